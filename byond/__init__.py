@@ -5,6 +5,8 @@ Created on Sep 21, 2013
 '''
 import os
 
+__version__ = '0.1.4'
+
 def GetFilesFromDME(dmefile='baystation12.dme', ext='.dm'):
     filesInDME=[]
     rootdir = os.path.dirname(dmefile)
@@ -57,10 +57,12 @@ for name, color in COLORS.items():
 import re, hashlib, collections
 from .utils import eval_expr
 REGEX_TABS = re.compile('^(?P<tabs>\t*)') 
-class BYONDValue:
+class BYONDValue(object):
     """
     Handles numbers and unhandled types like lists.
     """
+    __slots__ = ('value', 'filename', 'line', 'type', 'inherited', 'declaration', 'special', 'size')
+    
     def __init__(self, string, filename='', line=0, typepath='/', **kwargs):
         # : The actual value.
         self.value = string
@@ -119,6 +121,8 @@ class BYONDFileRef(BYONDValue):
     """
     Just to format file references differently.
     """
+    __slots__ = ()
+    
     def __init__(self, string, filename='', line=0, **kwargs):
         BYONDValue.__init__(self, string, filename, line, '/icon', **kwargs)
         
@@ -135,6 +139,8 @@ class BYONDString(BYONDValue):
     """
     Correctly formats strings.
     """
+    __slots__ = ()
+    
     def __init__(self, string, filename='', line=0, **kwargs):
         BYONDValue.__init__(self, string, filename, line, '/', **kwargs)
         
@@ -151,6 +157,8 @@ class BYONDList(BYONDValue):
     """
     Correctly formats lists (dict/lists).
     """
+    __slots__ = ()
+    
     def __init__(self, value, filename='', line=0, **kwargs):
         BYONDValue.__init__(self, value, filename, line, '/', **kwargs)
         
@@ -186,84 +194,126 @@ class PropertyFlags:
     # : Property being set should be handled as a value
     VALUE = 8
     
-class Atom:
+class HashedProperties(dict):
     '''
-    An atom is, in simple terms, what BYOND considers a class.
-    
-    :param string path:
-        The absolute path of this atom.  ex: */obj/item/weapon/gun*
-    :param string filename:
-        The file this atom originated from.
-    :param int line:
-        The line in the aforementioned file.
+    Vars of a :class:`MapAtom`.  Edits drop the atom's cached hash.
     '''
-
-    # : Prints all inherited properties, not just the ones that are mapSpecified.
-    FLAG_INHERITED_PROPERTIES = 1
-    
-    # : writeMap2 prints old_ids instead of the actual IID.
-    FLAG_USE_OLD_ID = 2  
+    __slots__ = ('_atom',)
     
-    def __init__(self, path, filename='', line=0, **kwargs):
-        global TURF_LAYER, AREA_LAYER, OBJ_LAYER, MOB_LAYER
-        
-        # : Absolute path of this atom
-        self.path = path
-        
-        # : Vars of this atom, including inherited vars.
-        self.properties = collections.OrderedDict()
-        
-        # : List of var names that were specified by the map, if atom was loaded from a :class:`byond.map.Map`.
-        self.mapSpecified = []
-        
-        # : Child atoms and procs.
-        self.children = {}
-        
-        # : The parent of this atom.
-        self.parent = None
-        
-        # : The file this atom originated from.
-        self.filename = filename
-        
-        # : Line from the originating file.
-        self.line = line
-        
-        # : Instance ID (maps only).  Used internally, do NOT change.
-        self.ID = None
+    def __init__(self, atom=None, *args):
+        dict.__init__(self, *args)
+        self._atom = atom
+        
+    def _touch(self):
+        atom = getattr(self, '_atom', None)
+        if atom is not None:
+            atom._hash = None
+            
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch()
         
-        # : Instance ID that was read from the map.
-        self.old_id = None
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch()
         
-        # : Used internally.
-        self.ob_inherited = False
+    def pop(self, *args):
+        self._touch()
+        return dict.pop(self, *args)
+    
+    def popitem(self):
+        self._touch()
+        return dict.popitem(self)
+    
+    def setdefault(self, key, default=None):
+        self._touch()
+        return dict.setdefault(self, key, default)
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._touch()
         
-        # : Loaded from map, but missing in the code. (Maps only)
-        self.missing = kwargs.get('missing', False)
+    def clear(self):
+        dict.clear(self)
+        self._touch()
         
-        # if not self.missing and path == '/area/engine/engineering':
-        #    raise Exception('God damnit')
+class HashedNames(list):
+    '''
+    mapSpecified of a :class:`MapAtom`.  Edits drop the atom's cached hash.
+    '''
+    __slots__ = ('_atom',)
+    
+    def __init__(self, atom=None, *args):
+        list.__init__(self, *args)
+        self._atom = atom
+        
+    def _touch(self):
+        atom = getattr(self, '_atom', None)
+        if atom is not None:
+            atom._hash = None
+            
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._touch()
+        
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._touch()
+        
+    def __iadd__(self, other):
+        list.extend(self, other)
+        self._touch()
+        return self
+    
+    def append(self, value):
+        list.append(self, value)
+        self._touch()
         
-        self._hash = None
+    def extend(self, values):
+        list.extend(self, values)
+        self._touch()
         
-        # : Coords
-        self.coords = None
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._touch()
         
-        # : Used for masters to track instance locations.
-        self.locations = []
+    def remove(self, value):
+        list.remove(self, value)
+        self._touch()
         
-    def rmLocation(self, map, coord, autoclean=True):
-        if coord in self.locations:
-            self.locations.remove(coord)
-        if autoclean and len(self.locations) == 0:
-            map.instances[self.ID] = None  # Mark ready for recovery
-            map._instance_idmap.pop(self.GetHash(), None)
+    def pop(self, *args):
+        self._touch()
+        return list.pop(self, *args)
     
-    def addLocation(self, coord):
-        self.locations.append(coord)
+    def clear(self):
+        list.clear(self)
+        self._touch()
         
+class BaseAtom(object):
+    '''
+    Behaviour shared by object tree atoms (:class:`Atom`) and the instances
+    a map holds (:class:`MapAtom`).  Holds no state of its own.
+    '''
+    __slots__ = ()
+    
+    # : Prints all inherited properties, not just the ones that are mapSpecified.
+    FLAG_INHERITED_PROPERTIES = 1
+    
+    # : writeMap2 prints old_ids instead of the actual IID.
+    FLAG_USE_OLD_ID = 2  
+    
+    @staticmethod
+    def MakeHashKey(path, properties, mapSpecified):
+        '''
+        :returns tuple:
+            Path and frozen (name, value) set of the map-specified vars, which
+            is all a map saves of an instance.
+        '''
+        return (path, frozenset([(key, str(properties[key])) for key in mapSpecified if key in properties]))
+    
     def UpdateHash(self, no_map_update=False):
         if self._hash is None:
-            self._hash = hashlib.md5(str(self).encode('utf-8')).hexdigest()
+            self._hash = hash(self.GetHashKey())
 
     def UpdateMap(self, map):
         self.UpdateHash()
@@ -273,22 +323,44 @@ class Atom:
         self._hash = None
         
     def GetHash(self):
+        '''
+        Cached until a var is edited through :meth:`setProperty`, or through
+        *properties* and *mapSpecified* of a :class:`MapAtom`.  Atoms of the
+        object tree must be invalidated by hand after direct edits.
+        
+        :returns int:
+            Hash of :meth:`GetHashKey`.  Only stable within one process; see
+            :meth:`GetContentHash` for a portable one.
+        '''
         self.UpdateHash()
         return self._hash
     
+    def GetHashKey(self):
+        '''
+        :returns tuple:
+            What :meth:`GetHash` hashes, built on every call.  Registries use
+            it to tell collisions apart.
+        '''
+        return self.MakeHashKey(self.path, self.properties, self.mapSpecified)
+    
+    def GetContentHash(self):
+        '''
+        :returns str:
+            MD5 of the serialized atom.
+        '''
+        return hashlib.md5(str(self).encode('utf-8')).hexdigest()
+    
     def copy(self, toNewMap=False):
         '''
         Make a copy of this atom, without dangling references.
         
-        :returns byond.basetypes.Atom
+        :returns byond.basetypes.MapAtom
         '''
-        new_node = Atom(self.path, self.filename, self.line, missing=self.missing)
-        new_node.properties = self.properties.copy()
-        new_node.mapSpecified = self.mapSpecified
+        # MapAtom copies these, into containers that track edits.
+        new_node = MapAtom(self.path, self.filename, self.line, missing=self.missing, properties=self.properties, mapSpecified=self.mapSpecified)
         if not toNewMap:
             new_node.ID = self.ID
             new_node.old_id = self.old_id
-        new_node.UpdateHash()
         # new_node.parent = self.parent
         return new_node
     
@@ -357,24 +429,7 @@ class Atom:
         else:
             self.properties[index] = BYONDValue(value)
         
-        self.UpdateHash()
-
-    def InheritProperties(self):
-        if self.ob_inherited: return
-        # debugInheritance=self.path in ('/area','/obj','/mob','/atom/movable','/atom')
-        if self.parent:
-            if not self.parent.ob_inherited:
-                self.parent.InheritProperties()
-            for key in sorted(self.parent.properties.keys()):
-                value = self.parent.properties[key].copy()
-                if key not in self.properties:
-                    self.properties[key] = value
-                    self.properties[key].inherited = True
-                    # if debugInheritance:print('  {0}[{2}] -> {1}'.format(self.parent.path,self.path,key))
-        # assert 'name' in self.properties
-        self.ob_inherited = True
-        for k in self.children.keys():
-            self.children[k].InheritProperties()
+        self.InvalidateHash()
 
     def __ne__(self, atom):
         return not self.__eq__(atom)
@@ -439,6 +494,79 @@ class Atom:
             return o + 'None'
         return o + repr(self.properties[name])
     
+class Atom(BaseAtom):
+    '''
+    An atom is, in simple terms, what BYOND considers a class.
+    
+    :param string path:
+        The absolute path of this atom.  ex: */obj/item/weapon/gun*
+    :param string filename:
+        The file this atom originated from.
+    :param int line:
+        The line in the aforementioned file.
+    '''
+
+    def __init__(self, path, filename='', line=0, **kwargs):
+        global TURF_LAYER, AREA_LAYER, OBJ_LAYER, MOB_LAYER
+        
+        # : Absolute path of this atom
+        self.path = path
+        
+        # : Vars of this atom, including inherited vars.
+        self.properties = collections.OrderedDict()
+        
+        # : List of var names that were specified by the map, if atom was loaded from a :class:`byond.map.Map`.
+        self.mapSpecified = []
+        
+        # : Child atoms and procs.
+        self.children = {}
+        
+        # : The parent of this atom.
+        self.parent = None
+        
+        # : The file this atom originated from.
+        self.filename = filename
+        
+        # : Line from the originating file.
+        self.line = line
+        
+        # : Instance ID (maps only).  Used internally, do NOT change.
+        self.ID = None
+        
+        # : Instance ID that was read from the map.
+        self.old_id = None
+        
+        # : Used internally.
+        self.ob_inherited = False
+        
+        # : Loaded from map, but missing in the code. (Maps only)
+        self.missing = kwargs.get('missing', False)
+        
+        # if not self.missing and path == '/area/engine/engineering':
+        #    raise Exception('God damnit')
+        
+        self._hash = None
+        
+        # : Coords
+        self.coords = None
+        
+    def InheritProperties(self):
+        if self.ob_inherited: return
+        # debugInheritance=self.path in ('/area','/obj','/mob','/atom/movable','/atom')
+        if self.parent:
+            if not self.parent.ob_inherited:
+                self.parent.InheritProperties()
+            for key in sorted(self.parent.properties.keys()):
+                value = self.parent.properties[key].copy()
+                if key not in self.properties:
+                    self.properties[key] = value
+                    self.properties[key].inherited = True
+                    # if debugInheritance:print('  {0}[{2}] -> {1}'.format(self.parent.path,self.path,key))
+        # assert 'name' in self.properties
+        self.ob_inherited = True
+        for k in self.children.keys():
+            self.children[k].InheritProperties()
+
     def _DumpCode(self):
         divider = '//' + ((len(self.path) + 2) * '/') + '\n'
         o = divider
@@ -487,6 +615,47 @@ class Atom:
     def DumpCode(self):
         return self._DumpCode()
     
+class MapAtom(BaseAtom):
+    '''
+    An instance placed on a map: the path and vars of an atom, without the
+    object tree's parent, children and inheritance bookkeeping.
+    
+    :param string path:
+        The absolute path of this atom.
+    '''
+    __slots__ = ('path', '_properties', '_mapSpecified', 'filename', 'line', 'ID', 'old_id', 'missing', '_hash', 'coords')
+    
+    def __init__(self, path, filename='', line=0, **kwargs):
+        self.path = path
+        self.properties = kwargs.get('properties', ())
+        self.mapSpecified = kwargs.get('mapSpecified', ())
+        self.filename = filename
+        self.line = line
+        self.ID = None
+        self.old_id = None
+        self.missing = kwargs.get('missing', False)
+        self._hash = None
+        self.coords = None
+        
+    @property
+    def properties(self):
+        return self._properties
+    
+    @properties.setter
+    def properties(self, value):
+        # Copied, so the cached hash only follows edits made through this atom.
+        self._properties = HashedProperties(self, value)
+        self._hash = None
+        
+    @property
+    def mapSpecified(self):
+        return self._mapSpecified
+    
+    @mapSpecified.setter
+    def mapSpecified(self, value):
+        self._mapSpecified = HashedNames(self, value)
+        self._hash = None
+        
 class Proc(Atom):
     def __init__(self, path, arguments, filename='', line=0):
         Atom.__init__(self, path, filename, line)
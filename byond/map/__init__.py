@@ -22,10 +22,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
-import os, itertools, sys, numpy, logging, hashlib
+import os, itertools, sys, numpy, logging, hashlib, types
 from byond.map.format import GetMapFormat, Load as LoadMapFormats
+from byond.map.format.base import LazyAtom, GetGridDType
+from byond.map import spatial
+from byond.map.spatial import SpatialIndex, LocationIndex
 from byond.DMI import DMI
-from byond.directions import SOUTH, IMAGE_INDICES
+from byond.directions import NORTH, SOUTH, EAST, WEST, IMAGE_INDICES
 from byond.basetypes import Atom, BYONDString, BYONDValue, BYONDFileRef, BYOND2RGBA
 # from byond.objtree import ObjectTree
 from PIL import Image, ImageChops
@@ -50,13 +53,18 @@ def tint_image(image, tint_color):
     return ImageChops.multiply(image, Image.new('RGBA', image.size, tint_color))
 
 class LocationIterator:
+    '''
+    Yields a :class:`TileView` for every cell, row by row.  See
+    :meth:`Map.IterTileIDs` to skip the views.
+    '''
     def __init__(self, _map):
         self.map = _map
         self.x = -1
         self.y = 0
         self.z = 0
-
+        
         self.max_z = len(self.map.zLevels)
+        self.cells = _map.IterTileIDs()
         
     def __iter__(self):
         return self
@@ -65,24 +73,8 @@ class LocationIterator:
         return self.next()
     
     def next(self):
-        self.x += 1
-        
-        zLev = self.map.zLevels[self.z]
-        
-        if self.x >= zLev.width:
-            self.y += 1
-            self.x = 0
-            
-        if self.y >= zLev.height:
-            self.z += 1
-            self.y = 0
-            
-        if self.z >= self.max_z:
-            raise StopIteration
-        
-        t = self.map.GetTileAt(self.x, self.y, self.z)
-        # print('{} = {}'.format((self.x,self.y,self.z),str(t)))
-        return t
+        self.x, self.y, self.z, tileID = next(self.cells)
+        return TileView(self.map.tiles[tileID], (self.x, self.y, self.z))
 
 class TileIterator:
     def __init__(self, _map):
@@ -124,11 +116,29 @@ class AtomIterator:
         if self.pos >= self.max:
             raise StopIteration
         
-        t = self.map.instances[self.pos]
+        t = self.map.MaterializeInstance(self.pos)
         # print('#{} = {}'.format(self.pos,str(t)))
         return t
 
+class TileRenderState(object):
+    '''
+    Rendering scratch space for a :class:`Tile`, only created when the tile
+    is rendered.
+    '''
+    __slots__ = ('frame', 'unselected_frame', 'areaSelected', 'offset', 'render_deferred')
+    
+    def __init__(self):
+        self.frame = None
+        self.unselected_frame = None
+        self.areaSelected = True
+        self.offset = (32, 32)
+        self.render_deferred = False
+        
 class Tile(object):
+    __slots__ = ('master', 'coords', 'origID', 'ID', 'instances', 'render', 'map', '_hash', 'orig_hash')
+    
+    log = logging.getLogger(__name__ + '.Tile')
+    
     def __init__(self, _map, master=False):
         # : Map's copy of the tile, used for tracking.
         self.master = master
@@ -136,19 +146,17 @@ class Tile(object):
         self.origID = ''
         self.ID = -1
         self.instances = []
-        self.locations = []
-        self.frame = None
-        self.unselected_frame = None
-        self.areaSelected = True
-        self.log = logging.getLogger(__name__ + '.Tile')
+        # : See GetRenderState().
+        self.render = None
         self.map = _map
         self._hash = None
         self.orig_hash = None
         
     def UpdateHash(self, no_map_update=False):
         if self._hash is None:
-            # Why MD5?  Because the shorter the string, the faster the comparison.
-            self._hash = hashlib.md5(str(self).encode('utf-8')).hexdigest()
+            # Instances are deduplicated by the registry, so their IDs say
+            # everything about the tile without serializing a single atom.
+            self._hash = tuple(self.instances)
             if not no_map_update: 
                 self.ID=self.map.UpdateTile(self)
                 if self.ID==-1:
@@ -158,10 +166,27 @@ class Tile(object):
         if self._hash is not None:
             self.orig_hash = self._hash
         self._hash = None
+        if self.master and self.map is not None:
+            # The registry's tile is being edited in place, so the paths
+            # and instances indexed for its ID may no longer hold.
+            self.map._spatial = None
+            self.map._instance_tiles = None
         
     def GetHash(self):
+        '''
+        :return tuple:
+            Instance IDs of the tile.  Only meaningful within its map; see
+            :meth:`GetContentHash` for a portable one.
+        '''
         self.UpdateHash()
         return self._hash
+    
+    def GetContentHash(self):
+        '''
+        :return str:
+            MD5 of the serialized tile, comparable across maps.
+        '''
+        return hashlib.md5(str(self).encode('utf-8')).hexdigest()
         
     def RemoveAtom(self, atom, hash=True):
         '''
@@ -179,6 +204,9 @@ class Tile(object):
             Atom to add.
         '''
         if atom is None: return
+        if isinstance(atom, AtomView):
+            # Registering it would renumber the instance in its own map.
+            atom = atom.copy()
         atom.UpdateMap(self.map)
         self.instances.append(atom.ID)
         self.InvalidateHash()
@@ -206,12 +234,16 @@ class Tile(object):
         
         return tile
     
-    def GetAtoms(self):
+    def GetAtoms(self, copy=False):
+        '''
+        :param copy bool:
+            Return editable copies instead of read-only :class:`AtomView`\ s.
+        '''
         atoms = []
         for id in self.instances:
             if id is None: 
                 continue
-            a = self.map.GetInstance(id)
+            a = self.map.GetInstance(id, copy)
             if a is None:
                 self.log.debug('Unknown instance ID {}!'.format(id))
                 continue
@@ -221,22 +253,26 @@ class Tile(object):
     def SortAtoms(self):
         return sorted(self.GetAtoms(), reverse=True)
     
-    def GetAtom(self, idx):
-        return self.map.GetInstance(self.instances[idx])
+    def GetAtom(self, idx, copy=False):
+        return self.map.GetInstance(self.instances[idx], copy)
     
     def GetInstances(self):
         return self.instances
     
-    def rmLocation(self, coord, autoclean=True):
-        if coord in self.locations:
-            self.locations.remove(coord)
-        if autoclean and len(self.locations) == 0:
-            self.map.tiles[self.ID] = None  # Mark ready for recovery
-            self.map._tile_idmap.pop(self.GetHash(), None)
+    def GetRenderState(self):
+        '''
+        :rtype TileRenderState:
+        '''
+        if self.render is None:
+            self.render = TileRenderState()
+        return self.render
     
-    def addLocation(self, coord):
-        if coord not in self.locations:
-            self.locations.append(coord)
+    @property
+    def locations(self):
+        '''
+        (x, y, z) of every cell using this tile, from :meth:`Map.GetTileLocations`.
+        '''
+        return [tuple(coord) for coord in self.map.GetTileLocations(self.ID).tolist()]
     
     def __str__(self):
         return self._serialize()
@@ -254,7 +290,8 @@ class Tile(object):
         
     def RenderToMapTile(self, passnum, basedir, renderflags, **kwargs):
         img = Image.new('RGBA', (96, 96))
-        self.offset = (32, 32)
+        render = self.GetRenderState()
+        render.offset = (32, 32)
         foundAPixelOffset = False
         render_types = kwargs.get('render_types', ())
         skip_alpha = kwargs.get('skip_alpha', False)
@@ -287,11 +324,10 @@ class Tile(object):
             
             dmi_file = atom.properties['icon'].value
             
-            if 'icon_state' not in atom.properties:
-                # Grab default icon_state ('') if we can't find the one defined.
-                atom.properties['icon_state'] = BYONDString("")
-            
-            state = atom.properties['icon_state'].value
+            # Grab default icon_state ('') if we can't find the one defined.
+            state = ''
+            if 'icon_state' in atom.properties:
+                state = atom.properties['icon_state'].value
             
             direction = SOUTH
             if 'dir' in atom.properties:
@@ -369,7 +405,7 @@ class Tile(object):
         
         if passnum == 1 and not foundAPixelOffset:
             return None
-        if not self.areaSelected:
+        if not render.areaSelected:
             # Fade out unselected tiles.
             bands = list(img.split())
             # Excluding alpha band
@@ -379,6 +415,108 @@ class Tile(object):
         
         return img
 
+class AtomView(object):
+    '''
+    Read-only window onto an instance in a :class:`Map`'s registry.
+    
+    Reads go straight to the registered atom, so nothing is copied or
+    rehashed.  Call :meth:`copy` for an :class:`Atom` you can edit.
+    '''
+    __slots__ = ('_atom',)
+    
+    # : Methods that edit the atom or renumber it in a map.
+    MUTATORS = frozenset(('setProperty', 'InheritProperties', 'InvalidateHash', 'UpdateHash', 'UpdateMap'))
+    
+    def __init__(self, atom):
+        object.__setattr__(self, '_atom', atom)
+        
+    def __getattr__(self, name):
+        if name in self.MUTATORS:
+            raise AttributeError('AtomView is read-only; edit a copy() instead.')
+        value = getattr(self._atom, name)
+        if name == 'properties':
+            return types.MappingProxyType(value)
+        if name == 'mapSpecified':
+            return list(value)
+        return value
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('AtomView is read-only; edit a copy() instead.')
+    
+    def copy(self, toNewMap=False):
+        return self._atom.copy(toNewMap)
+    
+    def __str__(self):
+        return str(self._atom)
+    
+    def __repr__(self):
+        return '<AtomView of {!r}>'.format(self._atom)
+    
+    def __eq__(self, other):
+        return self._atom == getattr(other, '_atom', other)
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __lt__(self, other):
+        return self._atom < getattr(other, '_atom', other)
+    
+    def __gt__(self, other):
+        return self._atom > getattr(other, '_atom', other)
+    
+    __hash__ = None
+    
+class TileView(object):
+    '''
+    Read-only window onto a tile in a :class:`Map`'s registry, at coords.
+    
+    Call :meth:`copy` for a :class:`Tile` you can edit and put back with
+    :meth:`Map.SetTileAt`.
+    '''
+    __slots__ = ('_tile', 'coords')
+    
+    # : Methods that edit the tile or renumber it in its map.
+    MUTATORS = frozenset(('AppendAtom', 'RemoveAtom', 'InvalidateHash', 'UpdateHash'))
+    
+    def __init__(self, tile, coords=(0, 0, 0)):
+        object.__setattr__(self, '_tile', tile)
+        object.__setattr__(self, 'coords', coords)
+        
+    def __getattr__(self, name):
+        if name in self.MUTATORS:
+            raise AttributeError('TileView is read-only; edit a copy() instead.')
+        value = getattr(self._tile, name)
+        if name == 'instances':
+            return list(value)
+        if name == 'master':
+            return False
+        return value
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('TileView is read-only; edit a copy() instead.')
+    
+    def GetInstances(self):
+        return list(self._tile.instances)
+    
+    def copy(self, origID=False):
+        tile = self._tile.copy(origID)
+        tile.coords = self.coords
+        return tile
+    
+    def __str__(self):
+        return str(self._tile)
+    
+    def __repr__(self):
+        return '<TileView #{} at {}>'.format(self._tile.ID, self.coords)
+    
+    def __eq__(self, other):
+        return self._tile == getattr(other, '_tile', other)
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    __hash__ = None
+    
 class MapLayer:
     def __init__(self, z, _map, height=255, width=255):
         self.initial_load=False
@@ -388,13 +526,25 @@ class MapLayer:
         self.tiles = None
         self.Resize(height, width)
         self.z = z
+        # : Where tiles[0, 0] came from in the source map, as (x, y, z).
+        self.origin = (0, 0, z)
         
         
-    def GetTile(self, x, y):
+    def GetTile(self, x, y, copy=False):
+        '''
+        :param copy bool:
+            Return an editable :class:`Tile` instead of a :class:`TileView`.
+        '''
         # return self.tiles[y][x]
-        t = self.map.GetTileByID(self.tiles[x, y])
-        t.coords = (x, y, self.z)
-        return t
+        t = self.map.tiles[self.tiles[x, y]]
+        if t is None:
+            return None
+        if copy:
+            t = t.copy()
+            t.master = False
+            t.coords = (x, y, self.z)
+            return t
+        return TileView(t, (x, y, self.z))
     
     def SetTile(self, x, y, tile):
         '''
@@ -413,10 +563,14 @@ class MapLayer:
         '''
         
         # Set new tile.
-        if not self.initial_load: 
+        if isinstance(tile, TileView):
+            # Already registered.
+            pass
+        elif not self.initial_load: 
             tile.ID=self.map.UpdateTile(tile)
+        self.fitTileID(tile.ID)
         self.tiles[x, y] = tile.ID
-        #self.map.tiles[tile.ID].addLocation((x, y, self.z))
+        self.map._locations = None
         
         
     
@@ -444,23 +598,166 @@ class MapLayer:
                 if t: t.rmLocation((x, y, self.z))
         '''
        
+        self.fitTileID(newID)
         self.tiles[x, y] = newID
-        #self.map.tiles[newID].addLocation((x, y, self.z))
-        
-    def Resize(self, height, width):
-        self.height = height
-        self.width = width
-        
-        basetile = self.map.basetile;
-        if self.tiles is None:
-            self.tiles = numpy.empty((height, width), int)  # object)
-            for y in range(height):
-                for x in range(width):
-                    self.SetTile(x, y, basetile)
-        else:
-            self.tiles.resize(height, width)
-                
-        # self.tiles = [[Tile(self.map) for _ in range(width)] for _ in range(height)]
+        self.map._locations = None
+        
+    def SetTiles(self, xs, ys, tileIDs):
+        '''
+        Set many cells at once.
+        
+        :param xs numpy.ndarray:
+        :param ys numpy.ndarray:
+        :param tileIDs numpy.ndarray:
+            IDs of registered tiles, one per (x, y).
+        '''
+        if len(tileIDs) == 0:
+            return
+        self.fitTileID(int(numpy.max(tileIDs)))
+        self.tiles[xs, ys] = tileIDs
+        self.map._locations = None
+        
+    def Fill(self, tile, bbox=None):
+        '''
+        Set every cell of a region to one tile.
+        
+        :param tile Tile|TileView|int:
+            Tile, or the ID of a registered one.
+        :param bbox tuple:
+            (x1, y1, x2, y2) to fill, with x2 and y2 exclusive, or None for
+            the whole level.
+        '''
+        tileID = self._registerTile(tile)
+        self.fitTileID(tileID)
+        self.tiles[self._region(bbox)] = tileID
+        self.map._locations = None
+        
+    def Replace(self, old, new, bbox=None):
+        '''
+        Swap one tile for another within a region.
+        
+        :param old Tile|TileView|int:
+        :param new Tile|TileView|int:
+        :param bbox tuple:
+            See :meth:`Fill`.
+        :return int: Number of cells changed.
+        '''
+        oldID = self._registerTile(old)
+        newID = self._registerTile(new)
+        self.fitTileID(newID)
+        region = self.tiles[self._region(bbox)]
+        mask = region == oldID
+        region[mask] = newID
+        self.map._locations = None
+        return int(mask.sum())
+        
+    def CopyRegion(self, bbox=None):
+        '''
+        :param bbox tuple:
+            See :meth:`Fill`.
+        :return numpy.ndarray: Tile IDs of the region, indexed [x, y].
+        '''
+        return numpy.array(self.tiles[self._region(bbox)])
+        
+    def PasteRegion(self, x, y, grid, source=None):
+        '''
+        Write a block of tile IDs with its corner at (x, y), which may be
+        negative.  Anything past the edges of the level is dropped.
+        
+        :param grid numpy.ndarray:
+            Tile IDs, indexed [x, y], as returned by :meth:`CopyRegion`.
+        :param source Map:
+            Map the IDs in grid belong to, if not this one.  Each distinct
+            tile is imported once.
+        '''
+        # Negative indices would wrap around to the far edge.
+        grid = numpy.asarray(grid)[max(0, -x):max(0, self.width - x), max(0, -y):max(0, self.height - y)]
+        x, y = max(0, x), max(0, y)
+        if grid.size == 0:
+            return
+        if source is not None and source is not self.map:
+            tileIDs, inverse = numpy.unique(grid, return_inverse=True)
+            lut = numpy.array([self.map.ImportTile(source.tiles[tileID]) for tileID in tileIDs])
+            grid = lut[inverse].reshape(grid.shape)
+        self.fitTileID(int(grid.max()))
+        width, height = grid.shape
+        self.tiles[x:x + width, y:y + height] = grid
+        self.map._locations = None
+        
+    def _registerTile(self, tile):
+        if isinstance(tile, (int, numpy.integer)):
+            if self.map.tiles[tile] is None:
+                raise KeyError('Unknown tile #{}'.format(tile))
+            return int(tile)
+        if not isinstance(tile, TileView):
+            tile.ID = self.map.UpdateTile(tile)
+        return tile.ID
+    
+    def _region(self, bbox):
+        if bbox is None:
+            return (slice(None), slice(None))
+        x1, y1, x2, y2 = [max(0, int(c)) for c in bbox]
+        return (slice(x1, x2), slice(y1, y2))
+        
+    def SetGrid(self, grid):
+        '''
+        Replace the entire tile grid at once.
+        
+        :param grid numpy.ndarray:
+            Tile IDs, indexed [x, y].
+        '''
+        self.width, self.height = grid.shape
+        self.max = (self.height - 1, self.width - 1)
+        self.tiles = grid
+        self.maxTileID = numpy.iinfo(grid.dtype).max
+        self.map._locations = None
+        
+    def fitTileID(self, tileID):
+        '''
+        Widen the grid's dtype if tileID doesn't fit in it.  A memory-mapped
+        grid is copied into memory when this happens.
+        '''
+        if tileID is not None and tileID > self.maxTileID:
+            self.tiles = self.tiles.astype(GetGridDType(tileID))
+            self.maxTileID = numpy.iinfo(self.tiles.dtype).max
+        
+    def Resize(self, height, width, anchor=NORTH | WEST):
+        '''
+        Change the size of the level.  Tiles keep their place relative to
+        anchor, anything outside the new size is dropped, and new cells get
+        the map's base tile.
+        
+        :param anchor int:
+            :mod:`byond.directions` flags for the edges that stay put.  NORTH
+            pins the top row (y = 0) and SOUTH the bottom one; WEST and EAST
+            do the same for columns.  With neither (or both) of a pair, the
+            content stays centered on that axis.
+        '''
+        fill = 0
+        if self.map.basetile is not None:
+            fill = self._registerTile(self.map.basetile)
+        dtype = GetGridDType(fill)
+        if self.tiles is not None:
+            dtype = numpy.promote_types(dtype, self.tiles.dtype)
+        grid = numpy.full((width, height), fill, dtype)
+        
+        if self.tiles is not None:
+            oldWidth, oldHeight = self.tiles.shape
+            dx = self._anchorOffset(oldWidth, width, anchor & WEST, anchor & EAST)
+            dy = self._anchorOffset(oldHeight, height, anchor & NORTH, anchor & SOUTH)
+            x1, x2 = max(0, dx), min(width, oldWidth + dx)
+            y1, y2 = max(0, dy), min(height, oldHeight + dy)
+            if x1 < x2 and y1 < y2:
+                grid[x1:x2, y1:y2] = self.tiles[x1 - dx:x2 - dx, y1 - dy:y2 - dy]
+        self.SetGrid(grid)
+    
+    @staticmethod
+    def _anchorOffset(oldSize, newSize, near, far):
+        if near and not far:
+            return 0
+        if far and not near:
+            return newSize - oldSize
+        return (newSize - oldSize) // 2
     
 class MapRenderFlags:
     RENDER_STARS = 1
@@ -470,13 +767,16 @@ class Map:
     def __init__(self, tree=None, **kwargs):
         self.zLevels = []
         
-        self._instance_idmap = {}  # md5 -> id
-        self._tile_idmap = {}  # md5 -> id
+        self._instance_idmap = {}  # Atom.GetHash() -> id
+        self._instance_collisions = {}  # Atom.GetHashKey() -> id, where GetHash() collided
+        self._tile_idmap = {}  # Tile.GetHash() -> id
         
         self.basetile = Tile(self)
         
         self.instances = []  # Atom
         self.tiles = []  # Tile
+        self._atom_views = {}  # id -> AtomView
+        self._tile_views = {}  # id -> TileView
          
         self.DMIs = {}
         self.tree = tree
@@ -484,11 +784,17 @@ class Map:
         self.selectedAreas = ()
         self.whitelistTypes = None
         self.forgiving_atom_lookups = kwargs.get('forgiving_atom_lookups', False)
+        # : Save tiles under the keys they were loaded with, where possible.
+        self.preserve_keys = kwargs.get('preserve_keys', False)
         
         self.log = logging.getLogger(__name__ + '.Map')
         
         self.missing_atoms = set()
         
+        self._spatial = None
+        self._locations = None
+        self._instance_tiles = None  # instance id -> [tile id], one per copy
+        
         self.basetile.UpdateHash();
         
     def ResetTilestore(self):
@@ -496,30 +802,121 @@ class Map:
         
         self.instances = []  # Atom
         self.tiles = []  # Tile
+        self._atom_views = {}  # id -> AtomView
+        self._tile_views = {}  # id -> TileView
+        self._instance_idmap = {}
+        self._instance_collisions = {}
+        self._tile_idmap = {}
+        self.zLevels = []
         self.basetile = None
+        self._spatial = None
+        self._locations = None
+        self._instance_tiles = None
         
-    def GetTileByID(self, tileID):
+    def GetTileByID(self, tileID, copy=False):
+        '''
+        :param copy bool:
+            Return an editable :class:`Tile` instead of a :class:`TileView`.
+        '''
         t = self.tiles[tileID]
         if t is None:
             return None
+        if not copy:
+            view = self._tile_views.get(tileID)
+            if view is None or view._tile is not t:
+                view = self._tile_views[tileID] = TileView(t)
+            return view
         t = t.copy()
         t.master = False
         return t
         
-    def GetInstance(self, atomID):
+    def GetInstance(self, atomID, copy=False):
+        '''
+        :param copy bool:
+            Return an editable :class:`Atom` instead of an :class:`AtomView`.
+        '''
         a=None
         try:
             a = self.instances[atomID]
         except IndexError as e:
             self.log.critical('Unable to find instance {}!')
             raise e
+        if isinstance(a, LazyAtom):
+            a = self.MaterializeInstance(atomID)
         if a is None:
             # print('WARNING: #{0} not found'.format(atomID)) 
             return None
+        if not copy:
+            view = self._atom_views.get(atomID)
+            if view is None or view._atom is not a:
+                view = self._atom_views[atomID] = AtomView(a)
+            return view
         a = a.copy()
         # a.master = False
         return a
     
+    def MaterializeInstance(self, atomID):
+        '''
+        Build the atom behind a :class:`LazyAtom` placeholder and put it in the
+        registry in its place.
+        
+        :param atomID int:
+        :return Atom: The registry's copy of the instance.
+        '''
+        a = self.instances[atomID]
+        if not isinstance(a, LazyAtom):
+            return a
+        atom = a.Materialize()
+        if atom is not None:
+            atom = atom.copy()
+            atom.ID = atomID
+        self.instances[atomID] = atom
+        if atom is not None:
+            self._registerInstance(atom, atomID)
+        return atom
+    
+    def _registerInstance(self, atom, atomID):
+        '''
+        Make atomID the instance to reuse for atoms equal to atom, unless an
+        equal instance is already registered.
+        '''
+        thash = atom.GetHash()
+        if thash not in self._instance_idmap:
+            self._instance_idmap[thash] = atomID
+        elif self._instance_idmap[thash] != atomID:
+            key = self._instanceKey(atomID)
+            if self._instanceKey(self._instance_idmap[thash]) != key:
+                self._instance_collisions.setdefault(key, atomID)
+    
+    def _instanceKey(self, atomID):
+        atom = self.MaterializeInstance(atomID)
+        return None if atom is None else atom.GetHashKey()
+    
+    def _findInstance(self, a):
+        '''
+        :return int: ID of the registered instance equal to a, or None.
+        '''
+        atomID = self._instance_idmap.get(a.GetHash())
+        if atomID is None:
+            return None
+        # Hashes only narrow it down; keys settle it.
+        key = a.GetHashKey()
+        if self._instanceKey(atomID) == key:
+            return atomID
+        return self._instance_collisions.get(key)
+    
+    def GetInstancePath(self, atomID):
+        '''
+        Path of an instance, without building it if it was loaded lazily.
+        
+        :param atomID int:
+        :return str:
+        '''
+        a = self.instances[atomID]
+        if a is None:
+            return None
+        return a.path
+        
     def UpdateTile(self, t):
         '''
         Update tile registry.
@@ -530,9 +927,6 @@ class Map:
         '''
         thash = t.GetHash()
 
-        # if t.ID >= 0 and t.ID < len(self.tiles) and self.tiles[t.ID] is not None:
-        #    self.tiles[t.ID].rmLocation(t.coords)
-           
         tiles_action = "-"
         '''
         if t in self.tiles:
@@ -545,7 +939,11 @@ class Map:
             idmap_action = "Added"
             
             t.ID = len(self.tiles)
-            self.tiles += [t.copy()]
+            # Keep the key it was loaded under, if any, for preserve_keys.
+            registered = t.copy(origID=True)
+            registered.master = True
+            self.tiles += [registered]
+            self._instance_tiles = None
             self._tile_idmap[thash] = t.ID
             tiles_action = "Added"
             #print('Assigned ID #{} to tile {}'.format(t.ID,thash))
@@ -556,7 +954,6 @@ class Map:
             
         #print('Updated #{} - Tiles: {}, idmap: {}'.format(t.ID, thash, tiles_action, idmap_action))
             
-        self.tiles[t.ID].addLocation(t.coords)
         return t.ID
         
     def UpdateAtom(self, a):
@@ -565,35 +962,29 @@ class Map:
         
         :param a Atom: Tile to update.
         '''
-        thash = a.GetHash()
-        
-        if a.ID and len(self.instances) < a.ID and self.instances[a.ID] is not None:
-            self.instances[a.ID].rmLocation(self, a.coords)
-            
-        if thash not in self._instance_idmap:
+        atomID = self._findInstance(a)
+        if atomID is None:
             a.ID = len(self.instances)
             self.instances += [a.copy()]
-            self._instance_idmap[thash] = a.ID
+            self._registerInstance(a, a.ID)
             #print('Assigned ID #{} to atom {}'.format(a.ID,thash))
         else:
-            a.ID = self._instance_idmap[thash]
-        if a.coords is not None:
-            self.instances[a.ID].addLocation(a.coords)
+            a.ID = atomID
         return a.ID
         
     def RemoveAtom(self, a):
         '''
-        Remove atom from the entire map.
+        Forget an atom, so it's no longer reused.  Its registry slot is
+        reclaimed by :meth:`Compact` once no tile uses it.
         
-        :param a Atom: Tile to update.
+        :param a Atom: Atom to remove.
         '''
+        key = a.GetHashKey()
+        if key in self._instance_collisions:
+            del self._instance_collisions[key]
+            return
         thash = a.GetHash()
-        
-        if a.ID and len(self.instances) < a.ID and self.instances[a.ID] is not None:
-            self.instances[a.ID].rmLocation(self, a.coords)
-            del self.instances[a.ID]
-            
-        if thash in self._instance_idmap:
+        if thash in self._instance_idmap and self._instanceKey(self._instance_idmap[thash]) == key:
             del self._instance_idmap[thash]
         
     def CreateZLevel(self, height, width, z= -1):
@@ -615,8 +1006,146 @@ class Map:
         return TileIterator(self)
     
     def Locations(self):
+        '''
+        Iterates over every cell of the map, as :class:`TileView`\ s.
+        '''
         return LocationIterator(self)
     
+    def IterTileIDs(self, z=None):
+        '''
+        Iterate over every cell straight from the grids, row by row.  Use
+        :meth:`GetTileByID` for the tiles themselves.
+        
+        :param z int:
+            Only this z-level.
+        :return generator: (x, y, z, tileID) tuples.
+        '''
+        for zLevel in self._levels(z):
+            for y, row in enumerate(zLevel.tiles.T.tolist()):
+                for x, tileID in enumerate(row):
+                    yield x, y, zLevel.z, tileID
+    
+    def IterRows(self, z=None):
+        '''
+        :return generator:
+            (y, z, tileIDs) for every row, where tileIDs is a read-only view of
+            the grid, indexed by x.
+        '''
+        for zLevel in self._levels(z):
+            for y in range(zLevel.height):
+                yield y, zLevel.z, self._readOnly(zLevel.tiles[:, y])
+    
+    def IterColumns(self, z=None):
+        '''
+        :return generator:
+            (x, z, tileIDs) for every column, where tileIDs is a read-only
+            view of the grid, indexed by y.
+        '''
+        for zLevel in self._levels(z):
+            for x in range(zLevel.width):
+                yield x, zLevel.z, self._readOnly(zLevel.tiles[x, :])
+    
+    def _levels(self, z):
+        return self.zLevels if z is None else [self.zLevels[z]]
+    
+    @staticmethod
+    def _readOnly(block):
+        block = block.view()
+        block.flags.writeable = False
+        return block
+    
+    def GetLocationIndex(self):
+        '''
+        :rtype LocationIndex:
+        '''
+        if self._locations is None:
+            self._locations = LocationIndex(self)
+        return self._locations
+    
+    def GetTileLocations(self, tileID):
+        '''
+        :return numpy.ndarray: One (x, y, z) row per cell using the tile.
+        '''
+        return self.GetLocationIndex().Get(tileID)
+    
+    def GetInstanceLocations(self, atomID):
+        '''
+        :return numpy.ndarray: 
+            One (x, y, z) row per cell holding the instance, once per copy of
+            it in the tile.
+        '''
+        if self._instance_tiles is None:
+            # Built once from the registry, like the location index is from the grids.
+            self._instance_tiles = {}
+            for tileID, tile in enumerate(self.tiles):
+                if tile is None:
+                    continue
+                for instanceID in tile.instances:
+                    self._instance_tiles.setdefault(instanceID, []).append(tileID)
+        locations = [numpy.empty((0, 3), int)]
+        for tileID in self._instance_tiles.get(atomID, []):
+            locations.append(self.GetTileLocations(tileID))
+        return numpy.concatenate(locations)
+    
+    def GetSpatialIndex(self):
+        '''
+        :rtype SpatialIndex:
+        '''
+        if self._spatial is None:
+            self._spatial = SpatialIndex(self)
+        return self._spatial
+    
+    def Locate(self, path, z=None, subtypes=True):
+        '''
+        Find every tile holding an instance of path (or, with subtypes, of
+        anything under it).
+        
+        :return numpy.ndarray: One (x, y, z) row per tile.
+        '''
+        return self.GetSpatialIndex().Locate(path, z, subtypes)
+    
+    def CountPerZ(self, path, subtypes=True):
+        '''
+        :return list: Number of instances of path on each z-level.
+        '''
+        return self.GetSpatialIndex().CountPerZ(path, subtypes)
+    
+    def GetTileIDsContaining(self, path, subtypes=True):
+        '''
+        :return numpy.ndarray: IDs of the registry tiles holding path.
+        '''
+        return self.GetSpatialIndex().GetTileIDs(path, subtypes)
+    
+    def MatchTiles(self, predicate, atoms=False):
+        '''
+        Evaluate predicate once per registry tile (or instance, with atoms).
+        
+        :return numpy.ndarray: Boolean lookup table indexed by tile ID.
+        '''
+        return spatial.MatchTiles(self, predicate, atoms)
+    
+    def Query(self, predicate, z=None, atoms=False, mask=False):
+        '''
+        Find the tiles for which predicate holds.
+        
+        predicate is called once per unique tile with a read-only
+        :class:`TileView` (or once per unique instance with an
+        :class:`AtomView`, if atoms is set), and the results are projected
+        onto the grids.
+        
+        :param z int:
+            Only search this z-level.
+        :param mask bool:
+            Return one [x, y] boolean mask per z-level instead of coordinates.
+        :return numpy.ndarray|list: 
+            One (x, y, z) row per matching tile, ordered by z, then y, then x.
+        '''
+        lut = spatial.MatchTiles(self, predicate, atoms)
+        levels = self._levels(z)
+        if mask:
+            return [spatial.ProjectMask(zLevel, lut) for zLevel in levels]
+        return spatial.MaskCoords(levels, lut)
+    
     def Load(self, filename, **kwargs):
         _, ext = os.path.splitext(filename)
         fmt = kwargs.get('format', 'dmm2' if ext == 'dmm2' else 'dmm')
@@ -663,7 +1192,7 @@ class Map:
         :param int x:
         :param int y:
         :param int z:
-        :rtype Tile:
+        :rtype TileView:
         '''
         if z < len(self.zLevels):
             return self.zLevels[z].GetTile(x, y)
@@ -675,7 +1204,8 @@ class Map:
         :param int z:
         :rtype Tile:
         '''
-        return self.GetTileAt(x, y, z).copy()
+        if z < len(self.zLevels):
+            return self.zLevels[z].GetTile(x, y, copy=True)
                 
     def SetTileAt(self, x, y, z, tile):
         '''
@@ -686,6 +1216,178 @@ class Map:
         if z < len(self.zLevels):
             self.zLevels[z].SetTile(x, y, tile)
                 
+    def FillRegion(self, z, tile, bbox=None):
+        '''
+        See :meth:`MapLayer.Fill`.
+        '''
+        self.zLevels[z].Fill(tile, bbox)
+                
+    def ReplaceTile(self, old, new, z=None, bbox=None):
+        '''
+        Swap one tile for another on z (or every z-level).  See
+        :meth:`MapLayer.Replace`.
+        
+        :return int: Number of cells changed.
+        '''
+        return sum(zLevel.Replace(old, new, bbox) for zLevel in self._levels(z))
+                
+    def CopyRegion(self, z, bbox=None):
+        '''
+        See :meth:`MapLayer.CopyRegion`.
+        '''
+        return self.zLevels[z].CopyRegion(bbox)
+                
+    def PasteRegion(self, x, y, z, grid, source=None):
+        '''
+        See :meth:`MapLayer.PasteRegion`.
+        '''
+        self.zLevels[z].PasteRegion(x, y, grid, source)
+                
+    def ImportTile(self, tile):
+        '''
+        Register a tile from another map, along with its instances.
+        
+        :param tile Tile|TileView:
+        :return int: ID of the tile in this map.
+        '''
+        if tile.map is self:
+            return tile.ID
+        newTile = self.CreateTile()
+        for atom in tile.GetAtoms(copy=True):
+            # IDs from the other map mean nothing here.
+            atom.ID = None
+            newTile.AppendAtom(atom, hash=False)
+        return self.UpdateTile(newTile)
+                
+    def Compact(self, preserve_keys=False):
+        '''
+        Drop tiles no z-level uses, and instances no remaining tile uses, and
+        renumber both registries densely.  Grids are remapped to match; Tiles
+        and IDs held outside the map are not.
+        
+        :param preserve_keys bool:
+            Keep the original DMM keys: sets :attr:`preserve_keys`, so saves
+            write each tile under the key it was loaded with.  Tiles also
+            keep their IDs where those still fit in the compacted registry,
+            and only the ones past its end move into the freed slots.
+            Otherwise tiles are renumbered in order.
+        :return numpy.ndarray:
+            New ID of each old tile ID, or -1 for dropped tiles.
+        '''
+        used = [numpy.unique(zLevel.tiles) for zLevel in self.zLevels]
+        if self.basetile is not None and 0 <= self.basetile.ID < len(self.tiles):
+            used.append(numpy.array([self.basetile.ID]))
+        live = numpy.unique(numpy.concatenate(used)) if len(used) > 0 else numpy.empty(0, int)
+        live = live[[self.tiles[tileID] is not None for tileID in live.tolist()]]
+        
+        tileLUT = numpy.full(len(self.tiles), -1, int)
+        if preserve_keys:
+            self.preserve_keys = True
+            keep = live[live < len(live)]
+            free = numpy.setdiff1d(numpy.arange(len(live)), keep)
+            tileLUT[keep] = keep
+            tileLUT[live[live >= len(live)]] = free
+        else:
+            tileLUT[live] = numpy.arange(len(live))
+        
+        # Instances keep their relative order.
+        atomLUT = numpy.full(len(self.instances), -1, int)
+        liveAtoms = set()
+        for tileID in live.tolist():
+            liveAtoms.update(atomID for atomID in self.tiles[tileID].instances if atomID is not None)
+        liveAtoms = sorted(atomID for atomID in liveAtoms if self.instances[atomID] is not None)
+        atomLUT[liveAtoms] = numpy.arange(len(liveAtoms))
+        
+        self.instances = [self.instances[atomID] for atomID in liveAtoms]
+        self._instance_idmap = {}
+        self._instance_collisions = {}
+        for atomID, atom in enumerate(self.instances):
+            atom.ID = atomID
+            self._registerInstance(atom, atomID)
+        self._atom_views = {}
+        self._tile_views = {}
+        
+        tiles = [None] * len(live)
+        self._tile_idmap = {}
+        for oldID in live.tolist():
+            tile = self.tiles[oldID]
+            tile.ID = int(tileLUT[oldID])
+            tile.instances = [int(atomLUT[atomID]) for atomID in tile.instances if atomID is not None and atomLUT[atomID] >= 0]
+            tile._hash = tuple(tile.instances)
+            tile.orig_hash = None
+            tiles[tile.ID] = tile
+            self._tile_idmap.setdefault(tile._hash, tile.ID)
+        self.tiles = tiles
+        if self.basetile is not None and 0 <= self.basetile.ID < len(tileLUT):
+            self.basetile.ID = int(tileLUT[self.basetile.ID])
+            self.basetile.instances = list(tiles[self.basetile.ID].instances)
+            self.basetile._hash = tiles[self.basetile.ID]._hash
+        
+        dtype = GetGridDType(len(tiles))
+        for zLevel in self.zLevels:
+            zLevel.SetGrid(tileLUT.astype(dtype)[zLevel.tiles])
+        self._spatial = None
+        self._locations = None
+        self._instance_tiles = None
+        return tileLUT
+    
+    @staticmethod
+    def _detachInstance(atom):
+        if isinstance(atom, LazyAtom):
+            detached = LazyAtom(atom.path, atom.source, atom.builder, atom._hash)
+            detached.ID = atom.ID
+            return detached
+        return atom.copy()
+    
+    def ExtractZLevels(self, zs=None):
+        '''
+        Split z-levels off into maps of their own.  Only the grids are copied:
+        each new map gets fresh registry entries for the tiles its level uses,
+        renumbered in order, and copies of the instances those use under their
+        current IDs, so either map can be edited or compacted on its own.
+        
+        :param zs list:
+            z-levels to extract, all of them by default.
+        :return list: One :class:`Map` per z-level, holding it as z-level 0.
+        '''
+        if zs is None:
+            zs = range(len(self.zLevels))
+        maps = []
+        for z in zs:
+            zLevel = self.zLevels[z]
+            used = [numpy.unique(zLevel.tiles)]
+            if self.basetile is not None and 0 <= self.basetile.ID < len(self.tiles):
+                used.append(numpy.array([self.basetile.ID]))
+            live = numpy.unique(numpy.concatenate(used))
+            
+            output = Map(self.tree, forgiving_atom_lookups=self.forgiving_atom_lookups)
+            output.ResetTilestore()
+            tileLUT = numpy.zeros(len(self.tiles), int)
+            tileLUT[live] = numpy.arange(len(live))
+            atomIDs = []
+            for tileID, oldID in enumerate(live.tolist()):
+                tile = Tile(output, master=True)
+                tile.ID = tileID
+                tile.origID = self.tiles[oldID].origID
+                tile.instances = list(self.tiles[oldID].instances)
+                tile._hash = tuple(tile.instances)
+                output.tiles.append(tile)
+                output._tile_idmap.setdefault(tile._hash, tileID)
+                atomIDs += tile.instances
+            liveAtoms = numpy.zeros(len(self.instances), bool)
+            liveAtoms[[atomID for atomID in atomIDs if atomID is not None]] = True
+            output.instances = [self._detachInstance(atom) if keep and atom is not None else None for atom, keep in zip(self.instances, liveAtoms.tolist())]
+            output._instance_idmap = dict((thash, atomID) for thash, atomID in self._instance_idmap.items() if liveAtoms[atomID])
+            output._instance_collisions = dict((key, atomID) for key, atomID in self._instance_collisions.items() if liveAtoms[atomID])
+            if self.basetile is not None and 0 <= self.basetile.ID < len(self.tiles):
+                output.basetile = output.tiles[tileLUT[self.basetile.ID]].copy()
+            
+            newZLevel = output.CreateZLevel(0, 0)
+            newZLevel.SetGrid(tileLUT.astype(GetGridDType(len(live)))[zLevel.tiles])
+            newZLevel.origin = zLevel.origin
+            maps.append(output)
+        return maps
+                
     def CreateTile(self):
         '''
         :rtype Tile:
@@ -702,9 +1404,10 @@ class Map:
         for tid in range(len(self.tileTypes)):
             tile = self.tileTypes[tid]
             img = Image.new('RGBA', (96, 96))
-            tile.offset = (32, 32)
-            tile.areaSelected = True
-            tile.render_deferred = False
+            render = tile.GetRenderState()
+            render.offset = (32, 32)
+            render.areaSelected = True
+            render.render_deferred = False
             for atom in sorted(tile.GetAtoms(), reverse=True):
                 
                 aid = atom.id
@@ -726,11 +1429,10 @@ class Map:
                 
                 dmi_file = atom.properties['icon'].value
                 
-                if 'icon_state' not in atom.properties:
-                    # Grab default icon_state ('') if we can't find the one defined.
-                    atom.properties['icon_state'] = BYONDString("")
-                
-                state = atom.properties['icon_state'].value
+                # Grab default icon_state ('') if we can't find the one defined.
+                state = ''
+                if 'icon_state' in atom.properties:
+                    state = atom.properties['icon_state'].value
                 
                 direction = SOUTH
                 if 'dir' in atom.properties:
@@ -794,15 +1496,15 @@ class Map:
                     self._icons[icon_key] = (frame, pixel_x, pixel_y)
                 img.paste(frame, (32 + pixel_x, 32 - pixel_y), frame)  # Add to the top of the stack.
                 if pixel_x != 0 or pixel_y != 0:
-                    tile.render_deferred = True
-            tile.frame = img
+                    render.render_deferred = True
+            render.frame = img
             
             # Fade out unselected tiles.
             bands = list(img.split())
             # Excluding alpha band
             for i in range(3):
                 bands[i] = bands[i].point(lambda x: x * 0.4)
-            tile.unselected_frame = Image.merge(img.mode, bands)
+            render.unselected_frame = Image.merge(img.mode, bands)
             
             self.tileTypes[tid] = tile
                 
@@ -0,0 +1,160 @@
+'''
+Differences between two maps.
+
+Both tile registries are first mapped onto one shared :class:`KeySpace` (the
+serialized tile), so finding the cells that changed is a single numpy
+comparison per z-level.  Atom-level changes are then only worked out once for
+each distinct (old tile, new tile) pair.
+'''
+import collections, numpy
+from byond.map.format.dmm import DMMFormat
+
+class TileChange(object):
+    '''
+    How one tile turns into another, as counts of serialized atoms.
+    '''
+    __slots__ = ('old', 'new', 'removed', 'added')
+
+    def __init__(self, oldAtoms, newAtoms):
+        # : Serialized atom -> count, in order of appearance.
+        self.old = collections.Counter(oldAtoms)
+        self.new = collections.Counter(newAtoms)
+        self.removed = self.old - self.new
+        self.added = self.new - self.old
+
+class KeySpace(object):
+    '''
+    One ID per distinct serialized tile, shared by every map added.
+    '''
+    def __init__(self):
+        # : Serialized tile -> shared ID.
+        self.keys = {}
+
+        # : Shared ID -> (MapKeys, tile ID) it was first seen as.
+        self.sources = []
+
+    def Add(self, _map):
+        '''
+        :rtype MapKeys:
+        '''
+        return MapKeys(self, _map)
+
+class MapKeys(object):
+    '''
+    A map's tiles and instances in a :class:`KeySpace`.
+    '''
+    def __init__(self, space, _map):
+        self.space = space
+        self.map = _map
+        self.format = DMMFormat(_map)
+        self.format.atomText = {}
+
+        # : Tile ID -> shared ID.
+        self.lut = numpy.full(len(_map.tiles), -1, int)
+        for tileID, tile in enumerate(_map.tiles):
+            if tile is None:
+                continue
+            key = self.format.SerializeTile(tile)
+            if key not in space.keys:
+                space.keys[key] = len(space.sources)
+                space.sources.append((self, tileID))
+            self.lut[tileID] = space.keys[key]
+
+        self._atomIDs = None
+
+    def Project(self, z):
+        '''
+        :return numpy.ndarray: Shared IDs of z-level z, indexed [x, y].
+        '''
+        return self.lut[self.map.zLevels[z].tiles]
+
+    def GetAtomKeys(self, tileID):
+        '''
+        :return list: Serialized atoms of the tile, in order.
+        '''
+        tile = self.map.tiles[tileID]
+        if tile is None:
+            return []
+        # Filled in by SerializeTile().
+        atomText = self.format.atomText
+        return [atomText[atomID] for atomID in tile.instances if atomText.get(atomID) is not None]
+
+    def GetAtomID(self, key):
+        '''
+        :return int: ID of an instance serializing to key, or None.
+        '''
+        if self._atomIDs is None:
+            self._atomIDs = {}
+            for atomID, text in self.format.atomText.items():
+                if text is not None:
+                    self._atomIDs.setdefault(text, atomID)
+        return self._atomIDs.get(key)
+
+class MapDiff(object):
+    '''
+    Cell-by-cell differences between old and new, two :class:`byond.map.Map`\\ s
+    of the same size.  Z-levels whose sizes don't match are listed in
+    :attr:`mismatched` and skipped.
+    '''
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+        self.space = KeySpace()
+        self.oldKeys = self.space.Add(old)
+        self.newKeys = self.space.Add(new)
+
+        # : z-levels that can't be compared, because they differ in size or
+        #   only exist in one map.
+        self.mismatched = []
+        self.zLevels = []
+        for z in range(max(len(old.zLevels), len(new.zLevels))):
+            if z >= len(old.zLevels) or z >= len(new.zLevels) or old.zLevels[z].tiles.shape != new.zLevels[z].tiles.shape:
+                self.mismatched.append(z)
+            else:
+                self.zLevels.append(z)
+
+        # : (old tile ID, new tile ID) -> TileChange
+        self.changes = {}
+
+    def GetChangedCells(self, z):
+        '''
+        :return numpy.ndarray:
+            One (x, y) row per cell of z-level z that differs, ordered by y,
+            then x.
+        '''
+        old = self.oldKeys.Project(z)
+        new = self.newKeys.Project(z)
+        # Grids are indexed [x, y]; transpose for row-major results.
+        ys, xs = numpy.nonzero((old != new).T)
+        return numpy.column_stack((xs, ys))
+
+    def CountChangedCells(self):
+        return sum(len(self.GetChangedCells(z)) for z in self.zLevels)
+
+    def Changes(self):
+        '''
+        :return generator:
+            (x, y, z, old tile ID, new tile ID) for every changed cell.
+        '''
+        for z in self.zLevels:
+            oldGrid = self.old.zLevels[z].tiles
+            newGrid = self.new.zLevels[z].tiles
+            for x, y in self.GetChangedCells(z).tolist():
+                yield x, y, z, int(oldGrid[x, y]), int(newGrid[x, y])
+
+    def GetChange(self, oldTileID, newTileID):
+        '''
+        :rtype TileChange:
+        '''
+        change = self.changes.get((oldTileID, newTileID))
+        if change is None:
+            change = self.changes[oldTileID, newTileID] = TileChange(self.oldKeys.GetAtomKeys(oldTileID), self.newKeys.GetAtomKeys(newTileID))
+        return change
+
+    def __iter__(self):
+        '''
+        :return generator: (x, y, z, :class:`TileChange`) for every changed cell.
+        '''
+        for x, y, z, oldTileID, newTileID in self.Changes():
+            yield x, y, z, self.GetChange(oldTileID, newTileID)
@@ -1,4 +1,4 @@
-import logging
+import logging, numpy
 
 _log = logging.getLogger("byond.mapformat")
 # Decorator
@@ -23,6 +23,39 @@ def GetMapFormat(_map,ext):
         _log.error('Unable to find MapFormat for {}.'.format(ext))
     return f(_map)
     
+def GetGridDType(maxID):
+    '''
+    Smallest unsigned dtype, of at least 16 bits, that holds tile IDs up to
+    maxID.
+    '''
+    return numpy.min_scalar_type(max(int(maxID), 0xFFFF))
+    
+class LazyAtom(object):
+    '''
+    Stand-in for a map instance that hasn't been built yet.
+    
+    Only the path and hash are known up front, so the registry can still
+    match it.  :class:`byond.map.Map` swaps in the real atom, built by calling
+    *builder* with *source*, the first time something asks for it.
+    '''
+    __slots__ = ('path', 'source', 'builder', 'ID', '_hash')
+    
+    def __init__(self, path, source, builder, thash=None):
+        self.path = path
+        self.source = source
+        self.builder = builder
+        self.ID = None
+        self._hash = thash
+        
+    def GetHash(self):
+        '''
+        :return int: What :meth:`Atom.GetHash` of the built atom will return.
+        '''
+        return self._hash
+        
+    def Materialize(self):
+        return self.builder(self.source)
+    
 class BaseMapFormat:
     def __init__(self, _map):
         self.map = _map
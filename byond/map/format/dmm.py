@@ -1,8 +1,16 @@
 from byond.basetypes import *
 from byond.utils import getElapsed, do_profile
 # from byond.map import Tile, MapLayer
-from byond.map.format.base import BaseMapFormat, MapFormat
-import os, sys, logging, itertools, shutil, collections, math
+from byond.map.format.base import BaseMapFormat, MapFormat, LazyAtom, GetGridDType
+from byond.map.format.dmmcache import DMMCache
+from byond.map.format.dmmindex import DMMIndex
+import os, sys, re, logging, itertools, shutil, collections, math, hashlib, numpy
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport.
+    ProcessPoolExecutor = None
 
 # clock was removed in 3.8, but perf_counter was only added in 3.3
 if sys.version_info[0] >= 3 and sys.version_info[1] >= 3:
@@ -15,6 +23,103 @@ else:
 ID_ENCODING_TABLE = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 IET_SIZE = len(ID_ENCODING_TABLE)
 
+# (1,1,1) = {"
+# aaaaabaac
+# "}
+REGEX_ZLEVEL = re.compile(r'^\((?P<x>\d+),(?P<y>\d+),(?P<z>\d+)\)\s*=\s*\{"(?P<tiles>.*?)"\}', re.MULTILINE | re.DOTALL)
+
+# Everything that can appear between the parentheses of a tile definition.
+# Strings, {"text"} blocks and file refs are swallowed whole so their contents
+# never look like structure; anything else is a run of plain characters or a
+# single piece of punctuation.
+REGEX_ATOM_TOKEN = re.compile(r'''
+      "(?:[^"\\]|\\.)*"
+    | \{".*?"\}
+    | '(?:[^'\\]|\\.)*'
+    | [^"'(){},;=]+
+    | .
+''', re.VERBOSE | re.DOTALL)
+
+def ParseAtoms(text):
+    '''
+    Tokenize the atom list of a tile definition in a single pass.
+    
+    >>> ParseAtoms('/obj/item{name = "a; b"; x = list(1, 2)},/area')
+    [('/obj/item{name = "a; b"; x = list(1, 2)}', '/obj/item', [('name', '"a; b"'), ('x', 'list(1, 2)')]), ('/area', '/area', [])]
+    
+    :param text str:
+        Contents of the tile's parentheses.
+    :return list:
+        (chunk, path, properties) for each atom, where chunk is the atom's
+        source text and properties is a list of (name, value) tuples.  A
+        property without a value has a value of None.
+    '''
+    atoms = []
+    state = 0  # 0 = path, 1 = properties, 2 = after properties
+    depth = 0
+    atomStart = 0
+    propStart = 0
+    valueStart = 0
+    path = None
+    name = None
+    properties = []
+    pos = 0
+    for token in REGEX_ATOM_TOKEN.findall(text):
+        end = pos + len(token)
+        if state == 1:
+            if depth > 0:
+                if token == '(':
+                    depth += 1
+                elif token == ')':
+                    depth -= 1
+            elif token == '(':
+                depth = 1
+            elif token == '=':
+                if name is None:
+                    name = text[propStart:pos].strip()
+                    valueStart = end
+            elif token == ';' or token == '}':
+                if name is not None:
+                    properties.append((name, text[valueStart:pos].strip()))
+                elif text[propStart:pos].strip() != '':
+                    properties.append((text[propStart:pos].strip(), None))
+                name = None
+                propStart = end
+                if token == '}':
+                    state = 2
+        elif token == ',':
+            chunk = text[atomStart:pos].strip()
+            if state == 0:
+                path = chunk
+            if chunk != '':
+                atoms.append((chunk, path, properties))
+            state = 0
+            properties = []
+            atomStart = end
+        elif token == '{' and state == 0:
+            path = text[atomStart:pos].strip()
+            state = 1
+            propStart = end
+        pos = end
+    chunk = text[atomStart:].strip()
+    if state == 1 and name is not None:
+        properties.append((name, text[valueStart:].strip()))
+    if state == 0:
+        path = chunk
+    if chunk != '':
+        atoms.append((chunk, path, properties))
+    return atoms
+
+def ParseTileDefinitions(lines):
+    '''
+    Run :func:`ParseAtoms` over a batch of tile definition lines.  This only
+    touches text, so it can run in a worker process.
+    
+    :return list:
+        The parsed atoms of each line, in order.
+    '''
+    return [ParseAtoms(line.strip()[line.index('(') + 1:-1].rstrip()) for line in lines]
+
 def chunker(iterable, chunksize):
     """
     Return elements from the iterable in `chunksize`-ed lists. The last returned
@@ -54,40 +159,176 @@ class DMMFormat(BaseMapFormat):
         # Number of duplicates found when loading.
         self.duplicates = 0
         
+        # instance ID -> serialized atom, while saving.
+        self.atomText = None
+        
         # Caches
         self.tileChunk2ID = {}
+        # (path, properties) -> instance ID
         self.atomCache = {}
-    
-        self.atomBorders = {
-            '{':'}',
-            '"':'"',
-            '(':')'
-        }
-        nit = self.atomBorders.copy()
-        for start, stop in self.atomBorders.items():
-            if start != stop:
-                nit[stop] = None
-        self.atomBorders = nit
+        self.atomCacheHits = 0
+        self.atomCacheMisses = 0
+
         self.idlen = 0
         
         self.dump_inherited = False
         
+        # Keep instances as LazyAtoms until they're used.
+        self.lazy = False
+        
     def Load(self, filename, **kwargs):
+        '''
+        :param filename str:
+            Map to read.
+        :param cache bool:
+            Reuse (or write) a binary ``.dmm.cache`` next to the map, so
+            unchanged maps skip the parser.  Off by default.  Not used when
+            loading a selection or loading lazily.
+        :param mmap bool:
+            Memory-map the z-level grids from the ``.dmm.cache``, writing the
+            cache first if needed, instead of keeping them in RAM.  Implies
+            cache.  Grids are mapped copy-on-write, so edits stay private.
+        :param z int:
+            Only load this z-level (0-based), or a list of them.
+        :param bbox tuple:
+            Only load (x1, y1, x2, y2) of each z-level, with x2 and y2
+            exclusive.  The origin of each loaded level is kept in
+            :attr:`MapLayer.origin`.
+        :param lazy bool:
+            Keep each distinct atom as a :class:`LazyAtom` holding its source
+            text and path, and only build it when it's first used.  Instances
+            and tiles get the same IDs as in an eager load.
+        :param workers int:
+            Tokenize tile definitions in this many worker processes.  Atoms
+            and tiles are still built and registered here, in file order, so
+            IDs don't depend on the number of workers.  Not used when loading
+            a selection.
+        :param index bool:
+            When loading a selection, seek straight to the selected blocks and
+            the definitions they use through a ``.dmm.idx`` byte-offset index,
+            which is built on first use.  A :class:`DMMIndex` can be passed
+            instead, to reuse one across loads.
+        '''
         if not os.path.isfile(filename):
             self.log.warn('File ' + filename + " does not exist.")
         self.map.ResetTilestore()
         
         self.filename = filename
         self.lineNumber = 0
+        self.lazy = kwargs.get('lazy', False)
+        
+        zLevels = kwargs.get('z', None)
+        if isinstance(zLevels, int):
+            zLevels = [zLevels]
+        bbox = kwargs.get('bbox', None)
+        selective = zLevels is not None or bbox is not None
+        
+        cache = None
+        mmap = kwargs.get('mmap', False) and not (selective or self.lazy)
+        if (kwargs.get('cache', False) or mmap) and not (selective or self.lazy):
+            cache = DMMCache(filename)
+            if self.consumeCache(cache, mmap):
+                return
+            self.map.ResetTilestore()
+            
         with open(filename, 'r') as f:
-            self.log.info('Reading tile types from %s...', self.filename)
-            self.consumeTiles(f)
-            self.log.info('Reading tile positions...')
-            self.consumeTileMap(f)
+            if selective:
+                index = kwargs.get('index', None)
+                if index is True:
+                    index = DMMIndex(filename).Get()
+                self.consumeSelection(f, set(zLevels) if zLevels is not None else None, bbox, index or None)
+            else:
+                self.log.info('Reading tile types from %s...', self.filename)
+                self.consumeTiles(f, kwargs.get('workers', None))
+                self.log.info('Reading tile positions...')
+                self.consumeTileMap(f)
+        
+        if self.lazy:
+            # LazyAtoms keep this reader alive, so drop what's only needed while parsing.
+            self.tileTypes = []
+            self.tileChunk2ID = {}
+            self.atomCache = {}
+            
+        if cache is not None:
+            self.WriteCache(cache)
+            if mmap:
+                self.mapGrids(cache)
+            
+    def consumeCache(self, cache, mmap=False):
+        '''
+        Restore the map from a :class:`DMMCache`.  Instances are rebuilt from
+        their serialized form, so changes to the object tree still apply.
+        
+        :return bool: False if the cache was missing, stale or didn't fit.
+        '''
+        start = perf_counter()
+        cached = cache.Read(mmap)
+        if cached is None:
+            return False
+        header, grids = cached
+        for iid, chunk in enumerate(header['instances']):
+            atom = self.consumeAtom(chunk)
+            if atom is None:
+                return False
+            atom.UpdateMap(self.map)
+            if atom.ID != iid:
+                self.log.warning('{}: Instance #{} came back as #{}, ignoring cache.'.format(cache.cachefile, iid, atom.ID))
+                return False
+        for tid, instances in enumerate(header['tiles']):
+            t = self.map.CreateTile()
+            t.instances = instances
+            t.ID = self.map.UpdateTile(t)
+            if t.ID != tid:
+                self.log.warning('{}: Tile #{} came back as #{}, ignoring cache.'.format(cache.cachefile, tid, t.ID))
+                return False
+        
+        self.idlen = header['idlen']
+        self.oldID2NewID = header['keys']
+        self.tileTypes = []
+        for origID, tid in self.oldID2NewID.items():
+            if not self.map.tiles[tid].origID:
+                self.map.tiles[tid].origID = origID
+            t = self.map.GetTileByID(tid, copy=True)
+            t.origID = origID
+            self.tileTypes += [t]
+            if origID == 'aaa':
+                self.map.basetile = t
+        for grid in grids:
+            zLevel = self.map.CreateZLevel(0, 0)
+            zLevel.SetGrid(grid.T)
+        self.log.info('Restored {} tiles and {} z-levels from {} in {}'.format(len(header['tiles']), len(grids), cache.cachefile, getElapsed(start)))
+        return True
+    
+    def mapGrids(self, cache):
+        '''
+        Swap the freshly loaded grids for memory maps of the ones just written
+        to the cache.
+        '''
+        cached = cache.Read(True)
+        if cached is None:
+            self.log.warning('{}: Unable to map grids, keeping them in memory.'.format(cache.cachefile))
+            return
+        _, grids = cached
+        for zLevel, grid in zip(self.map.zLevels, grids):
+            zLevel.SetGrid(grid.T)
+            
+    def WriteCache(self, cache):
+        '''
+        Write the freshly loaded map to a :class:`DMMCache`.
+        '''
+        header = {
+            'idlen': self.idlen,
+            'keys': self.oldID2NewID,
+            'instances': [self.SerializeAtom(atom) for atom in self.map.instances],
+            'tiles': [tile.instances for tile in self.map.tiles],
+        }
+        dtype = GetGridDType(len(self.map.tiles))
+        if cache.Write(header, [zLevel.tiles.T.astype(dtype, copy=False) for zLevel in self.map.zLevels]):
+            self.log.info('Wrote {}'.format(cache.cachefile))
             
     def consumeDataValue(self, value):
         data = None
-        if value[0] in ('"', "'"):
+        if value[:1] in ('"', "'"):
             quote = value[0]
             if quote == '"':
                 data = BYONDString(value[1:-1], self.filename, self.lineNumber)
@@ -99,252 +340,400 @@ class DMMFormat(BaseMapFormat):
             data = BYONDValue(value, self.filename, self.lineNumber)
         return data
     def consumeTileMap(self, f):
-        zLevel = None
-        y = 0
-        z = 0
-        inZLevel = False
-        width = 0
-        height = 0
+        data = f.read()
+        if len(self.oldID2NewID) > 0:
+            self.log.debug('Tile keys are {} characters long.'.format(self.idlen))
+        for m in REGEX_ZLEVEL.finditer(data):
+            start = perf_counter()
+            z = int(m.group('z'))
+            lineNumber = self.lineNumber + data.count('\n', 0, m.start())
+            grid = self.consumeKeys(self.consumeZLevel(m.group('tiles'), lineNumber), lineNumber)
+            height, width = grid.shape
+            if width > 255:
+                self.log.warn('{}: z={} is {} blocks wide!'.format(self.filename, z, width))
+            zLevel = self.map.CreateZLevel(0, 0)
+            zLevel.SetGrid(grid.T)
+            self.log.info(' * Added map layer {0} ({1}x{2}, {3})'.format(z, height, width, getElapsed(start)))
+        self.lineNumber += data.count('\n')
         
+    def consumeSelection(self, f, zLevels=None, bbox=None, index=None):
+        '''
+        Load part of a map.  Blocks of unselected z-levels are skipped without
+        being decoded, and only tile definitions used in the selection (plus
+        "aaa", the base tile) are turned into tiles.
+        
+        :param zLevels set:
+            Indices of the z-levels to keep, or None for all of them.
+        :param bbox tuple:
+            (x1, y1, x2, y2) to keep from each level, with x2 and y2 exclusive,
+            or None for everything.
+        :param index DMMIndex:
+            Byte offsets of the map, to seek to what's needed instead of
+            reading the whole file.
+        '''
+        self.resetParser()
+        x1, y1 = 0, 0
+        if bbox is not None:
+            x1, y1, x2, y2 = [max(0, int(c)) for c in bbox]
+        
+        def select(keys):
+            if bbox is not None:
+                keys = keys[y1:y2, x1:x2]
+            used.update(key.decode('utf-8') for key in numpy.unique(keys))
+            return keys
+        
+        levels = []
+        used = set(['aaa'])
+        if index is None:
+            definitions = []
+            for line in self.readTileDefinitions(f):
+                origID = self.consumeTileID(line)
+                definitions.append((origID, line, self.lineNumber))
+                self.idlen = max(self.idlen, len(origID))
+            
+            data = f.read()
+            for z, m in enumerate(REGEX_ZLEVEL.finditer(data)):
+                if zLevels is not None and z not in zLevels:
+                    continue
+                lineNumber = self.lineNumber + data.count('\n', 0, m.start())
+                levels.append((z, select(self.consumeZLevel(m.group('tiles'), lineNumber)), lineNumber))
+            self.lineNumber += data.count('\n')
+            definitionCount = len(definitions)
+        else:
+            self.idlen = index.idlen
+            with open(self.filename, 'rb') as raw:
+                for z in range(len(index.zlevels)):
+                    if zLevels is not None and z not in zLevels:
+                        continue
+                    block, lineNumber = index.ReadBlock(raw, z)
+                    m = REGEX_ZLEVEL.match(block)
+                    levels.append((z, select(self.consumeZLevel(m.group('tiles'), lineNumber)), lineNumber))
+                definitions = []
+                for origID in sorted(used & set(index.keys), key=lambda key: index.keys[key][0]):
+                    line, lineNumber = index.ReadDefinition(raw, origID)
+                    definitions.append((origID, line, lineNumber))
+            definitionCount = len(index.keys)
+        
+        lastLine = self.lineNumber
+        for origID, line, lineNumber in definitions:
+            if origID in used:
+                self.lineNumber = lineNumber
+                self.consumeTileDefinition(line)
+        self.lineNumber = lastLine
+        self.log.info('{} of {} tiles used by the selection'.format(len(self.oldID2NewID), definitionCount))
+        self.logAtomCacheStats()
+        
+        for z, keys, lineNumber in levels:
+            zLevel = self.map.CreateZLevel(0, 0)
+            zLevel.SetGrid(self.consumeKeys(keys, lineNumber).T)
+            zLevel.origin = (x1, y1, z)
+            self.log.info(' * Added map layer {0} ({1}x{2} at {3},{4})'.format(z, zLevel.height, zLevel.width, x1, y1))
+                
+    def consumeZLevel(self, block, lineNumber=0):
+        '''
+        Split the contents of a (1,1,z) = {"..."} block into tile keys in bulk.
+        
+        :param block str:
+            Everything between the opening {" and the closing "}.
+        :param lineNumber int:
+            Line the block starts on, for error reporting.
+        :return numpy.ndarray:
+            Fixed-width byte strings, indexed [y, x].
+        '''
+        raw = numpy.frombuffer(block.strip().encode('utf-8'), numpy.uint8)
+        height = int(numpy.count_nonzero(raw == 10)) + 1
+        raw = raw[raw > 32]  # Line breaks and indentation.
+        if len(raw) % (height * self.idlen) != 0:
+            raise ValueError('{}:{}: Malformed z-level: {} characters can\'t be split into {} rows of {}-character keys.'.format(self.filename, lineNumber, len(raw), height, self.idlen))
+        return raw.view('S{}'.format(self.idlen)).reshape(height, -1)
+    
+    def consumeKeys(self, keys, lineNumber=0):
+        '''
+        Turn an array of tile keys into tile IDs.
+        
+        :param keys numpy.ndarray:
+            As returned by :func:`consumeZLevel`.
+        :return numpy.ndarray:
+            Tile IDs, in the same shape.
+        '''
+        # Only the distinct keys need a dict lookup.
+        uniqueKeys, inverse = numpy.unique(keys, return_inverse=True)
+        lut = numpy.empty(len(uniqueKeys), GetGridDType(len(self.map.tiles)))
+        for i, key in enumerate(uniqueKeys):
+            key = key.decode('utf-8')
+            if key not in self.oldID2NewID:
+                raise KeyError('{}:{}: Unknown tile key "{}"'.format(self.filename, lineNumber, key))
+            lut[i] = self.oldID2NewID[key]
+        return lut[inverse].reshape(keys.shape)
+    
+    def readTileDefinitions(self, f):
+        '''
+        Yield each tile definition line, up to the first line that isn't one.
+        '''
         while True:
-            self.lineNumber += 1
             line = f.readline()
-            if line == '':
+            self.lineNumber += 1
+            if not line.startswith('"'):
                 return
-            log_prefix="{}:{}: ".format(self.filename,self.lineNumber)
-            # (1,1,1) = {"
-            if line.startswith('('):
-                coordChunk = line[1:line.index(')')].split(',')
-                # print(repr(coordChunk))
-                z = int(coordChunk[2])
-                inZLevel = True
-                y = 0
-                width = 0
-                height = 0
+            # {"text"} blocks may span several lines.
+            while not line.rstrip().endswith(')') or line.count('{"') > line.count('"}'):
+                nextLine = f.readline()
+                if nextLine == '':
+                    break
+                self.lineNumber += 1
+                line += nextLine
+            yield line
                 
-                start = perf_counter()
-                #print(log_prefix+' START z={}'.format(z))
-                continue
-            if line.strip() == '"}':
-                zLevel.initial_load=False
-                inZLevel = False
-                if height == 0:
-                    height = y
-                # self.map.zLevels[z] = zLevel
-                zLevel = None
-                self.log.info(' * Added map layer {0} ({1}x{2}, {3})'.format(z, height, width, getElapsed(start)))
-                continue
-            if inZLevel:
-                if zLevel is None:
-                    zLevel = self.map.CreateZLevel(height, width)  # , z-1)
-                    zLevel.initial_load=True
-                    #print(log_prefix+' CREATED z={}'.format(z))
-                if width == 0:
-                    width = len(line) / self.idlen
-                    self.log.debug('Width detected as {}.'.format(width))
-                    zLevel.Resize(width, width)
-                if width > 255:
-                    self.log.warn("%sLine is {} blocks long!", log_prefix, width)
-                x = 0
-                for chunk in chunker(line.strip(), self.idlen):
-                    chunk = ''.join(chunk)
-                    tid = self.oldID2NewID[chunk]
-                    #if tid == 1:
-                    #print('[{},{}] Chunk: {}, tid: {}'.format(x,y,chunk,tid))
-                    zLevel.SetTileID(x, y, tid)
-                    x += 1
-                y += 1
-                
-    def consumeTiles(self, f):
-        index = 0
+    def resetParser(self):
+        '''
+        Forget the tiles, keys and atoms of the last map read, which would
+        otherwise resolve to IDs that no longer exist in the reset map.
+        '''
+        self.tileTypes = []
+        self.oldID2NewID = {}
+        self.idlen = 0
         self.duplicates = 0
         self.tileChunk2ID = {}
-        while True:
-            line = f.readline()
-            self.lineNumber += 1
-            if line.startswith('"'):
-                t = self.consumeTile(line)
-                #t.ID = index
-                t.map = self.map
-                t.UpdateHash()
-                self.tileTypes += [t]
-                self.idlen = max(self.idlen, len(t.origID))
-                if t.origID=='':
-                    self.log.warning('{}:{}: ERROR: Unable to determine origID.'.format(self.filename,self.lineNumber))
-                    sys.exit(1)
-                if t.origID == 'aaa':
-                    self.map.basetile=t
-                    self.log.debug('{}:{}: Loaded tile #{} ({}) as map.basetile.'.format(self.filename,self.lineNumber,t.ID,t.origID))
-                self.oldID2NewID[t.origID] = t.ID
-                self.tileChunk2ID[self.SerializeTile(t)] = t.ID
+        self.atomCache = {}
+        self.atomCacheHits = 0
+        self.atomCacheMisses = 0
+        
+    def consumeTiles(self, f, workers=None):
+        index = 0
+        self.resetParser()
+        if workers is not None and workers > 1 and ProcessPoolExecutor is not None:
+            definitions = []
+            for line in self.readTileDefinitions(f):
+                definitions.append((line, self.lineNumber))
+            lastLine = self.lineNumber
+            parsed = self.parseTileDefinitions([line for line, _ in definitions], workers)
+            for (line, lineNumber), atoms in zip(definitions, parsed):
+                self.lineNumber = lineNumber
+                self.consumeTileDefinition(line, atoms)
                 index += 1
-                # No longer needed, 2fast.
-                # if((index % 100) == 0):
-                #   print(index)
-            else:
-                self.log.info('{} tiles loaded, {} duplicates discarded'.format(index, self.duplicates))
-                return 
+            self.lineNumber = lastLine
+        else:
+            if workers is not None and workers > 1:
+                self.log.warning('concurrent.futures is unavailable, parsing tile definitions serially.')
+            for line in self.readTileDefinitions(f):
+                self.consumeTileDefinition(line)
+                index += 1
+            # No longer needed, 2fast.
+            # if((index % 100) == 0):
+            #   print(index)
+        self.log.info('{} tiles loaded, {} duplicates discarded'.format(index, self.duplicates))
+        self.logAtomCacheStats()
+        
+    def parseTileDefinitions(self, lines, workers):
+        '''
+        Tokenize tile definitions in a process pool.
+        
+        :return list:
+            The parsed atoms of each line, in the order given.
+        '''
+        start = perf_counter()
+        # A few batches per worker evens out uneven line lengths.
+        batchSize = max(1, int(math.ceil(len(lines) / float(workers * 4))))
+        parsed = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in pool.map(ParseTileDefinitions, chunker(lines, batchSize)):
+                parsed += batch
+        self.log.info('Tokenized {} tile definitions with {} workers in {}'.format(len(lines), workers, getElapsed(start)))
+        return parsed
     
-    def consumeTileAtoms(self, line):
+    def consumeTileDefinition(self, line, atoms=None):
+        t = self.consumeTile(line, atoms=atoms)
+        #t.ID = index
+        t.map = self.map
+        t.UpdateHash()
+        self.tileTypes += [t]
+        self.idlen = max(self.idlen, len(t.origID))
+        if t.origID=='':
+            self.log.warning('{}:{}: ERROR: Unable to determine origID.'.format(self.filename,self.lineNumber))
+            sys.exit(1)
+        if t.origID == 'aaa':
+            self.map.basetile=t
+            self.log.debug('{}:{}: Loaded tile #{} ({}) as map.basetile.'.format(self.filename,self.lineNumber,t.ID,t.origID))
+        self.oldID2NewID[t.origID] = t.ID
+        return t
+    
+    def consumeTileAtoms(self, line, atoms=None):
+        '''
+        Turn the atom list of a tile definition into instance IDs.
+        
+        Atoms are interned: every occurrence of the same path and properties,
+        however it's spaced, shares one registered instance.
+        '''
         instances = []
-        atom_chunks = self.SplitAtoms(line)
-
-        dbg = False
-        for atom_chunk in atom_chunks:
-            if atom_chunk in self.atomCache:
-                atom=self.atomCache[atom_chunk]
-                self.log.debug('[CACHED] Adding {} as {}.'.format(atom_chunk,str(atom)))
-                instances += [atom]
+        if atoms is None:
+            atoms = ParseAtoms(line.rstrip())
+        for atom_chunk, path, properties in atoms:
+            key = (path, tuple(properties))
+            if key in self.atomCache:
+                self.atomCacheHits += 1
+                instances += [self.atomCache[key]]
+                continue
+            self.atomCacheMisses += 1
+            if self.lazy:
+                atom = self.consumeLazyAtom(path, properties, atom_chunk)
+                if atom is None:
+                    continue
             else:
-                atom = self.consumeAtom(atom_chunk)
-                atom.InvalidateHash()
+                atom = self.consumeParsedAtom(path, properties, atom_chunk)
+                if atom is None:
+                    continue
                 atom.UpdateMap(self.map)
                 self.log.debug('Adding {} ({}) as {}.'.format(atom_chunk,atom.GetHash(),str(atom)))
-                self.atomCache[atom_chunk] = atom
-                instances += [atom]
-            
-        return [x.ID for x in instances]
+            self.atomCache[key] = atom.ID
+            instances += [atom.ID]
+        return instances
+    
+    def GetAtomCacheHitRate(self):
+        '''
+        :return float: Share of atoms read so far that were already interned.
+        '''
+        total = self.atomCacheHits + self.atomCacheMisses
+        if total == 0:
+            return 0.0
+        return self.atomCacheHits / float(total)
+    
+    def logAtomCacheStats(self):
+        self.log.info('{} atoms read, {} distinct ({:.1%} interned)'.format(self.atomCacheHits + self.atomCacheMisses, self.atomCacheMisses, self.GetAtomCacheHitRate()))
     
     def SplitProperties(self, string):
         o = []
-        buf = []
-        inString = False
-        for chunk in string.split(';'):
-            if not inString:
-                if '"' in chunk:
-                    inString = False
-                    pos = 0
-                    while(True):
-                        pos = chunk.find('"', pos)
-                        if pos == -1:
-                            break
-                        pc = ''
-                        if pos > 0:
-                            pc = chunk[pos - 1]
-                        if pc != '\\':
-                            inString = not inString
-                        pos += 1
-                    if not inString:
-                        o += [chunk]
-                    else:
-                        buf += [chunk]
-                else:
-                    o += [chunk]
-            else:
-                if '"' in chunk:
-                    o += [';'.join(buf + [chunk])]
-                    inString = False
-                    buf = []
-                else:
-                    buf += [chunk]
-        return o
+        depth = 0
+        pos = 0
+        start = 0
+        for token in REGEX_ATOM_TOKEN.findall(string):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif token == ';' and depth == 0:
+                o += [string[start:pos]]
+                start = pos + 1
+            pos += len(token)
+        return o + [string[start:]]
     
     def SplitAtoms(self, string):
-        ignoreLevel = []
-        
-        o = []
-        buf = ''
-        
-        string = string.rstrip()
-        line_len = len(string)
-        for i in range(line_len):
-            c = string[i]
-            pc = ''
-            if i > 0:
-                pc = string[i - 1]
-            
-            if c in self.atomBorders and pc != '\\':
-                end = self.atomBorders[c]
-                if end == c:  # Just toggle.
-                    if len(ignoreLevel) > 0:
-                        if ignoreLevel[-1] == c:
-                            ignoreLevel.pop()
-                        else:
-                            ignoreLevel.append(c)
-                else:
-                    if end == None:
-                        if len(ignoreLevel) > 0:
-                            if ignoreLevel[-1] == c:
-                                ignoreLevel.pop()
-                    else:
-                        ignoreLevel.append(end)
-            if c == ',' and len(ignoreLevel) == 0:
-                o += [buf]
-                buf = ''
-            else:
-                buf += c
-                    
-        if len(ignoreLevel) > 0:
-            self.log.debug(repr(ignoreLevel))
-            sys.exit()
-        return o + [buf]
+        return [chunk for chunk, _, _ in ParseAtoms(string.rstrip())]
     
     def consumeAtom(self, line):
-        if '{' not in line:
-            atom = line.strip()
-            if atom.endswith('/'):
-                self.log.warn('{file}:{line}: Malformed atom: {data} has ending slash.  Stripping slashes from right side.'.format(file=self.filename, line=self.lineNumber, data=atom))
-                atom = atom.rstrip('/')
-            currentAtom = self.map.GetAtom(atom)
-            if currentAtom is not None:
-                return currentAtom
-            else:
-                self.log.error('{file}:{line}: Failed to consumeAtom({data}):  Unable to locate atom.'.format(file=self.filename, line=self.lineNumber, data=line))
-                return None
-        chunks = line.split('{')
-        if len(chunks) < 2:
+        atoms = ParseAtoms(line.strip())
+        if len(atoms) != 1:
             self.log.warn('{file}:{line}: Something went wrong in consumeAtom(). line={data}'.format(file=self.filename, line=self.lineNumber, data=line))
-        atom = chunks[0].strip()
+            if len(atoms) == 0:
+                return None
+        chunk, path, properties = atoms[0]
+        return self.consumeParsedAtom(path, properties, chunk)
+        
+    def consumeParsedAtom(self, atom, properties, chunk=''):
+        '''
+        Build an instance from the output of :func:`ParseAtoms`.
+        
+        :param atom str:
+            Path of the atom.
+        :param properties list:
+            (name, value) tuples, as written in the map.
+        :param chunk str:
+            Source text, for error messages.
+        '''
+        currentAtom = self.consumeAtomPath(atom, chunk)
+        if currentAtom is None:
+            return None
+        if len(properties) == 0:
+            return currentAtom
+        values, mapSupplied = self.consumeProperties(currentAtom, properties, chunk)
+        return self.instanceAtom(currentAtom, values, mapSupplied)
+    
+    def consumeAtomPath(self, atom, chunk=''):
+        '''
+        :return Atom: The object tree's atom for path atom, or None.
+        '''
         if atom.endswith('/'):
             self.log.warn('{file}:{line}: Malformed atom: {data} has ending slash.  Stripping slashes from right side.'.format(file=self.filename, line=self.lineNumber, data=atom))
             atom = atom.rstrip('/')
         currentAtom = self.map.GetAtom(atom)
-        if currentAtom is not None:
-            currentAtom = currentAtom.copy()
-        else:
+        if currentAtom is None:
+            self.log.error('{file}:{line}: Failed to consumeAtom({data}):  Unable to locate atom.'.format(file=self.filename, line=self.lineNumber, data=chunk))
+        return currentAtom
+    
+    def instanceAtom(self, base_atom, values, mapSupplied):
+        atom = base_atom.copy()
+        atom.properties.update(values)
+        atom.mapSpecified = mapSupplied
+        return atom
+    
+    def consumeLazyAtom(self, path, properties, chunk=''):
+        '''
+        Lazy counterpart of :meth:`consumeParsedAtom`, which also registers
+        the instance.
+        
+        Only the object tree is looked up: the atom's hash is worked out from
+        its vars without copying anything, so the map ends up with the same
+        instances and tiles as an eager load.  Atoms whose hash is already
+        registered are built straight away, to be compared with it.
+        
+        :return Atom:
+            The registered :class:`LazyAtom`, the built atom, or None if the
+            path is unknown.
+        '''
+        base_atom = self.consumeAtomPath(path, chunk)
+        if base_atom is None:
             return None
-        if chunks[1].endswith('}'):
-            chunks[1] = chunks[1][:-1]
-        property_chunks = self.SplitProperties(chunks[1])
+        if len(properties) == 0:
+            thash = base_atom.GetHash()
+        else:
+            values, mapSupplied = self.consumeProperties(base_atom, properties, chunk)
+            thash = hash(BaseAtom.MakeHashKey(base_atom.path, values, mapSupplied))
+        if thash in self.map._instance_idmap:
+            if len(properties) > 0:
+                base_atom = self.instanceAtom(base_atom, values, mapSupplied)
+            base_atom.UpdateMap(self.map)
+            return base_atom
+        atom = LazyAtom(base_atom.path, chunk, self.consumeAtom, thash)
+        atom.ID = len(self.map.instances)
+        self.map.instances += [atom]
+        self.map._instance_idmap[thash] = atom.ID
+        return atom
+    
+    def consumeProperties(self, base_atom, properties, chunk=''):
+        '''
+        :param base_atom Atom:
+            The atom of the object tree being instanced.
+        :param properties list:
+            (name, value) tuples, as written in the map.
+        :return (dict, list):
+            Vars set by the map, and the names of those that differ from
+            base_atom, which become the instance's mapSpecified.
+        '''
+        values = {}
         mapSupplied = []
-        for chunk in property_chunks:
-            if chunk.endswith('}'):
-                chunk = chunk[:-1]
-            pparts = chunk.split('=', 1)
-            key = pparts[0].strip()
-            value = pparts[1].strip()
+        for key, value in properties:
             if key == '':
                 self.log.warn('{file}:{line}: Ignoring property with blank name. (given {chunk})'.format(file=self.filename, line=self.lineNumber, chunk=chunk))
                 continue
+            if value is None:
+                self.log.warn('{file}:{line}: Ignoring property {key} with no value. (given {chunk})'.format(file=self.filename, line=self.lineNumber, key=key, chunk=chunk))
+                continue
             data = self.consumeDataValue(value)
-            if key not in currentAtom.mapSpecified:
+            if key not in base_atom.mapSpecified and key not in mapSupplied:
                 mapSupplied += [key]
-            currentAtom.properties[key] = data
+            values[key] = data
         
-        currentAtom.mapSpecified = mapSupplied
-                
-        # Compare to base
-        if True:  # TODO: not (self.readFlags & Map.READ_NO_BASE_COMP):
-            base_atom = self.map.GetAtom(currentAtom.path)
-            assert base_atom != None
-            # for key in base_atom.properties.keys():
-            #    val = base_atom.properties[key]
-            #    if key not in currentAtom.properties:
-            #        currentAtom.properties[key] = val
-            for key in currentAtom.properties.keys():
-                val = currentAtom.properties[key].value
-                if key in base_atom.properties and val == base_atom.properties[key].value:
-                    if key in currentAtom.mapSpecified:
-                        currentAtom.mapSpecified.remove(key)
-                        # print('Removed {0} from atom: Equivalent to base atom!')
-                        
-        return currentAtom
+        # Compare to base.  TODO: not (self.readFlags & Map.READ_NO_BASE_COMP)
+        for key, data in values.items():
+            if key in base_atom.properties and data.value == base_atom.properties[key].value:
+                if key in mapSupplied:
+                    mapSupplied.remove(key)
+        return values, mapSupplied
         
-    def consumeTile(self, line, cache=True):
+    def consumeTile(self, line, cache=True, atoms=None):
         origid = self.consumeTileID(line)
-        return self.consumeTileChunk(line, origID=origid)
+        return self.consumeTileChunk(line, origID=origid, atoms=atoms)
     
-    def consumeTileChunk(self, line, origID=None, cache=True):
+    def consumeTileChunk(self, line, origID=None, cache=True, atoms=None):
         t = self.map.CreateTile()
         tileChunk = line.strip()[line.index('(') + 1:-1]
         if tileChunk == '':
@@ -360,7 +749,7 @@ class DMMFormat(BaseMapFormat):
                 return self.tileTypes[parentID]
         if origID is not None:
             t.origID = origID
-        t.instances = self.consumeTileAtoms(tileChunk)
+        t.instances = self.consumeTileAtoms(tileChunk, atoms)
         t.ID=self.map.UpdateTile(t)
         self.tileChunk2ID[tileChunk]=t.ID
         return t
@@ -389,10 +778,16 @@ class DMMFormat(BaseMapFormat):
     def SerializeTile(self, tile):
         # "aat" = (/obj/structure/grille,/obj/structure/window/reinforced{dir = 8},/obj/structure/window/reinforced{dir = 1},/obj/structure/window/reinforced,/obj/structure/cable{d1 = 2; d2 = 4; icon_state = "2-4"; tag = ""},/turf/simulated/floor/plating,/area/security/prison)
         atoms = []
-        for i in range(len(tile.instances)):
-            atom = self.map.GetInstance(tile.instances[i])
-            if atom and atom.path != '':
-                atoms += [self.SerializeAtom(atom)]
+        for iid in tile.instances:
+            if self.atomText is not None and iid in self.atomText:
+                text = self.atomText[iid]
+            else:
+                atom = self.map.GetInstance(iid)
+                text = self.SerializeAtom(atom) if atom and atom.path != '' else None
+                if self.atomText is not None:
+                    self.atomText[iid] = text
+            if text is not None:
+                atoms += [text]
 
         return '({atoms})'.format(atoms=','.join(atoms))
     
@@ -402,7 +797,7 @@ class DMMFormat(BaseMapFormat):
             i = _id % IET_SIZE
             o = ID_ENCODING_TABLE[i] + o
             _id -= i
-            _id /= IET_SIZE
+            _id //= IET_SIZE
         o = ID_ENCODING_TABLE[_id] + o
         if pad > len(o):
             o = o.rjust(pad, ID_ENCODING_TABLE[0])
@@ -424,6 +819,34 @@ class DMMFormat(BaseMapFormat):
         tile.ID = self.tileTypes.index(tile)
         return self.ID2String(tile)
     
+    def AssignOriginalKeys(self, tileIDs):
+        '''
+        Give each tile the key it was loaded with, unless another tile took it
+        first, and the lowest free key otherwise.  Keys are padded if they
+        have to get longer to fit every tile.
+        
+        :param tileIDs list: Tiles to write, in order.
+        :return dict: Tile ID -> key.
+        '''
+        origIDs = [self.map.tiles[tileID].origID for tileID in tileIDs]
+        idlen = max([len(self.ID2String(max(len(tileIDs) - 1, 0)))] + [len(origID) for origID in origIDs if origID])
+        keys = {}
+        taken = set()
+        for tileID, origID in zip(tileIDs, origIDs):
+            if origID:
+                key = origID.rjust(idlen, ID_ENCODING_TABLE[0])
+                if key not in taken:
+                    keys[tileID] = key
+                    taken.add(key)
+        n = 0
+        for tileID in tileIDs:
+            if tileID not in keys:
+                while self.ID2String(n, idlen) in taken:
+                    n += 1
+                keys[tileID] = self.ID2String(n, idlen)
+                taken.add(keys[tileID])
+        return keys
+    
     def GetTID(self, tile):
         #print('GetTID: origID: {}'.format(repr(tile.origID)))
         if self.serialize_cleanly and tile.origID != '':
@@ -431,77 +854,67 @@ class DMMFormat(BaseMapFormat):
         else:
             return tile.ID
     
+    def GetUsedTileIDs(self):
+        '''
+        Tile IDs placed on the map, in the order a scan of z, then y, then x
+        first meets them.
+        
+        :return numpy.ndarray:
+        '''
+        if len(self.map.zLevels) == 0:
+            return numpy.empty(0, int)
+        cells = numpy.concatenate([zLevel.tiles.T.ravel() for zLevel in self.map.zLevels])
+        tileIDs, first = numpy.unique(cells, return_index=True)
+        return tileIDs[numpy.argsort(first)]
+    
     def Save(self, filename, **kwargs):
         self.filename = filename
         
         self.tileTypes = []
-        examined = []
-        hashMap = {}
         self.typeMap = {}
         self.type2TID = {}
         self.instances = []
         
         self.serialize_cleanly = kwargs.get('clean', True)
+        preserve_keys = kwargs.get('preserve_keys', self.map.preserve_keys)
         self.dump_inherited = kwargs.get('inherited', False)
+        # Instances are shared between tiles, so only serialize each once.
+        self.atomText = {}
         
         # Preprocess and assign IDs.
         start = perf_counter()
-        idlen = 0
-        it = self.map.Locations()
-        lz = -1
-        last_str = None
-        start = perf_counter()
-        maxid = 0
-        for tile in it:
-            # print(str(tile))
-            if lz != it.z:
-                if start:
-                    self.log.info('  -> Took {}'.format(getElapsed(start)))
-                self.log.info(' * Consolidating level {}...'.format(it.z + 1))
-                start = perf_counter()
-                lz = it.z
-            strt = tile.GetHash()  # str(tile)
-            dbg = False
-            # if strt == 'e18826df83665059358c177f43f6ac72':
-            #    dbg=True
-            if last_str == strt:
-                # if dbg: print('Continuing: Same as last examined.') 
-                continue
-            if strt in examined:
-                # if dbg: print('Continuing: Hash already examined.')
-                last_str = strt
-                continue
-            # tile.ID = len(examined)
-            examined += [strt]
-            tid = self.GetTID(tile)
-            if tile.origID=='aaa':
-                self.log.info('{} -> {}'.format(tile.origID,tid))
-            if tid in self.typeMap:
-                if hashMap.get(strt, None) == tid:
-                    if dbg: self.log.debug('Continuing: TID {} in typeMap, hashes match.'.format(tid))
-                    continue
-                tile.origID = ''
-                tid = len(self.typeMap)
-                while tid in self.typeMap:
-                    tid += 1
-
-                self.log.info('{} assigned to new TID {}'.format(strt,tid))
-            maxid = max(maxid, tid)
-            self.typeMap[tid] = (strt, self.SerializeTile(tile))
-            last_str = strt
-            hashMap[strt] = tid
+        self.log.info(' * Consolidating {} levels...'.format(len(self.map.zLevels)))
+        tileIDs = self.GetUsedTileIDs()
+        # Tiles that serialize identically share the key of the first one found.
+        hashMap = {}
+        id2tid = {}
+        for tileID in tileIDs.tolist():
+            tile = self.map.GetTileByID(tileID)
+            serdata = self.SerializeTile(tile)
+            if serdata not in hashMap:
+                hashMap[serdata] = tileID
+                self.typeMap[tileID] = (tile.GetHash(), serdata)
+            id2tid[tileID] = hashMap[serdata]
+        self.atomText = None
         
         self.log.info(' * Preprocessing completed in {}'.format(getElapsed(start)))
-        idlen = len(self.ID2String(maxid))
+        if preserve_keys:
+            keys = self.AssignOriginalKeys(list(self.typeMap.keys()))
+        else:
+            idlen = len(self.ID2String(max(self.typeMap.keys()) if len(self.typeMap) > 0 else 0))
+            keys = dict((tid, self.ID2String(tid, idlen)) for tid in self.typeMap)
+        idlen = len(next(iter(keys.values()))) if len(keys) > 0 else 1
+        # Row i holds the ASCII key written for tile ID i.
+        keyTable = numpy.zeros((int(tileIDs.max()) + 1 if len(tileIDs) > 0 else 0, idlen), numpy.uint8)
+        for tileID, tid in id2tid.items():
+            keyTable[tileID] = numpy.frombuffer(keys[tid].encode('ascii'), numpy.uint8)
         tmpfile = filename + '.tmp'
         self.log.info('Opening {} for write...'.format(tmpfile))
         start = perf_counter()
         with open(tmpfile, 'w') as f:
-            for tid in sorted(self.typeMap.keys()):
-                stid = self.ID2String(tid, idlen)
+            for tid in sorted(self.typeMap.keys(), key=lambda tid: [ID_ENCODING_TABLE.index(c) for c in keys[tid]]):
+                stid = keys[tid]
                 strt, serdata = self.typeMap[tid]
-                if serdata == '(/turf/space,/area)':
-                    self.log.debug('{} -> {}'.format(tid,stid))
                 f.write('"{}" = {}\n'.format(stid, serdata))
                 self.type2TID[strt] = stid
             self.log.info(' Wrote types in {}...'.format(getElapsed(start)))
@@ -510,16 +923,13 @@ class DMMFormat(BaseMapFormat):
                 self.log.debug(' Writing z={}...'.format(z))
                 f.write('\n(1,1,{0}) = {{"\n'.format(z + 1))
                 zlevel = self.map.zLevels[z]
-                for y in range(zlevel.height):
-                    for x in range(zlevel.width):
-                        tile = self.map.GetTileAt(x, y, z)
-                        thash = tile.GetHash()
-                        f.write(self.type2TID[thash])
-                    f.write("\n")
+                rows = numpy.empty((zlevel.height, zlevel.width * idlen + 1), numpy.uint8)
+                rows[:, :-1] = keyTable[zlevel.tiles.T].reshape(zlevel.height, -1)
+                rows[:, -1] = ord('\n')
+                f.write(rows.tobytes().decode('ascii'))
                 f.write('"}\n')
             self.log.info(' Wrote tiles in {}...'.format(getElapsed(lap)))
         if os.path.isfile(filename):
             os.remove(filename)
         os.rename(tmpfile, filename)
         self.log.info('-> {} in {}'.format(filename, getElapsed(start)))
-        
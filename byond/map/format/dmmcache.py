@@ -0,0 +1,128 @@
+'''
+Binary sidecar cache for parsed DMM files.
+
+Layout of ``<map>.dmm.cache``::
+
+    MAGIC (8 bytes) | header length (uint32, LE) | header (JSON) | padding | z-level grids
+
+The header records the cache format, the library version and the MD5 of the
+map it was built from, plus the tile and instance registries.  Grids follow
+as raw row-major arrays, each starting on a 64-byte boundary.
+'''
+import os, json, struct, logging, numpy
+import byond
+from byond.utils import md5sum
+
+_log = logging.getLogger('byond.mapformat.dmmcache')
+
+class DMMCache(object):
+    #: File signature.  The last byte is the layout version.
+    MAGIC = b'BTDMMC\x00\x01'
+    
+    #: Bump when the header contents change meaning.
+    FORMAT = 2
+    
+    ALIGNMENT = 64
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.cachefile = filename + '.cache'
+        self._hash = None
+        
+    def GetMapHash(self):
+        if self._hash is None:
+            self._hash = md5sum(self.filename)
+        return self._hash
+        
+    def Read(self, mmap=False):
+        '''
+        Read the cache, if it is still valid for the map.
+        
+        A cache is thrown away if it is missing, truncated, written by another
+        cache format or library version, or built from different map contents.
+        
+        :param mmap bool:
+            Map the grids from the cache file copy-on-write instead of reading
+            them.  Pages are shared with other processes mapping the same
+            cache until they are written to.
+        :return (header, grids):
+            Or None if the cache can't be used.  grids is a list of numpy arrays
+            of tile IDs, indexed [y, x].
+        '''
+        if not os.path.isfile(self.cachefile):
+            return None
+        try:
+            with open(self.cachefile, 'rb') as f:
+                if f.read(len(self.MAGIC)) != self.MAGIC:
+                    _log.info('{}: Unknown cache layout, ignoring.'.format(self.cachefile))
+                    return None
+                headerlen, = struct.unpack('<I', f.read(4))
+                header = json.loads(f.read(headerlen).decode('utf-8'))
+                if header.get('format') != self.FORMAT or header.get('version') != byond.__version__:
+                    _log.info('{}: Written by another version, ignoring.'.format(self.cachefile))
+                    return None
+                if header.get('hash') != self.GetMapHash():
+                    _log.info('{}: Map has changed since the cache was written, ignoring.'.format(self.cachefile))
+                    return None
+                dataStart = self._align(len(self.MAGIC) + 4 + headerlen)
+                grids = []
+                for width, height, dtype, offset in header['zlevels']:
+                    if mmap:
+                        if width * height == 0:
+                            grids.append(numpy.empty((height, width), numpy.dtype(dtype)))
+                        else:
+                            grids.append(numpy.memmap(self.cachefile, numpy.dtype(dtype), 'c', dataStart + offset, (height, width)))
+                        continue
+                    f.seek(dataStart + offset)
+                    grid = numpy.fromfile(f, numpy.dtype(dtype), width * height)
+                    if len(grid) != width * height:
+                        raise ValueError('Truncated grid')
+                    grids.append(grid.reshape(height, width))
+                return header, grids
+        except (IOError, OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            _log.warning('{}: Unreadable cache, ignoring. ({})'.format(self.cachefile, e))
+            return None
+        
+    def Write(self, header, grids):
+        '''
+        Write the cache atomically.
+        
+        :param header dict:
+            Registries, as built by :class:`byond.map.format.dmm.DMMFormat`.
+        :param grids list:
+            numpy arrays of tile IDs, indexed [y, x].
+        '''
+        header = dict(header)
+        header['format'] = self.FORMAT
+        header['version'] = byond.__version__
+        header['hash'] = self.GetMapHash()
+        header['zlevels'] = []
+        offset = 0
+        for grid in grids:
+            height, width = grid.shape
+            header['zlevels'].append([width, height, grid.dtype.str, offset])
+            offset = self._align(offset + grid.nbytes)
+        encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        dataStart = self._align(len(self.MAGIC) + 4 + len(encoded))
+        
+        tmpfile = self.cachefile + '.tmp'
+        try:
+            with open(tmpfile, 'wb') as f:
+                f.write(self.MAGIC)
+                f.write(struct.pack('<I', len(encoded)))
+                f.write(encoded)
+                for grid, (_, _, _, offset) in zip(grids, header['zlevels']):
+                    f.seek(dataStart + offset)
+                    f.write(numpy.ascontiguousarray(grid).tobytes())
+            os.replace(tmpfile, self.cachefile)
+        except (IOError, OSError) as e:
+            _log.warning('{}: Unable to write cache. ({})'.format(self.cachefile, e))
+            return False
+        return True
+        
+    def Remove(self):
+        if os.path.isfile(self.cachefile):
+            os.remove(self.cachefile)
+    
+    def _align(self, pos):
+        return (pos + self.ALIGNMENT - 1) // self.ALIGNMENT * self.ALIGNMENT
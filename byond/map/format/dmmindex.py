@@ -0,0 +1,183 @@
+'''
+Byte-offset index for DMM files.
+
+``<map>.dmm.idx`` is a JSON file recording where the tile definition section,
+each tile definition and each ``(1,1,z) = {"..."}`` block start in the map, so
+a reader can seek straight to them instead of reading everything before.
+
+An index is tied to the map's size, mtime and MD5.  The hash is only checked
+when the mtime has changed, so an untouched map is validated with a stat call.
+'''
+import os, re, json, logging
+import byond
+from byond.utils import md5sum
+
+_log = logging.getLogger('byond.mapformat.dmmindex')
+
+# Byte-level twin of dmm.REGEX_ZLEVEL.
+REGEX_BLOCK = re.compile(br'^\((?P<x>\d+),(?P<y>\d+),(?P<z>\d+)\)\s*=\s*\{".*?"\}', re.MULTILINE | re.DOTALL)
+
+class DMMIndex(object):
+    #: Bump when the index contents change meaning.
+    FORMAT = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.indexfile = filename + '.idx'
+
+        #: (start, end) byte offsets of the tile definitions.
+        self.definitions = (0, 0)
+
+        #: Tile key -> (offset, length, line number) of its definition.
+        self.keys = {}
+
+        #: (x, y, z, offset, length, line number) of each block, in file order.
+        self.zlevels = []
+
+        #: Longest tile key.
+        self.idlen = 0
+
+        self.size = None
+        self.mtime = None
+        self.hash = None
+
+    def Get(self):
+        '''
+        Read the index, or rebuild and write it if it's missing or stale.
+
+        :return DMMIndex: self
+        '''
+        if not self.Read():
+            self.Build()
+            self.Write()
+        return self
+
+    def Build(self):
+        '''
+        Scan the map for offsets.
+        '''
+        stat = os.stat(self.filename)
+        self.keys = {}
+        self.zlevels = []
+        self.idlen = 0
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+
+        # Definitions run up to the first line that doesn't open with a quote.
+        # {"text"} blocks may span several lines.
+        pos = 0
+        lineNumber = 1
+        while data.startswith(b'"', pos):
+            start = pos
+            startLine = lineNumber
+            while True:
+                end = data.find(b'\n', pos)
+                end = len(data) if end == -1 else end + 1
+                lineNumber += 1
+                pos = end
+                line = data[start:pos]
+                if pos >= len(data) or (line.rstrip().endswith(b')') and line.count(b'{"') <= line.count(b'"}')):
+                    break
+            key = line[1:line.index(b'"', 1)].decode('utf-8')
+            self.keys[key] = (start, pos - start, startLine)
+            self.idlen = max(self.idlen, len(key))
+        self.definitions = (0, pos)
+
+        for m in REGEX_BLOCK.finditer(data, pos):
+            blockLine = lineNumber + data.count(b'\n', pos, m.start())
+            self.zlevels.append((int(m.group('x')), int(m.group('y')), int(m.group('z')), m.start(), m.end() - m.start(), blockLine))
+
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.hash = md5sum(self.filename)
+
+    def Read(self):
+        '''
+        Read the index, if it is still valid for the map.
+
+        :return bool: False if the index is missing, unreadable or stale.
+        '''
+        if not os.path.isfile(self.indexfile):
+            return False
+        try:
+            with open(self.indexfile, 'r') as f:
+                data = json.load(f)
+            if data.get('format') != self.FORMAT or data.get('version') != byond.__version__:
+                _log.info('{}: Written by another version, ignoring.'.format(self.indexfile))
+                return False
+            stat = os.stat(self.filename)
+            if data['size'] != stat.st_size:
+                _log.info('{}: Map has changed size since the index was written, ignoring.'.format(self.indexfile))
+                return False
+            touched = data['mtime'] != stat.st_mtime
+            if touched:
+                if data['hash'] != md5sum(self.filename):
+                    _log.info('{}: Map has changed since the index was written, ignoring.'.format(self.indexfile))
+                    return False
+            self.size = data['size']
+            self.mtime = stat.st_mtime
+            self.hash = data['hash']
+            self.definitions = tuple(data['definitions'])
+            self.keys = dict((key, tuple(entry)) for key, entry in data['keys'].items())
+            self.zlevels = [tuple(entry) for entry in data['zlevels']]
+            self.idlen = data['idlen']
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            _log.warning('{}: Unreadable index, ignoring. ({})'.format(self.indexfile, e))
+            return False
+        if touched:
+            # Same contents, so later loads can go back to a stat call.
+            self.Write()
+        return True
+
+    def Write(self):
+        '''
+        Write the index atomically.
+        '''
+        data = {
+            'format': self.FORMAT,
+            'version': byond.__version__,
+            'size': self.size,
+            'mtime': self.mtime,
+            'hash': self.hash,
+            'definitions': self.definitions,
+            'keys': self.keys,
+            'zlevels': self.zlevels,
+            'idlen': self.idlen,
+        }
+        tmpfile = self.indexfile + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmpfile, self.indexfile)
+        except (IOError, OSError) as e:
+            _log.warning('{}: Unable to write index. ({})'.format(self.indexfile, e))
+            return False
+        return True
+
+    def Remove(self):
+        if os.path.isfile(self.indexfile):
+            os.remove(self.indexfile)
+
+    def ReadDefinition(self, f, key):
+        '''
+        :param f file:
+            The map, opened in binary mode.
+        :return (str, int):
+            The tile definition of key and the line it starts on.
+        '''
+        offset, length, lineNumber = self.keys[key]
+        f.seek(offset)
+        return f.read(length).decode('utf-8').replace('\r\n', '\n'), lineNumber
+
+    def ReadBlock(self, f, z):
+        '''
+        :param f file:
+            The map, opened in binary mode.
+        :param z int:
+            Index of the block in the file (0-based).
+        :return (str, int):
+            The whole (1,1,z) = {"..."} block and the line it starts on.
+        '''
+        _, _, _, offset, length, lineNumber = self.zlevels[z]
+        f.seek(offset)
+        return f.read(length).decode('utf-8'), lineNumber
@@ -0,0 +1,255 @@
+'''
+Three-way merges of maps.
+
+Cells are compared through a shared :class:`byond.map.diff.KeySpace`, as in
+:mod:`byond.map.diff`.  Wherever both sides agree, or only one side changed a
+cell, the merge is settled with numpy over whole z-levels.  Cells that both
+sides changed differently are merged atom by atom, once per distinct
+(base, ours, theirs) triple of tiles.
+'''
+import collections, numpy
+from byond.map import Map
+from byond.map.diff import KeySpace
+from byond.map.format.base import GetGridDType
+
+def MergeAtoms(base, ours, theirs):
+    '''
+    Three-way merge of the atoms of a tile.  Each distinct atom is merged on
+    its count: a side that kept base's count yields to the other one.  The
+    result may hold at most one turf and one area.
+
+    :param base list: Serialized atoms, in order.
+    :param ours list:
+    :param theirs list:
+    :return list: Merged atoms, or None if they conflict.
+    '''
+    b = collections.Counter(base)
+    o = collections.Counter(ours)
+    t = collections.Counter(theirs)
+    # Both sides adding different versions of a path is most likely the same
+    # atom edited two ways.
+    oursAdded = _byPath(o - b)
+    theirsAdded = _byPath(t - b)
+    for path in set(oursAdded) & set(theirsAdded):
+        if oursAdded[path] != theirsAdded[path]:
+            return None
+
+    merged = collections.Counter()
+    for key in set(b) | set(o) | set(t):
+        if o[key] == t[key] or t[key] == b[key]:
+            merged[key] = o[key]
+        elif o[key] == b[key]:
+            merged[key] = t[key]
+        else:
+            return None
+
+    # Our order, then whatever they added; turfs and areas go last.
+    atoms = []
+    for key in list(o) + [key for key in t if key not in o]:
+        atoms += [key] * merged[key]
+    layers = [_layer(atom) for atom in atoms]
+    if layers.count(1) > 1 or layers.count(2) > 1:
+        return None
+    return [atom for _, atom in sorted(zip(layers, atoms), key=lambda pair: pair[0])]
+
+def _byPath(atoms):
+    paths = {}
+    for atom in atoms:
+        paths.setdefault(atom.split('{', 1)[0], set()).add(atom)
+    return paths
+
+def _layer(atom):
+    if atom.startswith('/turf'):
+        return 1
+    if atom.startswith('/area'):
+        return 2
+    return 0
+
+class MapMerge(object):
+    '''
+    Three-way merge of :class:`byond.map.Map`\\ s.  Unresolved cells keep our
+    tile, or theirs on a z-level we removed, and are flagged in
+    :attr:`conflicts`.
+    '''
+    def __init__(self, base, ours, theirs):
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+
+        self.space = KeySpace()
+        self.baseKeys = self.space.Add(base)
+        self.oursKeys = self.space.Add(ours)
+        self.theirsKeys = self.space.Add(theirs)
+
+        # : Merged map, once :meth:`Merge` has run.
+        self.result = None
+
+        # : [x, y] mask of the cells left unresolved, per z-level of result.
+        self.conflicts = []
+
+        # : Number of cells merged atom by atom.
+        self.atomMerges = 0
+
+        # : (base, ours, theirs) shared IDs -> merged shared ID, or -1.
+        self.merges = {}
+
+        # : Shared ID -> serialized atoms, for tiles only made by the merge.
+        self.mergedTiles = {}
+
+    def Merge(self):
+        '''
+        :return Map: The merged map.
+        '''
+        grids = []
+        self.conflicts = []
+        for z in range(max(len(self.ours.zLevels), len(self.theirs.zLevels))):
+            merged, conflicts = self._mergeLevel(z)
+            if merged is None:
+                # Removed.
+                continue
+            grids.append(merged)
+            self.conflicts.append(conflicts)
+
+        self.result = self._build(grids)
+        return self.result
+
+    def GetConflicts(self):
+        '''
+        :return numpy.ndarray: One (x, y, z) row per unresolved cell.
+        '''
+        found = [numpy.empty((0, 3), int)]
+        for z, conflicts in enumerate(self.conflicts):
+            ys, xs = numpy.nonzero(conflicts.T)
+            found.append(numpy.column_stack((xs, ys, numpy.full(len(xs), z))))
+        return numpy.concatenate(found)
+
+    def _shape(self, _map, z):
+        if z >= len(_map.zLevels):
+            return None
+        return _map.zLevels[z].tiles.shape
+
+    def _unchanged(self, keys, z):
+        '''
+        :return bool: Whether a side's z-level is the same as base's.
+        '''
+        if self._shape(self.base, z) != self._shape(keys.map, z):
+            return False
+        return bool((self.baseKeys.Project(z) == keys.Project(z)).all())
+
+    def _mergeLevel(self, z):
+        '''
+        :return tuple:
+            (grid, conflicts) of the merged z-level, or (None, None) if it was
+            removed.
+        '''
+        if self._shape(self.ours, z) is None or self._shape(self.theirs, z) is None:
+            return self._mergeRemoval(z)
+        o = self.oursKeys.Project(z)
+        shape = o.shape
+        theirShape = self._shape(self.theirs, z)
+        baseShape = self._shape(self.base, z)
+        if theirShape != shape:
+            # A side resized the level, which is only fine if the other side
+            # left it alone.
+            if self._unchanged(self.oursKeys, z):
+                t = self.theirsKeys.Project(z)
+                return t, numpy.zeros(t.shape, bool)
+            if self._unchanged(self.theirsKeys, z):
+                return o, numpy.zeros(shape, bool)
+            return o, numpy.ones(shape, bool)
+
+        t = self.theirsKeys.Project(z)
+        if baseShape == shape:
+            b = self.baseKeys.Project(z)
+        else:
+            # Nothing to compare against; only agreement merges.
+            b = numpy.full(shape, -1, int)
+        merged = numpy.where(o == t, o, numpy.where(o == b, t, numpy.where(t == b, o, -1)))
+
+        both = merged == -1
+        conflicts = numpy.zeros(shape, bool)
+        if both.any():
+            triples, inverse = numpy.unique(numpy.column_stack((b[both], o[both], t[both])), axis=0, return_inverse=True)
+            results = numpy.array([self._mergeTiles(*triple) for triple in triples.tolist()], int)
+            resolved = results[inverse.ravel()]
+            conflicts[both] = resolved == -1
+            merged[both] = numpy.where(resolved == -1, o[both], resolved)
+            self.atomMerges += int((resolved != -1).sum())
+        return merged, conflicts
+
+    def _mergeRemoval(self, z):
+        '''
+        Merge a z-level only one side has.  If base didn't have it either, it
+        was added and is kept.  Otherwise the other side removed it, which
+        wins if the level was left alone and conflicts if it was edited.
+        '''
+        if z < len(self.ours.zLevels):
+            kept = self.oursKeys
+        elif z < len(self.theirs.zLevels):
+            kept = self.theirsKeys
+        else:
+            return None, None
+        grid = kept.Project(z)
+        if self._shape(self.base, z) is None:
+            return grid, numpy.zeros(grid.shape, bool)
+        if self._unchanged(kept, z):
+            return None, None
+        return grid, numpy.ones(grid.shape, bool)
+
+    def _mergeTiles(self, b, o, t):
+        key = (b, o, t)
+        if key not in self.merges:
+            atoms = MergeAtoms(self._atoms(b), self._atoms(o), self._atoms(t)) if b >= 0 else None
+            if atoms is None:
+                self.merges[key] = -1
+            else:
+                text = '({})'.format(','.join(atoms))
+                if text not in self.space.keys:
+                    self.space.keys[text] = len(self.space.sources)
+                    self.space.sources.append((None, None))
+                    self.mergedTiles[self.space.keys[text]] = atoms
+                self.merges[key] = self.space.keys[text]
+        return self.merges[key]
+
+    def _atoms(self, sharedID):
+        keys, tileID = self.space.sources[sharedID]
+        if keys is None:
+            return self.mergedTiles[sharedID]
+        return keys.GetAtomKeys(tileID)
+
+    def _build(self, grids):
+        result = Map(self.ours.tree)
+        result.ResetTilestore()
+
+        lut = numpy.full(len(self.space.sources), -1, int)
+        def getTileID(sharedID):
+            if lut[sharedID] < 0:
+                keys, tileID = self.space.sources[sharedID]
+                if keys is not None:
+                    lut[sharedID] = result.ImportTile(keys.map.tiles[tileID])
+                else:
+                    tile = result.CreateTile()
+                    for text in self.mergedTiles[sharedID]:
+                        tile.AppendAtom(self._copyAtom(text), hash=False)
+                    lut[sharedID] = result.UpdateTile(tile)
+            return lut[sharedID]
+
+        if self.ours.basetile is not None and 0 <= self.ours.basetile.ID < len(self.oursKeys.lut):
+            result.basetile = result.GetTileByID(getTileID(self.oursKeys.lut[self.ours.basetile.ID]), copy=True)
+        for grid in grids:
+            for sharedID in numpy.unique(grid).tolist():
+                getTileID(sharedID)
+        dtype = GetGridDType(len(result.tiles))
+        for grid in grids:
+            zLevel = result.CreateZLevel(0, 0)
+            zLevel.SetGrid(lut[grid].astype(dtype))
+        return result
+
+    def _copyAtom(self, text):
+        for keys in (self.oursKeys, self.theirsKeys, self.baseKeys):
+            atomID = keys.GetAtomID(text)
+            if atomID is not None:
+                atom = keys.map.GetInstance(atomID, copy=True)
+                # IDs from the other map mean nothing here.
+                atom.ID = None
+                return atom
@@ -0,0 +1,231 @@
+'''
+Applying map patches (``.dmmpatch``, as written by ``dmm.py diff``).
+
+A patch is a list of blocks::
+
+    <x,y,z>
+     @CHECK before-hash after-hash (serialized tile after the change)
+     -ALL
+     - /obj/removed
+     +2 /obj/added{dir = 4}
+
+Edits are worked out on serialized atoms.  Each distinct resulting tile is
+registered once, and the grids are written in one go per z-level.
+'''
+import re, logging, collections
+import numpy
+from byond.basetypes import Atom, PropertyFlags
+from byond.map.format.dmm import DMMFormat
+
+REG_INSTRUCTION = re.compile(r'^(?P<change>[\+\-])(?P<amount>[0-9\*]+)?\s+(?P<atom>/.*)')
+
+class PatchBlock(object):
+    '''
+    Changes to one cell.
+    '''
+    __slots__ = ('coords', 'check', 'ops', 'line')
+
+    def __init__(self, coords, line):
+        self.coords = coords
+        # : (before hash, after hash, serialized tile), or None.
+        self.check = None
+        # : (change, amount, serialized atom, line), where change is '+', '-'
+        #   or '-ALL' and amount is None for "all of them".
+        self.ops = []
+        self.line = line
+
+class MapPatch(object):
+    '''
+    A parsed ``.dmmpatch``.
+    '''
+    def __init__(self, filename=None):
+        self.log = logging.getLogger(__name__ + '.MapPatch')
+        self.filename = filename
+        self.blocks = []
+
+        # : z -> [atoms added, atoms removed], from the last Apply().
+        self.stats = {}
+        # : Cells already in their patched state.
+        self.skipped = []
+        # : Cells that changed since the patch was made, and were patched anyway.
+        self.changed = []
+
+        if filename is not None:
+            with open(filename) as f:
+                self.Parse(f)
+
+    def Parse(self, lines):
+        '''
+        :param lines iterable: Lines of the patch.
+        '''
+        block = None
+        for ln, line in enumerate(lines, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if line.startswith('<') and line.endswith('>'):
+                block = PatchBlock(tuple(int(coord) for coord in line.strip('<>').split(',')), ln)
+                self.blocks.append(block)
+                continue
+            if block is None:
+                raise ValueError('{}:{}: Instruction outside of a <x,y,z> block: {}'.format(self.filename, ln, line))
+            if line.startswith('@CHECK'):
+                _, before, after, serdata = line.split(' ', 3)
+                block.check = (before, after, serdata)
+            elif line == '-ALL':
+                block.ops.append(('-ALL', None, None, ln))
+            elif line.startswith('+') or line.startswith('-'):
+                m = REG_INSTRUCTION.match(line)
+                if m is None:
+                    raise ValueError('{}:{}: MALFORMED INSTRUCTION: {}'.format(self.filename, ln, line))
+                amount = m.group('amount')
+                amount = None if amount == '*' else int(amount or 1)
+                block.ops.append((m.group('change'), amount, m.group('atom'), ln))
+
+    def Apply(self, _map, clobber=False):
+        '''
+        Patch a map.
+
+        :param clobber bool:
+            Replace each cell with the tile in its @CHECK line (plus a
+            /obj/effect/byondtools/changed marker), whatever is there now.
+        '''
+        applier = _PatchApplier(self, _map)
+        self.stats = {}
+        self.skipped = []
+        self.changed = []
+        for block in self.blocks:
+            x, y, z = block.coords
+            if not 0 <= z < len(_map.zLevels):
+                continue
+            zLevel = _map.zLevels[z]
+            if not (0 <= x < zLevel.width and 0 <= y < zLevel.height):
+                self.log.warning('{}:{}: <{},{},{}> is outside of the map.  Skipping.'.format(self.filename, block.line, x, y, z))
+                continue
+            if block.coords in applier.pending:
+                # Touched twice; settle the first edit before reading the cell.
+                applier.Flush()
+            tileID = int(zLevel.tiles[x, y])
+            if block.check is not None:
+                before, after, serdata = block.check
+                if clobber:
+                    applier.pending[block.coords] = tuple(applier.GetCheckAtoms(serdata) + [applier.Marker(block.line)])
+                    continue
+                current = applier.GetContentHash(tileID)
+                if current == after:
+                    self.skipped.append(block.coords)
+                    continue
+                if current != before:
+                    self.log.warning('<{},{},{}> has changed.  Operations on this tile may not be accurate!'.format(x, y, z))
+                    self.changed.append(block.coords)
+            atoms = list(applier.GetAtomKeys(tileID))
+            stats = self.stats.setdefault(z, [0, 0])
+            for change, amount, atom, ln in block.ops:
+                if change == '-ALL':
+                    atoms = []
+                    continue
+                atom = applier.Normalize(atom)
+                if change == '+':
+                    atoms += [atom] * amount
+                    stats[0] += amount
+                else:
+                    while atom in atoms and (amount is None or amount > 0):
+                        atoms.remove(atom)
+                        stats[1] += 1
+                        if amount is not None:
+                            amount -= 1
+            if block.check is not None:
+                # Ops don't carry order; take it from @CHECK when they agree.
+                expected = applier.GetCheckAtoms(block.check[2])
+                if collections.Counter(expected) == collections.Counter(atoms):
+                    atoms = expected
+            applier.pending[block.coords] = tuple(atoms)
+        applier.Flush()
+
+class _PatchApplier(object):
+    def __init__(self, patch, _map):
+        self.patch = patch
+        self.map = _map
+        self.format = DMMFormat(_map)
+        self.format.atomText = {}
+        self.format.filename = patch.filename
+
+        # : (x, y, z) -> serialized atoms it should end up with.
+        self.pending = {}
+
+        self.tileAtoms = {}
+        self.contentHashes = {}
+        self.normalized = {}
+        self.checkAtoms = {}
+        # : Serialized atom -> instance ID.
+        self.atomIDs = {}
+
+    def GetAtomKeys(self, tileID):
+        if tileID not in self.tileAtoms:
+            atoms = []
+            for atomID in self.map.tiles[tileID].instances:
+                if atomID not in self.format.atomText:
+                    atom = self.map.GetInstance(atomID)
+                    self.format.atomText[atomID] = self.format.SerializeAtom(atom) if atom is not None and atom.path != '' else None
+                text = self.format.atomText[atomID]
+                if text is not None:
+                    atoms.append(text)
+                    self.atomIDs.setdefault(text, atomID)
+            self.tileAtoms[tileID] = atoms
+        return self.tileAtoms[tileID]
+
+    def GetContentHash(self, tileID):
+        if tileID not in self.contentHashes:
+            self.contentHashes[tileID] = self.map.GetTileByID(tileID).GetContentHash()
+        return self.contentHashes[tileID]
+
+    def Normalize(self, text):
+        '''
+        Rewrite an atom the way SerializeAtom() would, so spacing in the patch
+        doesn't matter.
+        '''
+        if text not in self.normalized:
+            atom = self.format.consumeAtom(text)
+            self.normalized[text] = text if atom is None else self.format.SerializeAtom(atom)
+        return self.normalized[text]
+
+    def GetCheckAtoms(self, serdata):
+        '''
+        :return list: Normalized atoms of a serialized tile from @CHECK.
+        '''
+        if serdata not in self.checkAtoms:
+            self.checkAtoms[serdata] = [self.Normalize(atom) for atom in self.format.SplitAtoms(serdata.strip()[1:-1])]
+        return list(self.checkAtoms[serdata])
+
+    def Marker(self, ln):
+        atom = Atom('/obj/effect/byondtools/changed')
+        atom.setProperty('tag', '{}:{}'.format(self.patch.filename, ln), flags=PropertyFlags.MAP_SPECIFIED)
+        atom.UpdateMap(self.map)
+        text = self.format.SerializeAtom(atom)
+        self.atomIDs.setdefault(text, atom.ID)
+        return text
+
+    def GetAtomID(self, text):
+        if text not in self.atomIDs:
+            atomIDs = self.format.consumeTileAtoms(text)
+            if len(atomIDs) != 1:
+                self.patch.log.warning('{}: Unable to parse instance {}'.format(self.patch.filename, text))
+            self.atomIDs[text] = atomIDs[0] if len(atomIDs) > 0 else None
+        return self.atomIDs[text]
+
+    def Flush(self):
+        '''
+        Register each distinct pending tile once and write the grids.
+        '''
+        tileIDs = {}
+        cells = {}
+        for (x, y, z), atoms in self.pending.items():
+            if atoms not in tileIDs:
+                tile = self.map.CreateTile()
+                tile.instances = [atomID for atomID in map(self.GetAtomID, atoms) if atomID is not None]
+                tileIDs[atoms] = self.map.UpdateTile(tile)
+            cells.setdefault(z, []).append((x, y, tileIDs[atoms]))
+        for z, changes in cells.items():
+            xs, ys, ids = numpy.array(changes, int).T
+            self.map.zLevels[z].SetTiles(xs, ys, ids)
+        self.pending = {}
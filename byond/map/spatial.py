@@ -0,0 +1,214 @@
+'''
+Where things are on a map.
+
+:class:`SpatialIndex` maps atom paths to the registry tiles holding them, and
+:func:`MatchTiles` evaluates a predicate once per registry tile.  Either way
+the answer is a lookup table indexed by tile ID, which is projected onto the
+z-level grids with a numpy gather, so no tile or atom is visited per cell.
+
+:class:`LocationIndex` goes the other way, from tile IDs to the cells using
+them.
+'''
+import numpy
+
+def MatchTiles(_map, predicate, atoms=False):
+    '''
+    Evaluate predicate once per tile in the registry.
+
+    :param predicate callable:
+        Called with a read-only :class:`byond.map.TileView`, or with an
+        :class:`byond.map.AtomView` if atoms is set.
+    :param atoms bool:
+        Match tiles holding at least one matching atom.  Each instance is
+        tested once, however many tiles use it.
+    :return numpy.ndarray: Boolean lookup table indexed by tile ID.
+    '''
+    lut = numpy.zeros(len(_map.tiles), bool)
+    atomMatches = {}
+    for tileID, tile in enumerate(_map.tiles):
+        if tile is None:
+            continue
+        if not atoms:
+            lut[tileID] = bool(predicate(_map.GetTileByID(tileID)))
+            continue
+        for atomID in tile.instances:
+            if atomID is None:
+                continue
+            matched = atomMatches.get(atomID)
+            if matched is None:
+                matched = atomMatches[atomID] = bool(predicate(_map.GetInstance(atomID)))
+            if matched:
+                lut[tileID] = True
+                break
+    return lut
+
+def ProjectMask(zLevel, lut):
+    '''
+    :param lut numpy.ndarray: Boolean lookup table indexed by tile ID.
+    :return numpy.ndarray: [x, y] mask of the cells whose tile is set in lut.
+    '''
+    grid = zLevel.tiles
+    if len(lut) <= grid.max(initial=0):
+        # Tiles added since lut was made can't have matched.
+        lut = numpy.concatenate((lut, numpy.zeros(int(grid.max()) + 1 - len(lut), bool)))
+    return lut[grid]
+
+def MaskCoords(levels, lut):
+    '''
+    :return numpy.ndarray:
+        One (x, y, z) row per matching cell of levels, ordered by z, then y,
+        then x.
+    '''
+    found = []
+    for zLevel in levels:
+        # Grids are indexed [x, y]; transpose for row-major results.
+        ys, xs = numpy.nonzero(ProjectMask(zLevel, lut).T)
+        found.append(numpy.column_stack((xs, ys, numpy.full(len(xs), zLevel.z))))
+    if len(found) == 0:
+        return numpy.empty((0, 3), int)
+    return numpy.concatenate(found)
+
+class LocationIndex(object):
+    '''
+    Where each tile ID is used, from one stable argsort over every grid of a
+    :class:`byond.map.Map`.
+
+    Unlike :class:`SpatialIndex`, this is a snapshot of the grids; the map
+    drops it whenever a grid is edited and builds a new one when asked.
+    '''
+    def __init__(self, _map):
+        levels = _map.zLevels
+        # Cells are numbered row by row, level by level.
+        sizes = [zLevel.width * zLevel.height for zLevel in levels]
+        self.levelStarts = numpy.cumsum([0] + sizes)
+        self.widths = numpy.array([zLevel.width for zLevel in levels], int)
+        self.zs = numpy.array([zLevel.z for zLevel in levels], int)
+        if len(levels) == 0:
+            cells = numpy.empty(0, int)
+        else:
+            cells = numpy.concatenate([zLevel.tiles.T.ravel() for zLevel in levels])
+
+        # : Cell numbers, grouped by tile ID.
+        self.order = numpy.argsort(cells, kind='stable')
+        # : Tile IDs in use, where their cells start in order, and how many.
+        self.tileIDs, self.starts, self.counts = numpy.unique(cells[self.order], return_index=True, return_counts=True)
+
+    def Get(self, tileID):
+        '''
+        :return numpy.ndarray:
+            One (x, y, z) row per cell using tileID, ordered by z, then y,
+            then x.
+        '''
+        i = numpy.searchsorted(self.tileIDs, tileID)
+        if i == len(self.tileIDs) or self.tileIDs[i] != tileID:
+            return numpy.empty((0, 3), int)
+        cells = self.order[self.starts[i]:self.starts[i] + self.counts[i]]
+        level = numpy.searchsorted(self.levelStarts, cells, side='right') - 1
+        ys, xs = numpy.divmod(cells - self.levelStarts[level], self.widths[level])
+        return numpy.column_stack((xs, ys, self.zs[level]))
+
+    def Count(self, tileID):
+        '''
+        :return int: Number of cells using tileID.
+        '''
+        i = numpy.searchsorted(self.tileIDs, tileID)
+        if i == len(self.tileIDs) or self.tileIDs[i] != tileID:
+            return 0
+        return int(self.counts[i])
+
+class SpatialIndex(object):
+    '''
+    Index of atom paths to tile IDs, built from a :class:`byond.map.Map`'s
+    tile registry the first time it's queried.
+
+    The registry only grows, so each query first indexes any tiles added
+    since the last one; editing a registry tile in place makes the map drop
+    the index instead.  Grids are read fresh every time, so edits made with
+    :meth:`byond.map.Map.SetTileAt` and friends are always reflected.
+    '''
+    def __init__(self, _map):
+        self.map = _map
+
+        # : path -> tile IDs, one entry per instance of path in the tile.
+        self.paths = {}
+
+        # : Number of registry tiles indexed so far.
+        self.indexed = 0
+
+    def Update(self):
+        '''
+        Index tiles added to the registry since the last update.
+        '''
+        tiles = self.map.tiles
+        for tileID in range(self.indexed, len(tiles)):
+            tile = tiles[tileID]
+            if tile is None:
+                continue
+            for atomID in tile.instances:
+                if atomID is None:
+                    continue
+                path = self.map.GetInstancePath(atomID)
+                if path is not None:
+                    self.paths.setdefault(path, []).append(tileID)
+        self.indexed = len(tiles)
+
+    def MatchPaths(self, path, subtypes=True):
+        '''
+        :param path str:
+            Atom path, like ``/obj/machinery/door``.
+        :param subtypes bool:
+            Also match paths below it, like ``/obj/machinery/door/airlock``.
+        :return list: Indexed paths that match.
+        '''
+        self.Update()
+        path = path.rstrip('/')
+        if not subtypes:
+            return [path] if path in self.paths else []
+        prefix = path + '/'
+        return [p for p in self.paths if p == path or p.startswith(prefix)]
+
+    def GetTileIDs(self, path, subtypes=True):
+        '''
+        :return numpy.ndarray: Sorted IDs of the tiles that contain path.
+        '''
+        tileIDs = [self.paths[p] for p in self.MatchPaths(path, subtypes)]
+        if len(tileIDs) == 0:
+            return numpy.empty(0, int)
+        return numpy.unique(numpy.concatenate(tileIDs))
+
+    def GetTileCounts(self, path, subtypes=True):
+        '''
+        :return numpy.ndarray:
+            How many instances of path each tile holds, indexed by tile ID.
+        '''
+        counts = numpy.zeros(len(self.map.tiles), int)
+        for p in self.MatchPaths(path, subtypes):
+            counts += numpy.bincount(self.paths[p], minlength=len(counts))
+        return counts
+
+    def Locate(self, path, z=None, subtypes=True):
+        '''
+        Find every tile holding path.
+
+        :param z int:
+            Only search this z-level.
+        :return numpy.ndarray:
+            One (x, y, z) row per tile, ordered by z, then y, then x.
+        '''
+        return MaskCoords(self._levels(z), self.GetTileCounts(path, subtypes) > 0)
+
+    def CountPerZ(self, path, subtypes=True):
+        '''
+        :return list: Number of instances of path on each z-level.
+        '''
+        counts = self.GetTileCounts(path, subtypes)
+        perZ = []
+        for zLevel in self.map.zLevels:
+            histogram = numpy.bincount(zLevel.tiles.ravel(), minlength=len(counts))
+            perZ.append(int(numpy.dot(histogram[:len(counts)], counts)))
+        return perZ
+
+    def _levels(self, z):
+        if z is None:
+            return self.map.zLevels
+        return [self.map.zLevels[z]]
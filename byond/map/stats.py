@@ -0,0 +1,120 @@
+'''
+Counting what's on a map.
+
+Cells only matter through their tile IDs, so each z-level is reduced to a
+histogram of tile IDs with one :func:`numpy.bincount`.  :class:`MapStats`
+keeps a sparse table of which instances each registry tile holds, and
+weighting it by the histogram gives exact counts per instance, and from
+there per path or per var value, without walking a single cell.
+'''
+import collections, numpy
+
+class MapStats(object):
+    '''
+    Counts for a :class:`byond.map.Map`.
+
+    Like :class:`byond.map.spatial.LocationIndex`, this is a snapshot: make a
+    new one after editing the map.
+    '''
+    def __init__(self, _map):
+        self.map = _map
+
+        # Sparse tile/instance table: entry i says tile tileIDs[i] holds one
+        # of instance atomIDs[i].  Repeated instances get an entry each.
+        tileIDs = []
+        atomIDs = []
+        for tileID, tile in enumerate(_map.tiles):
+            if tile is None:
+                continue
+            for atomID in tile.instances:
+                if atomID is not None:
+                    tileIDs.append(tileID)
+                    atomIDs.append(atomID)
+        self.tileIDs = numpy.array(tileIDs, int)
+        self.atomIDs = numpy.array(atomIDs, int)
+
+        # : Distinct instance paths, and the index into them of each instance (-1 for none).
+        self.paths = []
+        self.pathIndex = numpy.full(len(_map.instances), -1, int)
+        indices = {}
+        for atomID in range(len(_map.instances)):
+            path = _map.GetInstancePath(atomID)
+            if path is None:
+                continue
+            if path not in indices:
+                indices[path] = len(self.paths)
+                self.paths.append(path)
+            self.pathIndex[atomID] = indices[path]
+
+        # : z -> tile ID histogram.
+        self.histograms = {}
+
+    def GetTileCounts(self, z=None):
+        '''
+        :param z int: Only count this z-level.
+        :return numpy.ndarray: Number of cells using each tile, indexed by tile ID.
+        '''
+        counts = numpy.zeros(len(self.map.tiles), int)
+        for level in self._zs(z):
+            if level not in self.histograms:
+                self.histograms[level] = numpy.bincount(self.map.zLevels[level].tiles.ravel(), minlength=len(self.map.tiles))
+            counts += self.histograms[level][:len(counts)]
+        return counts
+
+    def GetInstanceCounts(self, z=None):
+        '''
+        :return numpy.ndarray: How many times each instance is placed, indexed by instance ID.
+        '''
+        weights = self.GetTileCounts(z)[self.tileIDs]
+        return numpy.bincount(self.atomIDs, weights=weights, minlength=len(self.map.instances)).astype(int)
+
+    def GetPathCounts(self, z=None):
+        '''
+        :return dict: Path -> number of atoms of exactly that path on the map.
+        '''
+        perAtom = self.GetInstanceCounts(z)
+        placed = self.pathIndex >= 0
+        perPath = numpy.bincount(self.pathIndex[placed], weights=perAtom[placed], minlength=len(self.paths)).astype(int)
+        return dict((path, count) for path, count in zip(self.paths, perPath.tolist()) if count > 0)
+
+    def CountPath(self, path, z=None, subtypes=True):
+        '''
+        :param path str: Atom path, like ``/obj/machinery/door``.
+        :param subtypes bool: Also count paths below it.
+        :return int:
+        '''
+        path = path.rstrip('/')
+        prefix = path + '/'
+        return sum(count for p, count in self.GetPathCounts(z).items() if p == path or (subtypes and p.startswith(prefix)))
+
+    def GetPropertyCounts(self, name, path=None, z=None, subtypes=True):
+        '''
+        Count the values a var is given on the map.  Only vars set in the map
+        itself are seen; atoms that leave it at its default are counted under
+        None.
+
+        :param name str: Var name, like ``dir``.
+        :param path str: Only count atoms of this path.
+        :return collections.Counter: Value, as written in the map -> count.
+        '''
+        perAtom = self.GetInstanceCounts(z)
+        if path is not None:
+            path = path.rstrip('/')
+            prefix = path + '/'
+            wanted = numpy.array([p == path or (subtypes and p.startswith(prefix)) for p in self.paths] + [False], bool)
+            # pathIndex of -1 picks the trailing False.
+            perAtom = numpy.where(wanted[self.pathIndex], perAtom, 0)
+
+        values = collections.Counter()
+        for atomID in numpy.nonzero(perAtom)[0].tolist():
+            atom = self.map.GetInstance(atomID)
+            value = None
+            if name in atom.mapSpecified and name in atom.properties:
+                value = str(atom.properties[name])
+            values[value] += int(perAtom[atomID])
+        return values
+
+    def _zs(self, z):
+        if z is None:
+            return range(len(self.map.zLevels))
+        return [z]
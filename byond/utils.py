@@ -1,11 +1,9 @@
 import hashlib, ast, os, time, sys
 import operator as op
+from functools import reduce
 
 def clock():
-    if sys.platform == 'win32':
-        return time.clock()
-    else:
-        return time.time()
+    return time.perf_counter()
     
 def md5sum(filename):
     with open(filename, mode='rb') as f:
@@ -23,10 +23,15 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
-import sys, argparse, os, re
-from byond import ObjectTree, Map, MapRenderFlags
-from byond.basetypes import Atom, PropertyFlags
+import sys, argparse, os, time
+from byond.objtree import ObjectTree
+from byond.map import Map, MapRenderFlags
 from byond.map.format.dmm import DMMFormat
+from byond.map.format.dmmcache import DMMCache
+from byond.map.diff import MapDiff
+from byond.map.merge import MapMerge
+from byond.map.patch import MapPatch
+from byond.map.stats import MapStats
 
 def main():
     dmmt = DMMFormat(None)
@@ -40,6 +45,12 @@ def main():
     _compare.add_argument('theirs', type=str, help='One side of the difference', metavar='theirs.dmm')
     _compare.add_argument('mine', type=str, help='The other side.', metavar='mine.dmm')
     
+    _merge = command.add_parser('merge', help='Three-way merge of maps.  Exits with status 1 if there are conflicts, so it can be used as a git merge driver.')
+    _merge.add_argument('-O', '--output', dest='output', type=str, help='Where to place the merged map. (Default is to overwrite ours)', metavar='merged.dmm', nargs='?')
+    _merge.add_argument('base', type=str, help='Common ancestor.', metavar='base.dmm')
+    _merge.add_argument('ours', type=str, help='Our side.', metavar='ours.dmm')
+    _merge.add_argument('theirs', type=str, help='Their side.', metavar='theirs.dmm')
+    
     _transcribe = command.add_parser('transcribe', help='Re-write a map file (used for parser debugging).')
     _transcribe.add_argument('-O', '--output', dest='output', type=str, help='The other side.', metavar='map.trans.dmm', nargs='?')
     _transcribe.add_argument('subject', type=str, help='Map file to re-write.', metavar='map.dmm')
@@ -57,9 +68,15 @@ def main():
     #_split.add_argument('-i','--isolate', help='Isolate a given z-level', metavar='NUM')
     _split.add_argument('map', type=str, help='Map to split.', metavar='map.dmm')
     
+    _benchmark = command.add_parser('benchmark', help='Time cold and warm (cached) loads of a map.')
+    _benchmark.add_argument('-n', '--runs', dest='runs', type=int, default=5, help='Number of warm loads to time.')
+    _benchmark.add_argument('map', type=str, help='Map to load.', metavar='map.dmm')
+    
     args = opt.parse_args()
     if args.MODE == 'diff':
         compare_dmm(args)
+    elif args.MODE == 'merge':
+        merge_dmm(args)
     elif args.MODE == 'analyze':
         analyze_dmm(args)
     elif args.MODE == 'split':
@@ -68,6 +85,8 @@ def main():
         patch_dmm(args)
     elif args.MODE == 'transcribe':
         transcribe_dmm(args)
+    elif args.MODE == 'benchmark':
+        benchmark_dmm(args)
     else:
         print('!!! Error, unknown MODE=%r' % args.MODE)
         
@@ -85,9 +104,27 @@ def transcribe_dmm(args):
     dmm.Load(args.subject, format='dmm')
     dmm.Save(outfile, format='dmm', serialize_cleanly=True)
         
+def benchmark_dmm(args):
+    if not os.path.isfile(args.map):
+        print('File {0} does not exist.'.format(args.map))
+        sys.exit(1)
+        
+    def timeLoad(**kwargs):
+        start = time.perf_counter()
+        dmm = Map(forgiving_atom_lookups=True)
+        dmm.Load(args.map, format='dmm', **kwargs)
+        return time.perf_counter() - start
+    
+    DMMCache(args.map).Remove()
+    cold = timeLoad(cache=True)
+    warm = [timeLoad(cache=True) for _ in range(max(1, args.runs))]
+    print('Cold load (parse + write cache): {:.3f}s'.format(cold))
+    print('Warm load (from cache): best {:.3f}s, mean {:.3f}s over {} runs'.format(min(warm), sum(warm) / len(warm), len(warm)))
+    print('Speedup: {:.1f}x'.format(cold / min(warm)))
+        
 def split_dmm(args):
     if not os.path.isfile(args.map):
-        print('File {0} does not exist.'.format(args.mine))
+        print('File {0} does not exist.'.format(args.map))
         sys.exit(1)
     if not os.path.isfile(args.project):
         print('DM Environment File {0} does not exist.'.format(args.project))
@@ -96,34 +133,21 @@ def split_dmm(args):
     dmm = Map(forgiving_atom_lookups=True)
     dmm.Load(args.map, format='dmm')
     
-    #fmt = DMMFormat(dmm)
-    
     nz = len(dmm.zLevels)
-    for z in range(nz):
-        basename,ext = os.path.splitext(args.map)
-        outfile='{0}-{1}{2}'.format(basename,z+1,ext)
-        print('>>> Splitting z={}/{} to {}'.format(z+1,nz,outfile))
-        output = Map(forgiving_atom_lookups=True)
-        currentZLevel = dmm.zLevels[z]
-        newZLevel = output.CreateZLevel(currentZLevel.height, currentZLevel.width)
-        #newZLevel.initial_load=True
-        for y in range(currentZLevel.width):
-            for x in range(currentZLevel.height):
-                newTile = newZLevel.GetTile(x, y)
-                for atom in currentZLevel.GetTile(x,y).GetAtoms():
-                    newTile.AppendAtom(atom.copy(toNewMap=True))
-        #newZLevel.initial_load=False
+    basename, ext = os.path.splitext(args.map)
+    for z, output in enumerate(dmm.ExtractZLevels()):
+        outfile = '{0}-{1}{2}'.format(basename, z + 1, ext)
+        print('>>> Splitting z={}/{} to {}'.format(z + 1, nz, outfile))
         output.Save(outfile, format='dmm')
 
 def patch_dmm(args):
-    print(repr(args.patches))
     for i in range(len(args.patches[0])):
         patch=args.patches[0][i]
         if not os.path.isfile(patch):
             print('File {0} does not exist.'.format(patch))
             sys.exit(1)
     if not os.path.isfile(args.map):
-        print('File {0} does not exist.'.format(args.mine))
+        print('File {0} does not exist.'.format(args.map))
         sys.exit(1)
     if not os.path.isfile(args.project):
         print('DM Environment File {0} does not exist.'.format(args.project))
@@ -132,120 +156,20 @@ def patch_dmm(args):
     dmm = Map(forgiving_atom_lookups=True)
     dmm.Load(args.map, format='dmm')
     
-    fmt = DMMFormat(dmm)
-
-    context = None
-    added = 0
-    removed = 0
-    
-    currentpatch = ''
-    
-    def changeMarker(ln):
-        a = Atom('/obj/effect/byondtools/changed')
-        a.setProperty('tag','{}:{}'.format(currentpatch,ln),flags=PropertyFlags.MAP_SPECIFIED)
-        return a
-    
-    def printReport(context, added, removed):
-        if context is not None:
-            x, y, z = context
-            print(' Z={} +{} -{}'.format(z, added, removed))
-    
-    REG_INSTRUCTION = re.compile(r'^(?P<change>[\+\-])(?P<amount>[0-9\*]+)?\s+(?P<atom>/.*)')
-    
     for i in range(len(args.patches[0])):
         patch=args.patches[0][i]
         print('* Applying {}...'.format(patch))
-        currentpatch=patch
-        with open(patch) as f:
-            ln = 0
-            lz = -1
-            skip_block = False
-            for line in f:
-                ln += 1
-                line = line.strip()
-                if line == '': continue
-                if line.startswith('#'): continue
-                if line.startswith('<') and line.endswith('>'):
-                    strcoords = line.strip('<>').split(',')
-                    newcoords = []
-                    for coord in strcoords:
-                        newcoords += [int(coord)]
-                    if context is not None and lz != context[2]:
-                        printReport(context, added, removed)
-                        lz = context[2]
-                        added = removed = 0
-                    context = newcoords
-                    skip_block = False
-                    continue
-                if line.startswith('@') and not skip_block:
-                    # @CHECK before-hash after-hash atoms-block
-    
-                    x, y, z = context
-                    
-                    if line.startswith('@CHECK'):
-                        _, beforehash, afterhash, serdata = line.split(' ', 3)
-                        
-                        if args.clobber:
-                            #print('WARNING: <{},{},{}> has changed and will be overwritten. (--clobber)'.format(x, y, z))
-                            t=fmt.consumeTileChunk(serdata, cache=False)
-                            t.AppendAtom(changeMarker(ln))
-                            dmm.SetTileAt(x, y, z, t)
-                            skip_block = True
-                            continue
-                        curhash = dmm.GetTileAt(x, y, z).GetHash()
-                        if afterhash == curhash:
-                            print('Skipping <{},{},{}> (already what we expected)'.format(x, y, z))
-                            skip_block = True
-                            continue
-                        #else: print('PRE {} != {}: OK'.format(curhash,afterhash))
-                        if beforehash != curhash:
-                            print('WARNING: <{},{},{}> has changed.  Operations on this tile may not be accurate!'.format(x, y, z))
-                            continue
-                        #else: print('OLD {} == {}: OK'.format(curhash,beforehash))
-                              
-                if not skip_block and (line.startswith('+') or line.startswith('-')):
-                    if line == '-ALL':
-                        dmm.SetTileAt(x, y, z, dmm.CreateTile())
-                        continue
-                    m = REG_INSTRUCTION.match(line)
-                    if m is None:
-                        print('{}:{}: MALFORMED INSTRUCTION: {}'.format(args.patch, ln, line))
-                        sys.exit(1)
-                    amount = m.group('amount')
-                    if amount == '*':
-                        amount = 9999
-                    else:
-                        amount = int(m.group('amount') or 1)
-                    change = m.group('change')
-                    
-                    atom = fmt.consumeAtom(m.group('atom'), ln)
-                    atom.filename = args.patch
-                    atom.line = ln
-                    if atom is None:
-                        print('{}:{}: WARNING: Unable to parse instance specified by chunk {}'.format(args.patch, ln, m.group('atom')))
-                        continue
-    
-                    x, y, z = context
-                    if x == 0 and y == 0 and z == 0:
-                        print('WE AT <0,0,0> SOMEFIN WRONG')
-                        
-                    if z >= len(dmm.zLevels): continue
-                    
-                    tile = dmm.GetTileAt(x, y, z)
-                    if change == '-':
-                        for _ in range(amount):
-                            if tile.CountAtom(atom) > 0:
-                                tile.RemoveAtom(atom, hash=False)
-                                removed += 1
-                            else: break
-                    elif change == '+':
-                        for _ in range(amount):
-                            tile.AppendAtom(atom, hash=False)
-                        added += amount
-                    tile.UpdateHash()
-                    # dmm.SetTileAt(x, y, z, tile)
-                    # print('{} - {}'.format((x,y,z),tile))
-            printReport(context, added, removed)
+        try:
+            mapPatch = MapPatch(patch)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        mapPatch.Apply(dmm, clobber=args.clobber)
+        for x, y, z in mapPatch.skipped:
+            print('Skipping <{},{},{}> (already what we expected)'.format(x, y, z))
+        for z in sorted(mapPatch.stats):
+            added, removed = mapPatch.stats[z]
+            print(' Z={} +{} -{}'.format(z, added, removed))
     
     print('Saving...')
     dmm.Save(args.output if args.output else args.map)
@@ -270,8 +194,6 @@ def compare_dmm(args):
     ttitle, _ = os.path.splitext(os.path.basename(args.theirs))
     mtitle, _ = os.path.splitext(os.path.basename(args.mine))
     
-    format = DMMFormat(theirs_dmm)
-    
     output = '{} - {}.dmmpatch'.format(ttitle, mtitle)
     
     if args.output:
@@ -279,107 +201,74 @@ def compare_dmm(args):
     with open(output, 'w') as f:
         stats = {
             'diffs':0,
-            'tilediffs':0,
-            'tiles':0,
-            'atoms':0
+            'tilediffs':0
         }
         print('Comparing maps...')
-        for z in range(len(theirs_dmm.zLevels)):
-            t_zlev = theirs_dmm.zLevels[z]
-            m_zlev = mine_dmm.zLevels[z]
-            if t_zlev.height != m_zlev.height or t_zlev.width != m_zlev.width:
+        diff = MapDiff(theirs_dmm, mine_dmm)
+        for z in diff.mismatched:
+            if z < len(theirs_dmm.zLevels) and z < len(mine_dmm.zLevels):
+                t_zlev = theirs_dmm.zLevels[z]
+                m_zlev = mine_dmm.zLevels[z]
                 print('!!! ZLEVEL {} HEIGHT/WIDTH MISMATCH: ({},{}) != ({},{})'.format(z, t_zlev.height, t_zlev.width, m_zlev.height, m_zlev.width))
+            else:
+                print('!!! ZLEVEL {} ONLY EXISTS IN ONE MAP'.format(z))
+        
+        def writeChanges(f, change, source):
+            for key, amount in source.items():
+                if amount > 1:
+                    f.write(' {}{} {}\n'.format('-' if source is change.removed else '+', amount if change.new[key] > 0 else '*', key))
+                else:
+                    f.write(' {} {}\n'.format('-' if source is change.removed else '+', key))
+                stats['diffs'] += amount
+        
+        # The @CHECK line only depends on the pair of tiles.
+        checks = {}
+        for x, y, z, tTileID, mTileID in diff.Changes():
+            change = diff.GetChange(tTileID, mTileID)
+            if len(change.removed) == 0 and len(change.added) == 0:
+                # Same atoms, different order.
                 continue
-            print(" Scanning z-level {} ({}x{})...".format(z, t_zlev.height, t_zlev.width))
-            for y in range(t_zlev.height):
-                for x in range(t_zlev.width):
-                    CHANGES = {}
-                    
-                    tTile = theirs_dmm.GetTileAt(x, y, z)
-                    # if tTile is None:
-                    #    print('!!! THEIRS <{},{},{}>: Tile object is None!'.format(x, y, z))
-                    #    #return
-                    mTile = mine_dmm.GetTileAt(x, y, z)
-                    # if tTile is None:
-                    #    print('!!! MINE <{},{},{}>: Tile object is None!'.format(x, y, z))
-                    #    #return
-                    
-                    theirs = {}
-                    mine = {}
-                    all_keys = set()
-                    
-                    if tTile:
-                        for A in tTile.GetAtoms():
-                            key = format.SerializeAtom(A)
-                            all_keys.add(key)
-                            if key not in theirs:
-                                theirs[key] = [A, 0]
-                            theirs[key][1] += 1
-                    if mTile:
-                        for A in mTile.GetAtoms():
-                            key = format.SerializeAtom(A)
-                            all_keys.add(key)
-                            if key not in mine:
-                                mine[key] = [A, 0]
-                            mine[key][1] += 1
-
-                    removals = set()
-                    additions = set()
-                    kept = {}
-                    
-                    for key in all_keys:
-                        change = None
-                        minecount = 0
-                        if key in mine:
-                            minecount = mine[key][1]
-                        theircount = 0
-                        if key in theirs:
-                            theircount = theirs[key][1]
-                        delta = minecount - theircount
-                        if delta < 0:
-                            change = '-'
-                            removals.add(key)
-                        elif delta > 0:
-                            change = '+'
-                            additions.add(key)
-                        if minecount > 0 and delta <= 0:
-                            kept[key] = minecount
-                        if change is not None:
-                            CHANGES[key] = [change, abs(delta), minecount, theircount]
-                        stats['tiles'] += 1
-                    
-                    def writeChanges(f, source, CHANGES):
-                        for key in source:
-                            change, amount, mc, tc = CHANGES[key]
-                            # change, amount, _, _ = changedat
-                            # f.write(' # {} vs {}\n'.format(mc, tc))
-                            abs_amt = abs(amount)
-                            if abs_amt > 1:
-                                f.write(' {}{} {}\n'.format(change, abs_amt if mc > 0 else '*', key))
-                            else:
-                                f.write(' {} {}\n'.format(change, key))
-                            stats['diffs'] += abs_amt
-                            
-                    if len(CHANGES) > 0:
-                        f.write('<{},{},{}>\n'.format(x, y, z))
-                        stats['tilediffs'] += 1
-                        f.write(' @CHECK {before} {after} {tiledat}\n'.format(before=tTile.GetHash(), after=mTile.GetHash(), tiledat=format.SerializeTile(mTile)))
-                        if len(kept) == 0:
-                            f.write(' -ALL\n')
-                        else:
-                            writeChanges(f, removals, CHANGES)
-                        """
-                        for key,count in kept.items():
-                            if count > 1:
-                                f.write(' ={} {}\n'.format(count, key))
-                            else:
-                                f.write(' = {}\n'.format(key))
-                        """
-                        writeChanges(f, additions, CHANGES)
+            check = checks.get((tTileID, mTileID))
+            if check is None:
+                tTile = theirs_dmm.GetTileByID(tTileID)
+                mTile = mine_dmm.GetTileByID(mTileID)
+                check = checks[tTileID, mTileID] = ' @CHECK {before} {after} {tiledat}\n'.format(before=tTile.GetContentHash(), after=mTile.GetContentHash(), tiledat=diff.newKeys.format.SerializeTile(mTile))
+            f.write('<{},{},{}>\n'.format(x, y, z))
+            stats['tilediffs'] += 1
+            f.write(check)
+            if not (change.old & change.new):
+                f.write(' -ALL\n')
+            else:
+                writeChanges(f, change, change.removed)
+            writeChanges(f, change, change.added)
         print('Compared maps: {} differences in {} tiles.'.format(stats['diffs'], stats['tilediffs']))
         print('Total: {} atoms, {} tiles.'.format(stats['diffs'], stats['tilediffs']))
 
 
+def merge_dmm(args):
+    for filename in (args.base, args.ours, args.theirs):
+        if not os.path.isfile(filename):
+            print('File {0} does not exist.'.format(filename))
+            sys.exit(2)
+    
+    maps = []
+    for filename in (args.base, args.ours, args.theirs):
+        dmm = Map(forgiving_atom_lookups=True)
+        dmm.Load(filename, format='dmm')
+        maps.append(dmm)
+    
+    print('Merging maps...')
+    merge = MapMerge(*maps)
+    merged = merge.Merge()
+    conflicts = merge.GetConflicts()
+    for x, y, z in conflicts.tolist():
+        print('!!! CONFLICT <{},{},{}>: kept ours'.format(x, y, z))
+    print('Merged maps: {} tiles merged by atom, {} conflicts.'.format(merge.atomMerges, len(conflicts)))
+    
+    merged.Save(args.output if args.output else args.ours)
+    if len(conflicts) > 0:
+        sys.exit(1)
+    
 def analyze_dmm(args):
     tmpl_head = '''
 <html>
@@ -414,17 +303,19 @@ def analyze_dmm(args):
         return (tmpl_head + body + tmpl_footer).replace('{TITLE}', title).replace('{ROOT}', rewt)
 
     if not os.path.isfile(args.project):
-        print('DM Environment file {0} does not exist.'.format(args.theirs))
+        print('DM Environment file {0} does not exist.'.format(args.project))
         sys.exit(1)
 
     if not os.path.isfile(args.map):
-        print('Map {0} does not exist.'.format(args.theirs))
+        print('Map {0} does not exist.'.format(args.map))
         sys.exit(1)
 
     tree = ObjectTree()
     tree.ProcessFilesFromDME(args.project)
     dmm = Map(tree)
-    dmm.readMap(args.map)
+    dmm.Load(args.map, format='dmm')
+    stats = MapStats(dmm)
+    placed = stats.GetInstanceCounts()
     
     basedir = os.path.join(os.path.dirname(args.project), 'analysis', os.path.basename(args.map))
     
@@ -435,6 +326,8 @@ def analyze_dmm(args):
     # Dump instances
     instance_info = {}
     for atom in dmm.instances:
+        if atom is None:
+            continue
         if atom.path not in instance_info:
             instance_info[atom.path] = []
         instance_info[atom.path] += [atom.ID]
@@ -443,6 +336,7 @@ def analyze_dmm(args):
             body = '<h2>Atom Data:</h2><table class="prettytable"><thead><tr><th>Name</th><th>Value</th></tr></thead><tbody>'
             for attr in presentable_attributes: 
                 body += '<tr><th>{0}</th><td>{1}</td></tr>'.format(attr, getattr(atom, attr, None))
+            body += '<tr><th>placed</th><td>{0}</td></tr>'.format(placed[atom.ID])
             body += '</tbody></table>'
             
             body += '<h2>Map-Specified Properties:</h2><table class="prettytable"><thead><tr><th>Name</th><th>Value</th></tr></thead><tbody>'
@@ -457,26 +351,30 @@ def analyze_dmm(args):
             body += '</tbody></table>'
             f.write(MakePage(title='Instance #{0}'.format(atom.ID), depth=1, body=body))
     with open(os.path.join(basedir, 'instances', 'index.html'), 'w') as idx:
+        pathCounts = stats.GetPathCounts()
         body = '<ul>'
-        for atype, instances in instance_info.items():
-            body += '<li><b>{0}</b><ul>'.format(atype)
+        for atype, instances in sorted(instance_info.items()):
+            body += '<li><b>{0}</b> ({1} placed)<ul>'.format(atype, pathCounts.get(atype, 0))
             for iid in instances:
-                body += '<li><a href="{{ROOT}}/instances/{0}.html">#{0}</a></li>'.format(iid)
+                body += '<li><a href="{{ROOT}}/instances/{0}.html">#{0}</a> ({1} placed)</li>'.format(iid, placed[iid])
             body += '</ul></li>'
         body += "</ul>"
         idx.write(MakePage(title='Instance Index'.format(atom.ID), depth=1, body=body))
         
     # Tiles
+    tileCounts = stats.GetTileCounts()
     with open(os.path.join(basedir, 'index.html'), 'w') as f:
-        body = '<table class="prettytable"><thead><tr><th>Icon</th><th>ID</th><th>Instances</th></tr></thead><tbody>'
-        for tile in dmm.tileTypes:
-            body += '<tr><td><img src="tiles/{0}.png" height="96" width="96" /></td><th>{0}</th><td><ul>'.format(tile.ID)
+        body = '<table class="prettytable"><thead><tr><th>Icon</th><th>ID</th><th>Cells</th><th>Instances</th></tr></thead><tbody>'
+        for tile in dmm.tiles:
+            if tile is None:
+                continue
+            body += '<tr><td><img src="tiles/{0}.png" height="96" width="96" /></td><th>{0}</th><td>{1}</td><td><ul>'.format(tile.ID, tileCounts[tile.ID])
             for atom in tile.SortAtoms():
                 body += '<li><a href="{{ROOT}}/instances/{0}.html">#{0}</a> - {1}</li>'.format(atom.ID, atom.path)
             body += '</ul></td></tr>'
-            img = tile.RenderToMapTile(0, os.path.dirname(sys.argv[1]), MapRenderFlags.RENDER_STARS)
+            img = tile.RenderToMapTile(0, os.path.dirname(args.project), MapRenderFlags.RENDER_STARS)
             if img is None: continue
-            pass_2 = tile.RenderToMapTile(1, os.path.dirname(sys.argv[1]), 0)
+            pass_2 = tile.RenderToMapTile(1, os.path.dirname(args.project), 0)
             if pass_2 is not None:
                 img.paste(pass_2, (0, 0, 96, 96), pass_2)
             img.save(os.path.join(basedir, 'tiles', '{0}.png'.format(tile.ID)), 'PNG')
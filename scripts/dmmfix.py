@@ -105,7 +105,7 @@ it = dmm.Tiles()
 thousandsActivity=0
 for tile in it:
     if tile is None: continue
-    for atom in tile.GetAtoms(): 
+    for atom in tile.GetAtoms(copy=True): 
         ': :type atom Atom:'
         changes = []
         tile.RemoveAtom(atom)
@@ -36,6 +36,62 @@ class AtomTest(unittest.TestCase):
         # Check it
         self.assertEqual(str(atom), atom_serialized)
 
+    def test_copy_is_compact(self):
+        from byond.basetypes import Atom, MapAtom, BYONDString, BYONDValue
+        atom = Atom('/datum/test',__file__,0)
+        atom.properties['dir']=BYONDValue(2)
+        atom.properties['name']=BYONDString('test datum')
+        atom.mapSpecified=['dir','name']
+        
+        atom2=atom.copy()
+        self.assertIsInstance(atom2, MapAtom)
+        self.assertFalse(hasattr(atom2, '__dict__'))
+        self.assertFalse(hasattr(atom2, 'children'))
+        self.assertEqual(str(atom2), str(atom))
+        self.assertEqual(atom2.GetHash(), atom.GetHash())
+        self.assertEqual(atom2.copy(), atom2)
+
+    def test_hash_follows_edits(self):
+        from byond.basetypes import Atom, PropertyFlags
+        atom = Atom('/datum/test',__file__,0)
+        atom.setProperty('dir', 2, PropertyFlags.MAP_SPECIFIED)
+        before = atom.GetHash()
+        content = atom.GetContentHash()
+        
+        atom.setProperty('dir', 4)
+        self.assertNotEqual(atom.GetHash(), before)
+        self.assertNotEqual(atom.GetContentHash(), content)
+        atom.setProperty('dir', 2)
+        self.assertEqual(atom.GetHash(), before)
+        self.assertEqual(atom.GetContentHash(), content)
+        
+        # Only what a map would save counts.
+        atom.setProperty('name', 'test')
+        self.assertEqual(atom.GetHash(), before)
+        self.assertEqual(atom.GetHashKey(), ('/datum/test', frozenset([('dir', '2')])))
+
+    def test_copy_hashes_its_own_edits(self):
+        from byond.basetypes import Atom, BYONDValue, PropertyFlags
+        atom = Atom('/datum/test',__file__,0)
+        atom.setProperty('dir', 2, PropertyFlags.MAP_SPECIFIED)
+        before = atom.GetHash()
+        
+        atom2 = atom.copy()
+        self.assertEqual(atom2.GetHash(), before)
+        atom2.properties['dir']=BYONDValue(4)
+        self.assertNotEqual(atom2.GetHash(), before)
+        self.assertEqual(atom.GetHash(), before)
+        
+        # Edits made straight to a map instance's vars are picked up too.
+        atom2.properties['dir']=BYONDValue(2)
+        self.assertEqual(atom2.GetHash(), before)
+        atom2.mapSpecified.remove('dir')
+        self.assertNotEqual(atom2.GetHash(), before)
+        atom2.mapSpecified += ['dir']
+        self.assertEqual(atom2.GetHash(), before)
+        del atom2.properties['dir']
+        self.assertNotEqual(atom2.GetHash(), before)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
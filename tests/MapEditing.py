@@ -0,0 +1,316 @@
+'''
+Editing maps: views, hashes, regions and registry housekeeping.
+'''
+import unittest
+from fixtures import MapTestCase
+
+class MapEditingTest(MapTestCase):
+    def setUp(self):
+        MapTestCase.setUp(self)
+        self.map = self._load_map()
+
+    def test_views_are_read_only(self):
+        from byond.map import AtomView, TileView
+        tile = self.map.GetTileAt(2, 0, 0)
+        self.assertIsInstance(tile, TileView)
+        self.assertEqual(tile.coords, (2, 0, 0))
+        self.assertRaises(AttributeError, setattr, tile, 'ID', 0)
+        self.assertRaises(AttributeError, getattr, tile, 'AppendAtom')
+
+        atom = tile.GetAtom(0)
+        self.assertIsInstance(atom, AtomView)
+        self.assertIs(atom, self.map.GetInstance(tile.instances[0]))
+        with self.assertRaises(TypeError):
+            atom.properties['d1'] = None
+        self.assertRaises(AttributeError, getattr, atom, 'setProperty')
+
+        edited = atom.copy()
+        edited.mapSpecified.remove('tag')
+        self.assertIn('tag', atom.mapSpecified)
+
+        for name in ('UpdateMap', 'UpdateHash', 'InvalidateHash'):
+            self.assertRaises(AttributeError, getattr, atom, name)
+        self.assertRaises(AttributeError, getattr, tile, 'UpdateHash')
+
+        before = str(tile)
+        copied = self.map.CopyTileAt(2, 0, 0)
+        copied.RemoveAtom(copied.GetAtom(0))
+        self.assertEqual(str(self.map.GetTileAt(2, 0, 0)), before)
+        self.map.SetTileAt(2, 0, 0, copied)
+        self.assertEqual(str(self.map.GetTileAt(2, 0, 0)), str(copied))
+
+    def test_views_append_to_other_maps(self):
+        from byond.map import Map
+        cells = self._cells(self.map)
+        atomIDs = [atom.ID for atom in self.map.instances]
+        cable = self.map.GetTileAt(2, 0, 0).GetAtom(0)
+
+        other = Map()
+        other.CreateZLevel(1, 1)
+        tile = other.CreateTile()
+        tile.AppendAtom(cable)
+        other.SetTileAt(0, 0, 0, tile)
+        self.assertEqual(str(other.GetTileAt(0, 0, 0)), str(cable))
+        self.assertEqual(cable.ID, atomIDs[self.map.GetTileAt(2, 0, 0).instances[0]])
+        self.assertListEqual([atom.ID for atom in self.map.instances], atomIDs)
+        self.assertListEqual(self._cells(self.map), cells)
+
+    def test_edited_copies_are_saved(self):
+        from byond.basetypes import BYONDString
+        from byond.map import Map
+        # As scripts/dmmfix.py does it: edit copies in place, then put them back.
+        tile = self.map.CopyTileAt(1, 0, 0)
+        for atom in tile.GetAtoms(copy=True):
+            tile.RemoveAtom(atom)
+            if atom.path == '/obj/structure/lattice':
+                atom.GetHash()
+                atom.properties['name'] = BYONDString('FIXED')
+                atom.mapSpecified.append('name')
+            tile.AppendAtom(atom)
+        self.map.SetTileAt(1, 0, 0, tile)
+        self.assertNotEqual(str(self.map.GetTileAt(1, 0, 0)), str(self.map.GetTileAt(0, 1, 0)))
+        
+        filename = self._write_map('')
+        self.map.Save(filename)
+        with open(filename) as f:
+            self.assertIn('/obj/structure/lattice{name = "FIXED"}', f.read())
+        reloaded = Map()
+        reloaded.Load(filename)
+        self.assertEqual(reloaded.GetTileAt(1, 0, 0).GetAtom(0).getProperty('name'), 'FIXED')
+        self.assertIsNone(reloaded.GetTileAt(0, 1, 0).GetAtom(0).getProperty('name'))
+        
+    def test_hash_collisions(self):
+        from unittest import mock
+        from byond.basetypes import BaseAtom
+        def collide(atom, no_map_update=False):
+            atom._hash = 0
+        with mock.patch.object(BaseAtom, 'UpdateHash', collide):
+            collided = self._load_map()
+            self.assertEqual(len(collided.instances), len(self.map.instances))
+            self.assertListEqual(self._cells(collided), self._cells(self.map))
+
+            tile = collided.CopyTileAt(2, 0, 0)
+            cable = tile.GetAtom(0)
+            tile.AppendAtom(self.map.GetTileAt(2, 0, 0).GetAtom(0))
+            self.assertEqual(tile.instances[-1], cable.ID)
+            collided.RemoveAtom(cable)
+            tile.AppendAtom(cable.copy())
+            self.assertEqual(tile.instances[-1], len(self.map.instances))
+
+    def test_loaded_instances_hash_their_map_vars(self):
+        from byond.map import Map
+        from fixtures import MakeTree
+        tree = MakeTree()
+        filename = self._write_map()
+        for lazy in (False, True):
+            _map = Map(tree)
+            _map.Load(filename, lazy=lazy)
+            floorgrime = _map.GetTileAt(2, 0, 0).GetAtom(1)
+            self.assertEqual(floorgrime.getProperty('icon_state'), 'floorgrime')
+            
+            # A plain floor is a new instance, not the floorgrime one.
+            tile = _map.CreateTile()
+            plain = tree.GetAtom('/turf/simulated/floor').copy()
+            tile.AppendAtom(plain)
+            self.assertNotEqual(plain.ID, floorgrime.ID)
+            self.assertEqual(_map.GetInstance(plain.ID).getProperty('icon_state'), '')
+        
+    def test_atoms_match_lazy_instances(self):
+        from byond.map.format.base import LazyAtom
+        lazy = self._load_map(lazy=True)
+        floorgrimeID = lazy.GetTileAt(2, 0, 0).instances[1]
+        self.assertIsInstance(lazy.instances[floorgrimeID], LazyAtom)
+        count = len(lazy.instances)
+
+        # An equal atom reuses the instance nothing has built yet.
+        tile = lazy.CreateTile()
+        floorgrime = self.map.GetTileAt(2, 0, 0).GetAtom(1).copy()
+        tile.AppendAtom(floorgrime)
+        self.assertEqual(floorgrime.ID, floorgrimeID)
+        self.assertEqual(len(lazy.instances), count)
+        # Other paths are left alone.
+        self.assertIsInstance(lazy.instances[lazy.GetTileAt(2, 0, 0).instances[0]], LazyAtom)
+
+    def test_lazy_loads_match_eager_ones(self):
+        from byond.map import Map
+        from fixtures import EditMap, MakeTree
+        # The same cable and lattice spelled differently, and a path the tree doesn't have.
+        filename = self._write_map(EditMap(
+            '"aae" = (/obj/structure/cable{tag = ""; d2 = 2; icon_state = "1-2"; d1 = 1},/obj/structure/lattice{icon_state = ""},/obj/unknown,/turf/space,/area)',
+            ('aabaacaaaaaa', 'aabaacaaeaaa')))
+        maps = []
+        for lazy in (False, True):
+            _map = Map(MakeTree())
+            _map.Load(filename, lazy=lazy)
+            maps.append(_map)
+        eager, lazy = maps
+        self.assertListEqual([lazy.GetInstancePath(i) for i in range(len(lazy.instances))], [a.path for a in eager.instances])
+        self.assertListEqual([t.instances for t in lazy.tiles], [t.instances for t in eager.tiles])
+        self.assertListEqual([str(t) for t in lazy.tiles], [str(t) for t in eager.tiles])
+        self.assertListEqual(self._cells(lazy), self._cells(eager))
+        # Shared with "aac" and "aab"; the unknown path is skipped.
+        self.assertListEqual(eager.GetTileAt(2, 1, 0).instances, eager.GetTileAt(2, 0, 0).instances[:1] + eager.GetTileAt(1, 0, 0).instances)
+
+    def test_tile_hash_is_structural(self):
+        tile = self.map.CopyTileAt(2, 0, 0)
+        self.assertEqual(tile.GetHash(), tuple(tile.instances))
+        atom = tile.GetAtom(0)
+        tile.RemoveAtom(atom)
+        tile.AppendAtom(atom)
+        self.assertEqual(tile.GetHash(), tuple(tile.instances))
+        self.assertEqual(len(self.map.tiles), len(set(t.GetHash() for t in self.map.tiles)))
+
+        # Content hashes are comparable between maps; structural ones needn't be.
+        other = self._load_map(lazy=True)
+        self.assertEqual(other.GetTileAt(2, 0, 0).GetContentHash(), self.map.GetTileAt(2, 0, 0).GetContentHash())
+
+    def test_region_edits(self):
+        original = self.map.CopyRegion(1)
+        untouched = self.map.CopyRegion(0, (2, 0, 4, 3))
+
+        lattice = self.map.GetTileAt(1, 0, 0)
+        self.map.FillRegion(0, lattice, (0, 0, 2, 3))
+        self.assertTrue((self.map.CopyRegion(0, (0, 0, 2, 3)) == lattice.ID).all())
+        self.assertTrue((self.map.CopyRegion(0, (2, 0, 4, 3)) == untouched).all())
+
+        space = self.map.GetTileAt(0, 1, 1)
+        changed = self.map.ReplaceTile(space, lattice, z=1)
+        self.assertEqual(changed, int((original == space.ID).sum()))
+        self.assertEqual(int((self.map.CopyRegion(1) == space.ID).sum()), 0)
+
+        # Blocks keep their contents when pasted into another map.
+        other = self._load_map()
+        background = other.GetTileAt(0, 1, 1)
+        other.FillRegion(0, background)
+        other.PasteRegion(2, 1, 0, self.map.CopyRegion(0, (0, 0, 3, 3)), source=self.map)
+        for x in range(4):
+            for y in range(3):
+                expected = self.map.GetTileAt(x - 2, y - 1, 0) if x >= 2 and y >= 1 else background
+                self.assertEqual(str(other.GetTileAt(x, y, 0)), str(expected))
+
+        # Blocks hanging off any edge are clipped, not wrapped around.
+        block = self.map.CopyRegion(0)
+        for x, y in ((-1, -2), (3, 2), (-4, 0), (0, 3)):
+            other.FillRegion(0, background)
+            other.PasteRegion(x, y, 0, block, source=self.map)
+            for cx in range(4):
+                for cy in range(3):
+                    inside = 0 <= cx - x < 4 and 0 <= cy - y < 3
+                    expected = self.map.GetTileAt(cx - x, cy - y, 0) if inside else background
+                    self.assertEqual(str(other.GetTileAt(cx, cy, 0)), str(expected))
+
+    def test_Resize(self):
+        from byond.directions import SOUTH, EAST
+        zLevel = self.map.zLevels[0]
+        original = zLevel.CopyRegion()
+        baseID = self.map.basetile.ID
+
+        zLevel.Resize(5, 6)
+        self.assertEqual((zLevel.width, zLevel.height), (6, 5))
+        self.assertTrue((zLevel.CopyRegion((0, 0, 4, 3)) == original).all())
+        self.assertTrue((zLevel.CopyRegion((4, 0, 6, 5)) == baseID).all())
+        self.assertTrue((zLevel.CopyRegion((0, 3, 6, 5)) == baseID).all())
+
+        # Shrink back, keeping the bottom right corner of the original.
+        zLevel.Resize(3, 4)
+        zLevel.Resize(2, 2, SOUTH | EAST)
+        self.assertTrue((zLevel.CopyRegion() == original[2:, 1:]).all())
+
+        zLevel.Resize(4, 4, 0)
+        self.assertTrue((zLevel.CopyRegion((1, 1, 3, 3)) == original[2:, 1:]).all())
+
+    def test_Compact(self):
+        for preserve_keys in (False, True):
+            self.map = self._load_map()
+
+            # Orphan a tile and add a new one past the end of the registry.
+            new = self.map.CopyTileAt(0, 0, 0)
+            new.AppendAtom(self.map.GetInstance(self.map.GetTileAt(1, 0, 0).instances[0], copy=True))
+            self.map.ReplaceTile(self.map.GetTileAt(2, 0, 0), self.map.GetTileAt(0, 0, 0))
+            self.map.SetTileAt(3, 2, 0, new)
+            cells = self._cells(self.map)
+            keyed = dict((tile.ID, str(tile)) for tile in self.map.tiles if tile is not None)
+
+            lut = self.map.Compact(preserve_keys)
+            self.assertListEqual(self._cells(self.map), cells)
+            used = set(tileID for z in self.map.zLevels for tileID in z.tiles.ravel().tolist())
+            self.assertEqual(len(self.map.tiles), len(used | set([self.map.basetile.ID])))
+            self.assertNotIn(None, self.map.tiles)
+            for tileID, tile in enumerate(self.map.tiles):
+                self.assertEqual(tile.ID, tileID)
+                self.assertEqual(self.map._tile_idmap[tile.GetHash()], tileID)
+            self.assertEqual(len(self.map.instances), len(set(atomID for tile in self.map.tiles for atomID in tile.instances)))
+            if preserve_keys:
+                # Only the tile that was past the end has moved.
+                moved = [oldID for oldID, newID in enumerate(lut.tolist()) if newID not in (-1, oldID)]
+                self.assertListEqual(moved, [new.ID])
+                for oldID, newID in enumerate(lut.tolist()):
+                    if newID == oldID:
+                        self.assertEqual(str(self.map.tiles[newID]), keyed[oldID])
+
+    def test_Compact_preserves_keys(self):
+        from byond.map import Map
+        def save(_map):
+            filename = self._write_map('')
+            _map.Save(filename)
+            with open(filename) as f:
+                keys = [line.split('"')[1] for line in f if line.startswith('"') and ' = ' in line]
+            reloaded = Map()
+            reloaded.Load(filename)
+            self.assertListEqual(self._cells(reloaded), self._cells(_map))
+            return keys
+
+        # Drop the lattice tile, and add a tile of our own.
+        cable = self.map.GetTileAt(2, 0, 0)
+        self.map.ReplaceTile(self.map.GetTileAt(1, 0, 0), self.map.GetTileAt(0, 0, 0))
+        new = self.map.CopyTileAt(0, 0, 0)
+        new.AppendAtom(cable.GetAtom(0))
+        self.map.SetTileAt(3, 2, 1, new)
+        renumbered = self._load_map()
+        renumbered.ReplaceTile(renumbered.GetTileAt(1, 0, 0), renumbered.GetTileAt(0, 0, 0))
+        renumbered.Compact()
+        self.assertListEqual(save(renumbered), ['a', 'b'])
+
+        self.map.Compact(preserve_keys=True)
+        self.assertTrue(self.map.preserve_keys)
+        # The new tile takes the first free key.
+        self.assertListEqual(save(self.map), ['aaa', 'aab', 'aac'])
+        self.assertEqual(self.map.tiles[self.map.GetTileAt(2, 0, 0).ID].origID, 'aac')
+        self.assertEqual(self.map.tiles[self.map.GetTileAt(3, 2, 1).ID].origID, '')
+
+    def test_ExtractZLevels(self):
+        from byond.map import Map
+        first, second = self.map.ExtractZLevels()
+        self.assertListEqual(self._cells(first), self._cells(self.map, 0))
+        self.assertListEqual(self._cells(second), self._cells(self.map, 1))
+        # Only space and lattice are used on z 1.
+        self.assertEqual(len(second.tiles), 2)
+
+        # Compacting an extracted map leaves the source alone.
+        second.Compact()
+        self.assertListEqual(self._cells(second), self._cells(self.map, 1))
+        self.assertListEqual([atom.ID for atom in self.map.instances], list(range(len(self.map.instances))))
+
+        # Nor does compacting the source touch the extracted maps.
+        cells = self._cells(self.map, 0)
+        lattice = self.map.GetTileAt(1, 0, 0)
+        self.map.ReplaceTile(lattice, self.map.GetTileAt(0, 0, 0))
+        self.map.ReplaceTile(self.map.GetTileAt(3, 0, 0), self.map.GetTileAt(0, 0, 0))
+        self.map.Compact()
+        self.assertLess(len(self.map.instances), len(first.instances))
+        
+        filename = self._write_map('')
+        first.Save(filename)
+        reloaded = Map()
+        reloaded.Load(filename)
+        self.assertEqual((reloaded.zLevels[0].width, reloaded.zLevels[0].height), (4, 3))
+        self.assertListEqual(self._cells(reloaded), cells)
+        self.assertListEqual(self._cells(first), cells)
+        for atom in first.GetTileAt(2, 0, 0).GetAtoms():
+            self.assertEqual(atom.ID, first.GetInstance(atom.ID).ID)
+        tile = first.CopyTileAt(2, 0, 0)
+        tile.RemoveAtom(tile.GetAtom(0))
+        self.assertListEqual([atom.path for atom in tile.GetAtoms()], ['/turf/simulated/floor', '/area/security/prison'])
+
+if __name__ == "__main__":
+    unittest.main()
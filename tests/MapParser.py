@@ -3,15 +3,10 @@ Created on Jan 1, 2014
 
 @author: Rob
 '''
-import unittest
+import unittest, os, json
+from fixtures import MapTestCase, TEST_MAP
 
-class MapParserTest(unittest.TestCase):
-    def setUp(self):
-        from byond.map.format.dmm import DMMFormat
-        from byond.map import Map
-        self.map = Map()
-        self.dmm = DMMFormat(self.map)
-    
+class MapParserTest(MapTestCase):
     def test_basic_SplitAtoms_operation(self):
         testStr = '/obj/effect/landmark{name = "carpspawn"},/obj/structure/lattice,/turf/space,/area'
         expectedOutput = ['/obj/effect/landmark{name = "carpspawn"}', '/obj/structure/lattice', '/turf/space', '/area']
@@ -26,6 +21,27 @@ class MapParserTest(unittest.TestCase):
         out = self.dmm.SplitProperties(testStr)
         self.assertListEqual(out, expectedOutput)
     
+    def test_ParseAtoms_nested_values(self):
+        from byond.map.format.dmm import ParseAtoms
+        testStr = '/obj/machinery/vending{products = list("a;b" = 1, "c" = list(2, 3)); icon = \'icons/obj/v,m.dmi\'; desc = {"one, two; three}"}; name = "it\\"s"},/turf/space,/area'
+        expectedOutput = [
+            ('/obj/machinery/vending{products = list("a;b" = 1, "c" = list(2, 3)); icon = \'icons/obj/v,m.dmi\'; desc = {"one, two; three}"}; name = "it\\"s"}', '/obj/machinery/vending', [
+                ('products', 'list("a;b" = 1, "c" = list(2, 3))'),
+                ('icon', "'icons/obj/v,m.dmi'"),
+                ('desc', '{"one, two; three}"}'),
+                ('name', '"it\\"s"'),
+            ]),
+            ('/turf/space', '/turf/space', []),
+            ('/area', '/area', []),
+        ]
+        self.assertListEqual(ParseAtoms(testStr), expectedOutput)
+        
+    def test_consumeTile_multiline_text(self):
+        testStr = '"aab" = (/obj/structure/sign{desc = {"Line one,\nline two"}; name = "sign"},/turf/space,/area)'
+        tile = self.dmm.consumeTile(testStr)
+        self.assertEqual(tile.GetAtom(0).properties['desc'].value, '{"Line one,\nline two"}')
+        self.assertEqual(self.dmm.SerializeTile(tile), testStr.split('=', 1)[1].strip())
+        
     def test_basic_consumeTile_operation(self):
         from byond.map import Map, Tile
         '''
@@ -128,6 +144,203 @@ class MapParserTest(unittest.TestCase):
         out = self.dmm.consumeTile(testStr)
         self.assertEqual(out._serialize(), testSerData)
 
+    def test_consumeTileMap_matches_per_cell_decode(self):
+        filename = self._write_map()
+        self.dmm.Load(filename)
+        reader = self.dmm
+        
+        # What the old chunker() loop produced, one SetTileID at a time.
+        z = -1
+        y = 0
+        for line in TEST_MAP.splitlines():
+            if line.startswith('('):
+                z += 1
+                y = 0
+                zLevel = self.map.zLevels[z]
+                self.assertEqual((zLevel.width, zLevel.height), (4, 3))
+                continue
+            if z < 0 or line in ('', '"}'):
+                continue
+            for x in range(len(line) // 3):
+                self.assertEqual(zLevel.tiles[x, y], reader.oldID2NewID[line[x * 3:x * 3 + 3]], '<{},{},{}>'.format(x, y, z))
+            y += 1
+        self.assertEqual(len(self.map.zLevels), 2)
+        self.assertEqual(reader.oldID2NewID['aad'], reader.oldID2NewID['aab'])
+        
+    def test_consumeTileMap_unknown_key(self):
+        filename = self._write_map(TEST_MAP.replace('aaaaabaacaad', 'aaaaabaacaaz'))
+        self.assertRaises(KeyError, self.dmm.Load, filename)
+
+    def test_Load_cache_roundtrip(self):
+        from byond.map import Map
+        filename = self._write_map()
+        
+        self.map.Load(filename, cache=True)
+        self.assertTrue(os.path.isfile(filename + '.cache'))
+        
+        warm = Map()
+        warm.Load(filename, cache=True)
+        self.assertEqual([str(t) for t in warm.tiles], [str(t) for t in self.map.tiles])
+        self.assertEqual([a.GetHash() for a in warm.instances], [a.GetHash() for a in self.map.instances])
+        for z in range(2):
+            self.assertTrue((warm.zLevels[z].tiles == self.map.zLevels[z].tiles).all())
+        self.assertEqual(warm.basetile.origID, 'aaa')
+        
+        # Edited maps don't come back from the old cache.
+        with open(filename, 'w') as f:
+            f.write(TEST_MAP.replace('aaaaabaacaad', 'aacaacaacaac'))
+        edited = Map()
+        edited.Load(filename, cache=True)
+        self.assertEqual(edited.zLevels[0].tiles[0, 0], edited.zLevels[0].tiles[2, 0])
+
+    def test_Load_mmap(self):
+        import numpy
+        from byond.map import Map
+        filename = self._write_map()
+        self.map.Load(filename)
+        self.assertEqual(self.map.zLevels[0].tiles.dtype, numpy.uint16)
+        
+        for _ in range(2):
+            mapped = Map()
+            mapped.Load(filename, mmap=True)
+            for z in range(2):
+                self.assertIsInstance(mapped.zLevels[z].tiles, numpy.memmap)
+                self.assertTrue((mapped.zLevels[z].tiles == self.map.zLevels[z].tiles).all())
+        
+        # Edits stay private and widen the grid when an ID doesn't fit.
+        zLevel = mapped.zLevels[0]
+        zLevel.SetTileID(0, 0, 2)
+        zLevel.fitTileID(70000)
+        self.assertEqual(zLevel.tiles.dtype, numpy.uint32)
+        self.assertEqual(zLevel.tiles[0, 0], 2)
+        self.assertTrue((zLevel.tiles[1:] == self.map.zLevels[0].tiles[1:]).all())
+        fresh = Map()
+        fresh.Load(filename, mmap=True)
+        self.assertEqual(fresh.zLevels[0].tiles[0, 0], self.map.zLevels[0].tiles[0, 0])
+        
+    def test_Load_selection(self):
+        from byond.map import Map
+        filename = self._write_map()
+        self.map.Load(filename)
+        
+        part = Map()
+        part.Load(filename, z=1, bbox=(1, 1, 3, 3))
+        self.assertEqual(len(part.zLevels), 1)
+        zLevel = part.zLevels[0]
+        self.assertEqual((zLevel.width, zLevel.height, zLevel.origin), (2, 2, (1, 1, 1)))
+        for x in range(2):
+            for y in range(2):
+                self.assertEqual(str(part.GetTileAt(x, y, 0)), str(self.map.GetTileAt(x + 1, y + 1, 1)))
+        # Rows 1-2 of z=2 only use "aaa" and "aab"; the cable tile is never built.
+        self.assertEqual(len(part.tiles), 2)
+        
+    def test_Load_selection_index(self):
+        from byond.map import Map
+        from byond.map.format.dmmindex import DMMIndex
+        filename = self._write_map()
+        index = DMMIndex(filename)
+        self.map.Load(filename, z=1, bbox=(1, 1, 3, 3))
+        
+        for _ in range(2):
+            part = Map()
+            part.Load(filename, z=1, bbox=(1, 1, 3, 3), index=True)
+            self.assertTrue(os.path.isfile(index.indexfile))
+            self.assertEqual([str(t) for t in part.tiles], [str(t) for t in self.map.tiles])
+            self.assertTrue((part.zLevels[0].tiles == self.map.zLevels[0].tiles).all())
+            self.assertEqual(part.zLevels[0].origin, (1, 1, 1))
+        
+        self.assertTrue(index.Read())
+        self.assertEqual([block[:3] for block in index.zlevels], [(1, 1, 1), (1, 1, 2)])
+        with open(filename, 'rb') as f:
+            line, _ = index.ReadDefinition(f, 'aac')
+        self.assertTrue(line.startswith('"aac" = (/obj/structure/cable'))
+
+        # A touched but unchanged map is hashed once, then trusted on mtime again.
+        from unittest import mock
+        mtime = os.stat(filename).st_mtime + 10
+        os.utime(filename, (mtime, mtime))
+        self.assertTrue(index.Read())
+        with open(index.indexfile) as f:
+            self.assertEqual(json.load(f)['mtime'], mtime)
+        with mock.patch('byond.map.format.dmmindex.md5sum', side_effect=AssertionError('hashed again')):
+            self.assertTrue(DMMIndex(filename).Read())
+
+        with open(filename, 'a') as f:
+            f.write('\n')
+        self.assertFalse(index.Read())
+        
+    def test_Load_lazy(self):
+        from byond.map import Map
+        from byond.map.format.base import LazyAtom
+        filename = self._write_map()
+        self.map.Load(filename)
+        
+        lazy = Map()
+        lazy.Load(filename, lazy=True)
+        self.assertTrue(all(isinstance(a, LazyAtom) for a in lazy.instances))
+        self.assertEqual(lazy.GetInstancePath(0), '/turf/space')
+        for z in range(2):
+            self.assertTrue((lazy.zLevels[z].tiles == self.map.zLevels[z].tiles).all())
+        
+        tile = lazy.GetTileAt(2, 0, 0)
+        self.assertEqual(str(tile), str(self.map.GetTileAt(2, 0, 0)))
+        self.assertFalse(isinstance(lazy.instances[tile.instances[0]], LazyAtom))
+        self.assertTrue(isinstance(lazy.instances[0], LazyAtom))
+        
+    def test_consumeTile_interns_atoms(self):
+        first = self.dmm.consumeTile('"aaa" = (/obj/structure/window/reinforced{dir = 8},/turf/space,/area)').instances
+        second = self.dmm.consumeTile('"aab" = (/obj/structure/window/reinforced{dir=8},/turf/space,/area/security/prison)').instances
+        self.assertEqual(first[:2], second[:2])
+        self.assertEqual(len(self.map.instances), 4)
+        self.assertEqual((self.dmm.atomCacheHits, self.dmm.atomCacheMisses), (2, 4))
+        self.assertAlmostEqual(self.dmm.GetAtomCacheHitRate(), 2 / 6.0)
+        
+    def test_Load_reuses_reader(self):
+        from byond.map import Map
+        filename = self._write_map()
+        expected = Map()
+        expected.Load(filename)
+        for kwargs in ({}, {}, {'z': 0}, {}):
+            self.dmm.Load(filename, **kwargs)
+            self.assertEqual((self.dmm.atomCacheHits, self.dmm.atomCacheMisses), (2, 6))
+            self.assertEqual(len(self.map.instances), 6)
+            zs = [kwargs['z']] if 'z' in kwargs else [0, 1]
+            self.assertListEqual(self._cells(self.map), [cell for z in zs for cell in self._cells(expected, z)])
+
+    def test_Load_workers(self):
+        from byond.map import Map
+        filename = self._write_map()
+        self.map.Load(filename)
+        
+        parallel = Map()
+        parallel.Load(filename, workers=2)
+        self.assertEqual([str(t) for t in parallel.tiles], [str(t) for t in self.map.tiles])
+        self.assertEqual([str(a) for a in parallel.instances], [str(a) for a in self.map.instances])
+        for z in range(2):
+            self.assertTrue((parallel.zLevels[z].tiles == self.map.zLevels[z].tiles).all())
+        
+    def test_Save_output(self):
+        filename = self._write_map()
+        self.map.Load(filename)
+        self.map.Save(filename)
+        with open(filename) as f:
+            self.assertEqual(f.read(), '''"a" = (/turf/space,/area)
+"b" = (/obj/structure/lattice,/turf/space,/area)
+"c" = (/obj/structure/cable{d1 = 1; d2 = 2; icon_state = "1-2"; tag = ""},/turf/simulated/floor{icon_state = "floorgrime"},/area/security/prison)
+
+(1,1,1) = {"
+abcb
+bcaa
+cabc
+"}
+
+(1,1,2) = {"
+bbbb
+aaaa
+bbbb
+"}
+''')
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,135 @@
+'''
+Finding and counting things on maps.
+'''
+import unittest
+from fixtures import MapTestCase
+
+class MapQueryTest(MapTestCase):
+    def setUp(self):
+        MapTestCase.setUp(self)
+        self.map = self._load_map()
+
+    def _brute(self, predicate):
+        # Walk every cell; what the indexes replace.
+        return [[x, y, z] for z in range(2) for y in range(3) for x in range(4) if predicate(self.map.GetTileAt(x, y, z))]
+
+    def test_Locate(self):
+        def holds(path):
+            return lambda tile: any(atom.path == path for atom in tile.GetAtoms())
+        lattices = self._brute(holds('/obj/structure/lattice'))
+        cables = self._brute(holds('/obj/structure/cable'))
+        self.assertListEqual(self.map.Locate('/obj/structure/lattice').tolist(), lattices)
+        self.assertListEqual(self.map.Locate('/obj/structure').tolist(), sorted(lattices + cables, key=lambda c: (c[2], c[1], c[0])))
+        self.assertListEqual(self.map.CountPerZ('/obj/structure/lattice'), [4, 8])
+        self.assertListEqual(self.map.CountPerZ('/obj/structure', subtypes=False), [0, 0])
+        self.assertListEqual(self.map.Locate('/obj/structure/lattice', z=1).tolist(), [c for c in lattices if c[2] == 1])
+
+        # Edits show up without rebuilding.
+        x, y, z = lattices[0]
+        self.map.SetTileAt(x, y, z, self.map.GetTileAt(0, 0, 0))
+        self.assertNotIn([x, y, z], self.map.Locate('/obj/structure/lattice').tolist())
+        self.assertListEqual(self.map.CountPerZ('/obj/structure/lattice'), [3, 8])
+
+        # So do registry tiles edited in place, as scripts/dmmfix.py does.
+        for tile in self.map.Tiles():
+            for atom in tile.GetAtoms(copy=True):
+                if atom.path == '/obj/structure/lattice':
+                    tile.RemoveAtom(atom)
+                    tile.AppendAtom(self.map.GetTileAt(2, 0, 0).GetAtom(0).copy())
+        self.assertListEqual(self.map.Locate('/obj/structure/lattice').tolist(), [])
+        self.assertListEqual(self.map.Locate('/obj/structure/cable').tolist(), self._brute(holds('/obj/structure/cable')))
+
+    def test_Query(self):
+        calls = []
+        def isPrison(tile):
+            calls.append(tile.ID)
+            return any(atom.path == '/area/security/prison' for atom in tile.GetAtoms())
+        expected = self._brute(isPrison)
+        calls = []
+        self.assertListEqual(self.map.Query(isPrison).tolist(), expected)
+        # Once per registry tile, not once per cell.
+        self.assertEqual(len(calls), len(self.map.tiles))
+
+        # Per-atom predicates give the same answer.
+        self.assertListEqual(self.map.Query(lambda atom: atom.path == '/area/security/prison', atoms=True).tolist(), expected)
+
+        masks = self.map.Query(isPrison, mask=True)
+        self.assertEqual(len(masks), 2)
+        self.assertEqual(masks[0].shape, (4, 3))
+        self.assertListEqual([[x, y, z] for z in range(2) for y in range(3) for x in range(4) if masks[z][x, y]], expected)
+
+    def test_locations(self):
+        def cellsOf(tileID):
+            return [(x, y, z) for z in range(2) for y in range(3) for x in range(4) if self.map.GetTileAt(x, y, z).ID == tileID]
+        for tile in self.map.tiles:
+            self.assertListEqual(tile.locations, cellsOf(tile.ID))
+
+        # Edits invalidate the index.
+        lattice = self.map.GetTileAt(1, 0, 0)
+        self.map.SetTileAt(0, 0, 0, lattice)
+        self.assertIn((0, 0, 0), lattice.locations)
+        self.assertListEqual(self.map.tiles[lattice.ID].locations, cellsOf(lattice.ID))
+
+        def holding(atomID):
+            return [(x, y, z) for z in range(2) for y in range(3) for x in range(4) for _ in range(self.map.GetTileAt(x, y, z).instances.count(atomID))]
+        def instanceLocations(atomID):
+            return sorted(map(tuple, self.map.GetInstanceLocations(atomID).tolist()), key=lambda c: (c[2], c[1], c[0]))
+        atomID = lattice.instances[0]
+        self.assertListEqual(instanceLocations(atomID), holding(atomID))
+        self.assertEqual(len(self.map.GetInstanceLocations(atomID)), len(cellsOf(lattice.ID)))
+        # The registry is only walked once.
+        inverse = self.map._instance_tiles
+        self.assertIsNotNone(inverse)
+        self.map.GetInstanceLocations(lattice.instances[1])
+        self.assertIs(self.map._instance_tiles, inverse)
+
+        # New tiles and registry tiles edited in place are picked up.
+        tile = self.map.CopyTileAt(2, 0, 0)
+        tile.AppendAtom(lattice.GetAtom(0))
+        tile.AppendAtom(lattice.GetAtom(0))
+        self.map.SetTileAt(2, 0, 0, tile)
+        self.assertListEqual(instanceLocations(atomID), holding(atomID))
+        self.assertEqual(instanceLocations(atomID).count((2, 0, 0)), 2)
+        registered = self.map.tiles[lattice.ID]
+        registered.RemoveAtom(registered.GetAtom(0))
+        self.assertListEqual(instanceLocations(atomID), holding(atomID))
+
+    def test_iteration(self):
+        cells = list(self.map.IterTileIDs())
+        self.assertListEqual(cells, [(x, y, z, self.map.GetTileAt(x, y, z).ID) for z in range(2) for y in range(3) for x in range(4)])
+        self.assertListEqual([(tile.coords, tile.ID) for tile in self.map.Locations()], [((x, y, z), tileID) for x, y, z, tileID in cells])
+        self.assertListEqual(list(self.map.IterTileIDs(z=1)), cells[12:])
+
+        rows = list(self.map.IterRows())
+        self.assertEqual(len(rows), 6)
+        y, z, row = rows[4]
+        self.assertEqual((y, z), (1, 1))
+        self.assertListEqual(row.tolist(), [tileID for _, _, _, tileID in cells[16:20]])
+        with self.assertRaises(ValueError):
+            row[0] = 0
+        x, z, column = list(self.map.IterColumns(z=0))[2]
+        self.assertListEqual(column.tolist(), [self.map.GetTileAt(2, y, 0).ID for y in range(3)])
+
+        # Views by ID are shared.
+        self.assertIs(self.map.GetTileByID(cells[0][3]), self.map.GetTileByID(cells[0][3]))
+
+    def test_MapStats(self):
+        from byond.map.stats import MapStats
+        stats = MapStats(self.map)
+        self.assertEqual(int(stats.GetTileCounts().sum()), 24)
+        self.assertDictEqual(stats.GetPathCounts(), {
+            '/turf/space': 20,
+            '/area': 20,
+            '/obj/structure/lattice': 12,
+            '/obj/structure/cable': 4,
+            '/turf/simulated/floor': 4,
+            '/area/security/prison': 4,
+        })
+        self.assertDictEqual(stats.GetPathCounts(z=1), {'/turf/space': 12, '/area': 12, '/obj/structure/lattice': 8})
+        self.assertEqual(stats.CountPath('/turf'), 24)
+        self.assertEqual(stats.CountPath('/area', subtypes=False), 20)
+        self.assertDictEqual(dict(stats.GetPropertyCounts('icon_state', '/obj/structure/cable')), {'"1-2"': 4})
+        self.assertDictEqual(dict(stats.GetPropertyCounts('icon_state', '/turf', z=0)), {None: 8, '"floorgrime"': 4})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+'''
+Diffing, merging and patching maps.
+'''
+import unittest
+from fixtures import MapTestCase, EditMap
+
+CABLE = '/obj/structure/cable{d1 = 1; d2 = 2; icon_state = "1-2"; tag = ""}'
+
+class MapDiffTest(MapTestCase):
+    def test_changes(self):
+        from byond.map.diff import MapDiff
+        old = self._load_map()
+        # aad is a duplicate of aab, so only row 0 of z 0 really changes.
+        new = self._load_map(EditMap('', ('aaaaabaacaad', 'aabaabaaaaad'), ('aadaadaadaad', 'aabaabaabaad')))
+
+        diff = MapDiff(old, new)
+        self.assertListEqual(diff.mismatched, [])
+        self.assertListEqual(diff.GetChangedCells(0).tolist(), [[0, 0], [2, 0]])
+        self.assertEqual(diff.CountChangedCells(), 2)
+        changes = dict(((x, y, z), change) for x, y, z, change in diff)
+        self.assertListEqual(sorted(changes.keys()), [(0, 0, 0), (2, 0, 0)])
+        self.assertDictEqual(dict(changes[0, 0, 0].added), {'/obj/structure/lattice': 1})
+        self.assertDictEqual(dict(changes[0, 0, 0].removed), {})
+        self.assertDictEqual(dict(changes[2, 0, 0].added), {'/turf/space': 1, '/area': 1})
+        self.assertDictEqual(dict(changes[2, 0, 0].removed), {CABLE: 1, '/turf/simulated/floor{icon_state = "floorgrime"}': 1, '/area/security/prison': 1})
+
+        # Each pair of tiles is only worked out once.
+        x, y, z, oldID, newID = next(diff.Changes())
+        self.assertIs(diff.GetChange(oldID, newID), changes[0, 0, 0])
+
+        new.zLevels[1].Resize(2, 2)
+        self.assertListEqual(MapDiff(old, new).mismatched, [1])
+
+class MapMergeTest(MapTestCase):
+    def setUp(self):
+        MapTestCase.setUp(self)
+        self.base = self._load_map()
+
+    def _merge(self, ours, theirs):
+        from byond.map.merge import MapMerge
+        merge = MapMerge(self.base, ours, theirs)
+        return merge, merge.Merge()
+
+    def test_one_side_changes(self):
+        # We change <0,0,0> and put a grille on plating at <1,0,0>...
+        ours = self._load_map(EditMap('"aae" = (/obj/structure/grille,/obj/structure/lattice,/turf/simulated/floor/plating,/area)', ('aaaaabaacaad', 'aacaaeaacaad')))
+        # ...they change <3,1,1>, turn <2,0,0>, which we left alone, into
+        # space, and put a floor at <1,0,0>.
+        theirs = self._load_map(EditMap('', ('aaaaabaacaad', 'aaaaacaaaaad'), ('aaaaaaaaaaaa\naab', 'aaaaaaaaaaac\naab')))
+
+        merge, result = self._merge(ours, theirs)
+        self.assertEqual(str(result.GetTileAt(0, 0, 0)), str(ours.GetTileAt(0, 0, 0)))
+        self.assertEqual(str(result.GetTileAt(2, 0, 0)), str(theirs.GetTileAt(2, 0, 0)))
+        self.assertEqual(str(result.GetTileAt(3, 1, 1)), str(theirs.GetTileAt(3, 1, 1)))
+        self.assertEqual(str(result.GetTileAt(3, 2, 1)), str(self.base.GetTileAt(3, 2, 1)))
+        # Two turfs at <1,0,0>.
+        self.assertListEqual(merge.GetConflicts().tolist(), [[1, 0, 0]])
+        self.assertEqual(str(result.GetTileAt(1, 0, 0)), str(ours.GetTileAt(1, 0, 0)))
+
+    def test_atom_merge(self):
+        # Without the clash, both sides' atoms are kept.
+        theirs = self._load_map(EditMap('"aae" = (/obj/structure/lattice,/obj/structure/cable,/turf/space,/area)', ('aaaaabaacaad', 'aaaaaeaacaad')))
+        ours = self._load_map(EditMap('"aae" = (/obj/structure/grille,/obj/structure/lattice,/turf/space,/area)', ('aaaaabaacaad', 'aaaaaeaacaad')))
+        merge, result = self._merge(ours, theirs)
+        self.assertEqual(len(merge.GetConflicts()), 0)
+        self.assertEqual(merge.atomMerges, 1)
+        self.assertListEqual([atom.path for atom in result.GetTileAt(1, 0, 0).GetAtoms()], ['/obj/structure/grille', '/obj/structure/lattice', '/obj/structure/cable', '/turf/space', '/area'])
+
+    def test_removed_levels(self):
+        from fixtures import TEST_MAP
+        removed = TEST_MAP.split('(1,1,2)')[0]
+        edited = EditMap('', ('aadaadaadaad', 'aaaaadaadaad'))
+        for oursRemoved in (True, False):
+            def sides(removedSide, otherSide):
+                return (self._load_map(removedSide), self._load_map(otherSide)) if oursRemoved else (self._load_map(otherSide), self._load_map(removedSide))
+
+            # Left alone on the other side, the level goes.
+            ours, theirs = sides(removed, TEST_MAP)
+            merge, result = self._merge(ours, theirs)
+            self.assertEqual(len(result.zLevels), 1)
+            self.assertEqual(len(merge.GetConflicts()), 0)
+            self.assertListEqual(self._cells(result), self._cells(self.base, 0))
+
+            # Edited on the other side, the whole level conflicts and keeps the edits.
+            ours, theirs = sides(removed, edited)
+            merge, result = self._merge(ours, theirs)
+            self.assertEqual(len(result.zLevels), 2)
+            self.assertEqual(len(merge.GetConflicts()), 12)
+            self.assertTrue((merge.GetConflicts()[:, 2] == 1).all())
+            self.assertListEqual(self._cells(result, 1), self._cells(self._load_map(edited), 1))
+
+        # Both sides removing it agree.
+        merge, result = self._merge(self._load_map(removed), self._load_map(removed))
+        self.assertEqual(len(result.zLevels), 1)
+        self.assertEqual(len(merge.GetConflicts()), 0)
+
+class MapPatchTest(MapTestCase):
+    def test_Apply(self):
+        from byond.map.patch import MapPatch
+        self.map = self._load_map()
+        space = self.map.GetTileAt(0, 0, 0).GetContentHash()
+        lattice = self.map.GetTileAt(1, 0, 0).GetContentHash()
+        patch = MapPatch()
+        patch.Parse([
+            '<0,0,0>',
+            ' @CHECK {} {} (/obj/structure/lattice,/turf/space,/area)'.format(space, lattice),
+            ' + /obj/structure/lattice',
+            '<3,0,0>',
+            ' -ALL',
+            ' + /turf/space',
+            ' + /area',
+            '<2,0,0>',
+            ' + ' + CABLE,
+            '<2,0,0>',
+            ' -* ' + CABLE,
+            ' +2 /obj/structure/grille',
+        ])
+        patch.Apply(self.map)
+        self.assertEqual(str(self.map.GetTileAt(0, 0, 0)), str(self.map.GetTileAt(1, 0, 0)))
+        self.assertEqual(self.map.GetTileAt(3, 0, 0).GetContentHash(), space)
+        self.assertListEqual([atom.path for atom in self.map.GetTileAt(2, 0, 0).GetAtoms()], ['/turf/simulated/floor', '/area/security/prison', '/obj/structure/grille', '/obj/structure/grille'])
+        self.assertDictEqual(patch.stats, {0: [6, 2]})
+        self.assertListEqual(self.map.GetTileLocations(self.map.GetTileAt(1, 0, 0).ID).tolist()[:4], [[0, 0, 0], [1, 0, 0], [0, 1, 0], [2, 2, 0]])
+
+        # Cells already patched are left alone.
+        patch.Apply(self.map)
+        self.assertIn((0, 0, 0), patch.skipped)
+        self.assertEqual(str(self.map.GetTileAt(0, 0, 0)), str(self.map.GetTileAt(1, 0, 0)))
+
+        # Blocks off the map are skipped, not wrapped around or crashed on.
+        cells = self._cells(self.map)
+        outside = MapPatch()
+        outside.Parse(['<-1,0,0>', ' -ALL', '<4,0,0>', ' -ALL', '<0,3,1>', ' -ALL', '<0,0,2>', ' -ALL'])
+        with self.assertLogs('byond.map.patch', 'WARNING') as logs:
+            outside.Apply(self.map)
+        self.assertEqual(len(logs.output), 3)
+        self.assertListEqual(self._cells(self.map), cells)
+        self.assertDictEqual(outside.stats, {})
+
+        with self.assertRaises(ValueError):
+            MapPatch().Parse([' + /obj/structure/lattice'])
+
+if __name__ == "__main__":
+    unittest.main()
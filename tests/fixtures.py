@@ -0,0 +1,89 @@
+'''
+Maps shared by the map tests.
+'''
+import unittest, os, tempfile
+
+# Non-square, two z-levels, and "aad" duplicates "aab".
+TEST_MAP = '''"aaa" = (/turf/space,/area)
+"aab" = (/obj/structure/lattice,/turf/space,/area)
+"aac" = (/obj/structure/cable{d1 = 1; d2 = 2; icon_state = "1-2"; tag = ""},/turf/simulated/floor{icon_state = "floorgrime"},/area/security/prison)
+"aad" = (/obj/structure/lattice,/turf/space,/area)
+
+(1,1,1) = {"
+aaaaabaacaad
+aabaacaaaaaa
+aacaaaaabaac
+"}
+
+(1,1,2) = {"
+aadaadaadaad
+aaaaaaaaaaaa
+aabaabaabaab
+"}
+'''
+
+def EditMap(definitions='', *rows):
+    '''
+    :param definitions str: Extra tile definitions, one per line.
+    :param rows tuple: (old, new) replacements in the map body.
+    :return str: TEST_MAP with the changes.
+    '''
+    contents = TEST_MAP
+    if definitions:
+        contents = contents.replace('\n\n(1,1,1)', '\n' + definitions + '\n\n(1,1,1)')
+    for old, new in rows:
+        contents = contents.replace(old, new)
+    return contents
+
+def MakeTree():
+    '''
+    :return byond.objtree.ObjectTree: Holds every path in TEST_MAP, with an
+        empty icon_state and its hash already worked out, as after use.
+    '''
+    from byond.objtree import ObjectTree
+    from byond.basetypes import Atom, BYONDString
+    tree = ObjectTree()
+    for path in ('/turf/space', '/turf/simulated/floor', '/area', '/area/security/prison', '/obj/structure/lattice', '/obj/structure/cable'):
+        atom = Atom(path)
+        atom.properties['icon_state'] = BYONDString('')
+        atom.GetHash()
+        tree.Atoms[path] = atom
+    return tree
+
+class MapTestCase(unittest.TestCase):
+    '''
+    Gives each test an empty :class:`byond.map.Map` with a DMM reader, and
+    temporary map files that are cleaned up afterwards.
+    '''
+    def setUp(self):
+        from byond.map.format.dmm import DMMFormat
+        from byond.map import Map
+        self.map = Map()
+        self.dmm = DMMFormat(self.map)
+
+    def _write_map(self, contents=TEST_MAP):
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        def cleanup():
+            for path in (filename, filename + '.cache', filename + '.idx'):
+                if os.path.isfile(path):
+                    os.remove(path)
+        self.addCleanup(cleanup)
+        return filename
+
+    def _load_map(self, contents=TEST_MAP, **kwargs):
+        '''
+        Load contents into a new map.
+        '''
+        from byond.map import Map
+        _map = Map()
+        _map.Load(self._write_map(contents), **kwargs)
+        return _map
+
+    def _cells(self, _map, z=None):
+        '''
+        :return list: str() of the tile on every cell, z by z, row by row.
+        '''
+        zs = range(len(_map.zLevels)) if z is None else [z]
+        return [str(_map.GetTileAt(x, y, z)) for z in zs for y in range(_map.zLevels[z].height) for x in range(_map.zLevels[z].width)]
@@ -2,6 +2,9 @@ import unittest
 
 from Atom import *
 from MapParser import *
+from MapEditing import *
+from MapQueries import *
+from MapTools import *
 from MapRendering import *
 from ObjectTree import *
 